@@ -1,16 +1,27 @@
-from contextlib import contextmanager
+import asyncio
+import contextlib
+import contextvars
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
 from sqlalchemy import MetaData, create_engine, event
 from sqlalchemy.exc import DisconnectionError
 from sqlalchemy.orm import sessionmaker
 
 from .base import Base
-from .job import Job
+from .job import Job, JobArray, JobNode, JobDependency, JobHistory, JobState, FINISHED_STATES
+from .node import Node
+from .migrate import migrate
+
+
+# session and lock of the batch the current task is running in, see Database.batch()
+_batch = contextvars.ContextVar('batch', default=None)
 
 
 class Database(object):
     """Manages the database connection for PyBS."""
 
-    def __init__(self, connect: str):
+    def __init__(self, connect: str, threads: int = 4, metrics: 'Metrics' = None, tracer: 'Tracer' = None):
         """Creates a new Database object.
 
         Examples for connect URI:
@@ -23,12 +34,19 @@ class Database(object):
 
         Args:
             connect: URI for database connection.
+            threads: Maximum number of threads for running database operations asynchronously.
+            metrics: If given, the duration of all operations run via run() is recorded there.
+            tracer: If given, all queries are timed and attributed to the operation run via run().
         """
+        self._metrics = metrics
+        self._tracer = tracer
 
         # create engine
         self._engine = create_engine(connect)
         self._engine.echo = False
         event.listen(self._engine, 'checkout', Database._checkout_listener)
+        if tracer is not None:
+            tracer.instrument(self._engine)
 
         # and metadata
         MetaData(self._engine)
@@ -36,8 +54,17 @@ class Database(object):
         # and session
         self._session = sessionmaker(bind=self._engine)
 
-        # create tables
+        # create tables and migrate existing ones
         Base.metadata.create_all(self._engine, checkfirst=True)
+        migrate(self._engine)
+
+        # thread pool for asynchronous access
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+
+    def close(self):
+        """Wait for running operations and close database connection."""
+        self._executor.shutdown()
+        self._engine.dispose()
 
     @staticmethod
     def _checkout_listener(dbapi_con, con_record, con_proxy):
@@ -73,5 +100,127 @@ class Database(object):
         finally:
             session.close()
 
+    @asynccontextmanager
+    async def batch(self):
+        """Run all operations of the current task, and of tasks started from it, in a single session.
+
+        The operations run one after another in the thread pool, so that a batch never needs more than one thread and
+        connection. Each operation is still committed on its own, so that its changes are visible to others
+        immediately. Operations that run after the batch is finished, e.g. in tasks started from it, run on their own.
+        """
+
+        # nested batches simply use the outer one
+        if _batch.get() is not None:
+            yield
+            return
+
+        # create session and a lock for using it in one operation at a time
+        batch = {'session': self._session(), 'lock': asyncio.Lock(), 'open': True}
+        token = _batch.set(batch)
+        try:
+            yield
+
+        finally:
+            # close session
+            _batch.reset(token)
+            batch['open'] = False
+            async with batch['lock']:
+                await asyncio.get_event_loop().run_in_executor(self._executor, batch['session'].close)
+
+    async def run(self, func, *args):
+        """Run a function in a transactional scope in a worker thread, so that the event loop is not blocked.
+
+        Since the session is closed afterwards, the function should not return any database objects.
+
+        Args:
+            func: Function to run, which gets a session as first parameter.
+            *args: Further parameters for function.
+
+        Returns:
+            Return value of function.
+        """
+        loop = asyncio.get_event_loop()
+
+        # within a batch?
+        batch = _batch.get()
+        if batch is not None and batch['open']:
+            async with batch['lock']:
+                future = loop.run_in_executor(self._executor, self._run_in_session, batch['session'], func, args)
+                try:
+                    return await asyncio.shield(future)
+                except asyncio.CancelledError:
+                    # the next operation must not use the session, before this one is done with it
+                    await asyncio.wait([future])
+                    raise
+
+        # run in pool
+        return await loop.run_in_executor(self._executor, self._run, func, args)
+
+    def _run(self, func, args):
+        """Run a function in a transactional scope.
+
+        Args:
+            func: Function to run, which gets a session as first parameter.
+            args: Further parameters for function.
+
+        Returns:
+            Return value of function.
+        """
+        start = time.perf_counter()
+        try:
+            with self._operation(func), self() as session:
+                return func(session, *args)
+        finally:
+            self._observe(func, start)
+
+    def _run_in_session(self, session: 'Session', func, args):
+        """Run a function in a new transaction on an existing session.
+
+        Args:
+            session: Session to use.
+            func: Function to run, which gets a session as first parameter.
+            args: Further parameters for function.
+
+        Returns:
+            Return value of function.
+        """
+        start = time.perf_counter()
+        try:
+            with self._operation(func):
+                result = func(session, *args)
+                session.commit()
+            return result
+        except:
+            session.rollback()
+            raise
+        finally:
+            self._observe(func, start)
+
+    @staticmethod
+    def _operation_name(func) -> str:
+        """Name of an operation, derived from the function, like "PyBSdaemon.submit.query"."""
+        return getattr(func, '__qualname__', repr(func)).replace('.<locals>', '')
+
+    def _operation(self, func):
+        """Returns a context manager that attributes all queries in it to the operation, if tracing.
+
+        Args:
+            func: Function that is run.
+        """
+        if self._tracer is None:
+            return contextlib.nullcontext()
+        return self._tracer.operation(self._operation_name(func))
+
+    def _observe(self, func, start: float):
+        """Record duration of an operation.
+
+        Args:
+            func: Function that was run.
+            start: Start time from time.perf_counter().
+        """
+        if self._metrics is not None:
+            self._metrics.db_latency.observe(time.perf_counter() - start, operation=self._operation_name(func))
+
 
-__all__ = ['Database', 'Job']
+__all__ = ['Database', 'Job', 'JobArray', 'JobNode', 'JobDependency', 'JobHistory', 'JobState', 'FINISHED_STATES',
+           'Node']
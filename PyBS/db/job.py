@@ -1,27 +1,83 @@
 import datetime
+import enum
+import functools
+import json
 import os
 import re
-from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy import Column, Integer, BigInteger, Float, String, Text, DateTime, Enum, ForeignKey, Index
+from sqlalchemy.orm import relationship
 
 from .base import Base
 
 
-class Job(Base):
-    """A single job in the database."""
-    __tablename__ = 'job'
+class JobState(enum.Enum):
+    """State of a job."""
+    waiting = 'waiting'
+    running = 'running'
+    done = 'done'
+    failed = 'failed'
+    cancelled = 'cancelled'
+
+
+# states of finished jobs
+FINISHED_STATES = (JobState.done, JobState.failed, JobState.cancelled)
+
+# a single line in the PBS header
+PBS_HEADER_LINE = re.compile(r'#PBS \-(\w) (.*)')
+
+# units for sizes in the PBS header, a word is 8 bytes
+SIZE_UNITS = {'b': 1, 'w': 8, 'kb': 1024, 'kw': 8 * 1024, 'mb': 1024 ** 2, 'mw': 8 * 1024 ** 2,
+              'gb': 1024 ** 3, 'gw': 8 * 1024 ** 3, 'tb': 1024 ** 4, 'tw': 8 * 1024 ** 4}
+
+
+class JobColumns(object):
+    """Columns shared by active and archived jobs."""
 
     id = Column(Integer, comment='unique ID for job', primary_key=True)
     name = Column(String(100), comment='job name', index=True, nullable=False)
     username = Column(String(20), comment='submitting user', nullable=False)
     filename = Column(String(200), comment='filename of submitted script', nullable=False)
     ncpus = Column(Integer, comment='number of requested CPUs', nullable=False)
+    mem = Column(BigInteger, comment='requested memory in bytes, unlimited if empty')
+    walltime = Column(Integer, comment='maximum run time in seconds, unlimited if empty')
     priority = Column(Integer, comment='priority of job', nullable=False, default=0)
     nodes = Column(String(100), comment='run job only on nodes in this comma-separated list')
     node = Column(String(100), comment='node that job actually runs/ran on')
+    cores = Column(String(200), comment='list of CPU cores the job is pinned to, e.g. "0-3,8"')
     pid = Column(Integer, comment='process ID of running job')
+    pid_started = Column(BigInteger, comment='start time of process in clock ticks after boot, to detect reused PIDs')
     submitted = Column(DateTime, comment='date and time of submission')
     started = Column(DateTime, comment='date and time of execution start')
     finished = Column(DateTime, comment='date and time of execution end')
+    state = Column(Enum(JobState), comment='state of job', nullable=False, default=JobState.waiting)
+    exit_code = Column(Integer, comment='exit code of script, negative signal number if it was killed')
+    cpu_user = Column(Float, comment='CPU time spent in user mode in seconds')
+    cpu_system = Column(Float, comment='CPU time spent in kernel mode in seconds')
+    max_rss = Column(BigInteger, comment='peak resident set size of largest process in bytes')
+    io_read = Column(BigInteger, comment='bytes read from storage')
+    io_write = Column(BigInteger, comment='bytes written to storage')
+    array_id = Column(Integer, comment='ID of array job this job is a task of')
+    array_index = Column(Integer, comment='index of task within array job')
+    header = Column(Text, comment='PBS header of script as JSON, parsed at submission')
+
+
+class Job(JobColumns, Base):
+    """A single job in the database."""
+    __tablename__ = 'job'
+    __table_args__ = (
+        # running jobs by start
+        Index('ix_job_state_started', 'state', 'started'),
+        # finished jobs, newest first
+        Index('ix_job_finished', 'finished'),
+        # running jobs on a given node
+        Index('ix_job_node_state', 'node', 'state'),
+        # tasks of an array job
+        Index('ix_job_array', 'array_id', 'array_index'),
+        # never reuse IDs of jobs moved to the history, which SQLite would do without AUTOINCREMENT
+        {'sqlite_autoincrement': True}
+    )
+
+    allowed_nodes = relationship('JobNode', cascade='all, delete-orphan')
 
     @staticmethod
     def parse_pbs_header(filename: str) -> dict:
@@ -29,11 +85,17 @@ class Job(Base):
 
         Example for a PBS header:
         #PBS -l ncpus=20
+        #PBS -l mem=4gb
+        #PBS -l walltime=12:00:00
         #PBS -N {{JOBNAME}}
         #PBS -e {{PATH}}/{{NAME}}.error
         #PBS -o {{PATH}}/{{NAME}}.output
         #PBS -m a
         #PBS -M musegc@astro.physik.uni-goettingen.de
+        #PBS -J 1-100
+        #PBS -W depend=afterok:123
+
+        Parsed headers are cached as long as modification time and size of the file do not change.
 
         Args:
             filename: Name of file to parse.
@@ -41,9 +103,22 @@ class Job(Base):
         Returns:
             Dictionary with all header items.
         """
+        st = os.stat(filename)
+        return dict(Job._parse_pbs_header(filename, st.st_mtime_ns, st.st_size))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def _parse_pbs_header(filename: str, mtime: int, size: int) -> dict:
+        """Actually parse the PBS header, which ends at the first line that is not a comment.
+
+        Args:
+            filename: Name of file to parse.
+            mtime: Modification time of file, only used as key for cache.
+            size: Size of file, only used as key for cache.
 
-        # compile regexp
-        regexp = re.compile(r'#PBS \-(\w) (.*)')
+        Returns:
+            Dictionary with all header items, must not be modified.
+        """
 
         # init header
         header = {}
@@ -51,8 +126,12 @@ class Job(Base):
         # open file
         with open(filename, 'r') as f:
             for line in f:
+                # end of header?
+                if line.strip() and not line.startswith('#'):
+                    break
+
                 # apply regexp
-                m = regexp.match(line)
+                m = PBS_HEADER_LINE.match(line)
                 if m is None:
                     continue
 
@@ -74,16 +153,22 @@ class Job(Base):
                     header['slack'] = m.group(2)
                 elif m.group(1) == 'p':
                     header['priority'] = int(m.group(2))
+                elif m.group(1) == 'J':
+                    header['array'] = m.group(2).strip()
+                elif m.group(1) == 'W':
+                    s = m.group(2).split('=', 1)
+                    header[s[0].strip()] = s[1].strip() if len(s) > 1 else ''
 
         # return it
         return header
 
     @staticmethod
-    def from_file(filename: str) -> 'Job':
+    def from_file(filename: str, header: dict = None) -> 'Job':
         """Create a new Job object from a given script file.
 
         Args:
             filename: Name of file to parse PBS header from.
+            header: Already parsed PBS header of file, if available.
 
         Returns:
             New job created from file.
@@ -98,9 +183,11 @@ class Job(Base):
 
         # fill basic stuff
         job.submitted = datetime.datetime.now()
+        job.state = JobState.waiting
 
         # parse header
-        header = Job.parse_pbs_header(filename)
+        if header is None:
+            header = Job.parse_pbs_header(filename)
 
         # we need at least a job name and number of cpus
         if 'name' not in header:
@@ -112,13 +199,154 @@ class Job(Base):
 
         # fill rest
         job.name = header['name']
-        job.ncpus = header['ncpus']
+        job.ncpus = int(header['ncpus'])
         if 'nodes' in header:
             job.nodes = header['nodes']
+            job.allowed_nodes = [JobNode(node=n) for n in JobNode.split(header['nodes'])]
         job.priority = header['priority'] if 'priority' in header else 0
+        if 'mem' in header:
+            job.mem = Job.parse_size(header['mem'])
+        if 'walltime' in header:
+            job.walltime = Job.parse_walltime(header['walltime'])
+        job.header = json.dumps(header)
 
         # return new job
         return job
 
+    @staticmethod
+    def parse_size(size: str) -> int:
+        """Parse a size like "4gb" or "512mb", which is given in bytes, if no unit is given.
+
+        Args:
+            size: Size as given in the PBS header.
+
+        Returns:
+            Size in bytes.
+        """
+        m = re.match(r'^(\d+)([kmgt]?[bw])?$', str(size).strip().lower())
+        if m is None:
+            raise ValueError('Invalid size: %s' % size)
+        return int(m.group(1)) * SIZE_UNITS[m.group(2) or 'b']
+
+    @staticmethod
+    def parse_walltime(walltime: str) -> int:
+        """Parse a walltime in the form "[[hours:]minutes:]seconds".
+
+        Args:
+            walltime: Walltime as given in the PBS header.
+
+        Returns:
+            Walltime in seconds.
+        """
+        s = str(walltime).strip().split(':')
+        if len(s) > 3 or not all(v.isdigit() for v in s):
+            raise ValueError('Invalid walltime: %s' % walltime)
+        seconds = 0
+        for v in s:
+            seconds = seconds * 60 + int(v)
+        return seconds
+
+
+# waiting jobs in the order they are started, priority must be descending, so that no sorting is required
+Index('ix_job_dispatch', Job.state, Job.priority.desc(), Job.submitted, Job.id)
+
+# and the same for the waiting jobs of a single user
+Index('ix_job_user_dispatch', Job.state, Job.username, Job.priority.desc(), Job.submitted, Job.id)
+
+
+class JobArray(Base):
+    """An array job, whose tasks are stored as single jobs."""
+    __tablename__ = 'job_array'
+
+    id = Column(Integer, comment='unique ID for array job', primary_key=True)
+    name = Column(String(100), comment='job name', nullable=False)
+    username = Column(String(20), comment='submitting user', nullable=False)
+    filename = Column(String(200), comment='filename of submitted script', nullable=False)
+    indices = Column(String(50), comment='range of task indices as given in header', nullable=False)
+    submitted = Column(DateTime, comment='date and time of submission')
+
+    @staticmethod
+    def parse_indices(indices: str) -> range:
+        """Parse a range of task indices in the form "first-last" or "first-last:step".
+
+        Args:
+            indices: Range of indices as given in the PBS header.
+
+        Returns:
+            Range of indices.
+        """
+        m = re.match(r'^(\d+)-(\d+)(?::(\d+))?$', indices)
+        if m is None:
+            raise ValueError('Invalid range of array indices: %s' % indices)
+        first, last, step = int(m.group(1)), int(m.group(2)), int(m.group(3) or 1)
+        if last < first or step < 1:
+            raise ValueError('Invalid range of array indices: %s' % indices)
+        return range(first, last + 1, step)
+
+
+class JobNode(Base):
+    """A node that a job is allowed to run on. Jobs without any of these can run on all nodes."""
+    __tablename__ = 'job_node'
+
+    job_id = Column(Integer, ForeignKey('job.id', ondelete='CASCADE'), comment='ID of job', primary_key=True)
+    node = Column(String(100), comment='name of node', primary_key=True, index=True)
+
+    @staticmethod
+    def split(nodes: str) -> list:
+        """Split a comma-separated list of nodes.
+
+        Args:
+            nodes: Comma-separated list of nodes.
+
+        Returns:
+            List of unique node names.
+        """
+        return sorted(set(n.strip() for n in nodes.split(',') if n.strip()))
+
+
+class JobDependency(Base):
+    """A dependency of a waiting job on another job, which is deleted as soon as it is satisfied."""
+    __tablename__ = 'job_dependency'
+
+    # types of dependencies and the states of the other job that satisfy them
+    TYPES = {
+        'afterok': (JobState.done,),
+        'afternotok': (JobState.failed, JobState.cancelled),
+        'afterany': FINISHED_STATES
+    }
+
+    job_id = Column(Integer, ForeignKey('job.id', ondelete='CASCADE'), comment='ID of waiting job', primary_key=True)
+    depends_on = Column(Integer, comment='ID of job it depends on', primary_key=True, index=True)
+    type = Column(String(20), comment='type of dependency, i.e. afterok, afternotok, or afterany', nullable=False)
+
+    @staticmethod
+    def parse(depend: str) -> list:
+        """Parse dependencies in the form "type:id[:id...][,type:id[:id...]...]".
+
+        Args:
+            depend: Dependencies as given in the PBS header.
+
+        Returns:
+            List of tuples with type and ID of job to depend on.
+        """
+        dependencies = []
+        for item in depend.split(','):
+            s = item.strip().split(':')
+            if s[0] not in JobDependency.TYPES or len(s) < 2:
+                raise ValueError('Invalid dependency: %s' % item)
+            try:
+                dependencies.extend((s[0], int(job_id.split('.')[0])) for job_id in s[1:])
+            except ValueError:
+                raise ValueError('Invalid dependency: %s' % item)
+        return dependencies
+
+
+class JobHistory(JobColumns, Base):
+    """A finished job that has been moved out of the job table."""
+    __tablename__ = 'job_history'
+    __table_args__ = (
+        Index('ix_job_history_finished', 'finished'),
+    )
+
 
-__all__ = ['job']
+__all__ = ['Job', 'JobArray', 'JobNode', 'JobDependency', 'JobHistory', 'JobState', 'FINISHED_STATES']
@@ -0,0 +1,181 @@
+import logging
+from sqlalchemy import MetaData, func, inspect
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from .base import Base
+from .job import Job, JobHistory, JobNode, JobState
+
+log = logging.getLogger(__name__)
+
+
+def migrate(engine: Engine):
+    """Bring an existing database up to date with the current schema.
+
+    Tables that do not exist yet are created by Base.metadata.create_all(), so only changes to existing tables and
+    their data are handled here. All steps can safely be run on every start.
+
+    Args:
+        engine: Engine for database to migrate.
+    """
+    _add_missing_columns(engine)
+    _migrate_job_ids(engine)
+    _migrate_job_states(engine)
+    _create_missing_indexes(engine)
+    _migrate_job_nodes(engine)
+
+
+def _add_missing_columns(engine: Engine):
+    """Add columns that have been added to existing tables.
+
+    New columns are always added as nullable, since existing rows have no value for them yet.
+
+    Args:
+        engine: Engine for database to migrate.
+    """
+
+    # loop all tables
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        # get existing columns
+        existing = set(col['name'] for col in inspector.get_columns(table.name))
+
+        # add missing ones
+        for column in table.columns:
+            if column.name not in existing:
+                log.info('Adding column %s to table %s...', column.name, table.name)
+                engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table.name, column.name,
+                                                                    column.type.compile(dialect=engine.dialect)))
+
+
+def _migrate_job_ids(engine: Engine):
+    """Make sure that IDs of jobs are never reused, even after all jobs have been moved to the history.
+
+    SQLite only guarantees this for tables with AUTOINCREMENT, so job tables created without it are rebuilt, keeping
+    all rows. Missing indexes are created again afterwards. Since InnoDB in MySQL before 8.0 resets its counter to the
+    largest existing ID on restart, the counter is then raised above all IDs in the history, too.
+
+    Args:
+        engine: Engine for database to migrate.
+    """
+
+    with engine.begin() as conn:
+        # rebuild SQLite table without AUTOINCREMENT
+        if engine.dialect.name == 'sqlite':
+            sql = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'job'").scalar()
+            if 'AUTOINCREMENT' not in sql.upper():
+                log.info('Rebuilding table job with AUTOINCREMENT...')
+                table = Job.__table__.to_metadata(MetaData(), name='job_rebuild')
+                table.indexes.clear()
+                table.create(conn)
+                columns = ', '.join(c.name for c in Job.__table__.columns)
+                conn.execute('INSERT INTO job_rebuild (%s) SELECT %s FROM job' % (columns, columns))
+                conn.execute('DROP TABLE job')
+                conn.execute('ALTER TABLE job_rebuild RENAME TO job')
+
+        # largest ID ever used
+        max_id = max(conn.execute(func.max(table.c.id).select()).scalar() or 0
+                     for table in (Job.__table__, JobHistory.__table__))
+        if max_id == 0:
+            return
+
+        # and continue after it
+        if engine.dialect.name == 'sqlite':
+            seq = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'job'").scalar()
+            if seq is None:
+                conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('job', %d)" % max_id)
+            elif seq < max_id:
+                conn.execute("UPDATE sqlite_sequence SET seq = %d WHERE name = 'job'" % max_id)
+        elif engine.dialect.name == 'mysql':
+            conn.execute('ALTER TABLE job AUTO_INCREMENT = %d' % (max_id + 1))
+
+
+def _migrate_job_states(engine: Engine):
+    """Derive state of jobs without one from their start and finish times.
+
+    Args:
+        engine: Engine for database to migrate.
+    """
+
+    session = Session(bind=engine)
+    try:
+        # finished, running, and waiting jobs
+        jobs = session.query(Job).filter(Job.state == None)
+        count = jobs.filter(Job.finished != None).update({Job.state: JobState.done}, synchronize_session=False)
+        count += jobs.filter(Job.started != None).update({Job.state: JobState.running}, synchronize_session=False)
+        count += jobs.update({Job.state: JobState.waiting}, synchronize_session=False)
+        if count > 0:
+            log.info('Set state for %d jobs.', count)
+
+        # commit changes
+        session.commit()
+
+    except:
+        session.rollback()
+        raise
+
+    finally:
+        session.close()
+
+
+def _create_missing_indexes(engine: Engine):
+    """Create indexes that have been added to existing tables.
+
+    Args:
+        engine: Engine for database to migrate.
+    """
+
+    # loop all tables
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        # get existing indexes
+        existing = set(idx['name'] for idx in inspector.get_indexes(table.name))
+
+        # create missing ones
+        for index in table.indexes:
+            if index.name not in existing:
+                log.info('Creating index %s on table %s...', index.name, table.name)
+                index.create(engine)
+
+
+def _migrate_job_nodes(engine: Engine):
+    """Move comma-separated lists of allowed nodes into the job_node table.
+
+    Up to version 0.3, Job.nodes was overwritten with the name of the executing node when a job was started, so for
+    started jobs it is copied into Job.node instead.
+
+    Args:
+        engine: Engine for database to migrate.
+    """
+
+    session = Session(bind=engine)
+    try:
+        # started jobs without a node
+        count = session.query(Job) \
+            .filter(Job.started != None, Job.node == None, Job.nodes != None) \
+            .update({Job.node: Job.nodes}, synchronize_session=False)
+        if count > 0:
+            log.info('Set executing node for %d jobs.', count)
+
+        # waiting jobs with a list of nodes, but no entries in job_node
+        jobs = session.query(Job.id, Job.nodes) \
+            .filter(Job.state == JobState.waiting, Job.nodes != None) \
+            .filter(~session.query(JobNode).filter(JobNode.job_id == Job.id).exists()) \
+            .all()
+        if len(jobs) > 0:
+            log.info('Moving allowed nodes of %d waiting jobs into job_node table...', len(jobs))
+            session.bulk_insert_mappings(JobNode, [{'job_id': job.id, 'node': node}
+                                                   for job in jobs for node in JobNode.split(job.nodes)])
+
+        # commit changes
+        session.commit()
+
+    except:
+        session.rollback()
+        raise
+
+    finally:
+        session.close()
+
+
+__all__ = ['migrate']
@@ -0,0 +1,17 @@
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime
+
+from .base import Base
+
+
+class Node(Base):
+    """A node running a PyBS daemon, which regularly reports its capacity."""
+    __tablename__ = 'node'
+
+    name = Column(String(100), comment='name of node', primary_key=True)
+    ncpus = Column(Integer, comment='number of CPUs on node', nullable=False)
+    used_cpus = Column(Integer, comment='number of used CPUs on node', nullable=False, default=0)
+    mem = Column(BigInteger, comment='memory in bytes for jobs on node, not taken into account if empty')
+    heartbeat = Column(DateTime, comment='date and time of last report from node', nullable=False)
+
+
+__all__ = ['Node']
@@ -1,3 +1,5 @@
+import asyncio
+import collections
 import smtplib
 from email.mime.text import MIMEText
 import logging
@@ -6,17 +8,28 @@ log = logging.getLogger(__name__)
 
 
 class Mailer:
-    """Sends emails to a given email address."""
+    """Sends emails to a given email address.
 
-    def __init__(self, sender: str, host: str):
+    The connection to the SMTP server is kept open between messages, until close() is called.
+    """
+
+    def __init__(self, sender: str, host: str, timeout: float = 30):
         """Creates a new Mailer.
 
         Args:
             sender: Value for FROM field in email.
-            host: SMTP host to send email through.
+            host: SMTP host to send email through, optionally with port as "host:port".
+            timeout: Timeout in seconds for connecting and talking to SMTP host.
         """
         self._sender = sender
         self._host = host
+        self._timeout = timeout
+        self._smtp = None
+
+    @property
+    def is_configured(self) -> bool:
+        """Whether sender and host are set."""
+        return self._sender is not None and self._host is not None
 
     def send(self, to: str, subject: str, body: str):
         """Send the email.
@@ -25,10 +38,13 @@ class Mailer:
             to: Email address to send to
             subject: Email subject
             body: Message body
+
+        Raises:
+            smtplib.SMTPException, OSError: If email could not be sent.
         """
 
         # no sender or host given?
-        if self._sender is None or self._host is None:
+        if not self.is_configured:
             log.error('Either sender or host not set for email.')
             return
 
@@ -38,14 +54,30 @@ class Mailer:
         msg['To'] = to
         msg['Subject'] = subject
 
-        # send email
+        # send email, reconnecting once, if server closed an existing connection in the meantime
+        reused = self._smtp is not None
         try:
-            smtp = smtplib.SMTP(self._host)
-            smtp.send_message(msg)
-            smtp.quit()
-        except:
-            # Could not send email
-            log.exception('Could not send email.')
+            self._connect().send_message(msg)
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            self.close()
+            if not reused:
+                raise
+            self._connect().send_message(msg)
+
+    def close(self):
+        """Close connection to SMTP host, if any."""
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                self._smtp.close()
+            self._smtp = None
+
+    def _connect(self) -> smtplib.SMTP:
+        """Returns the open connection to the SMTP host or opens a new one."""
+        if self._smtp is None:
+            self._smtp = smtplib.SMTP(self._host, timeout=self._timeout)
+        return self._smtp
 
 
 class Slack:
@@ -59,23 +91,188 @@ class Slack:
         """
         self._token = token
 
+    @property
+    def is_configured(self) -> bool:
+        """Whether an API token is set."""
+        return self._token is not None
+
     def send(self, to: str, body: str):
         """Send the email.
 
         Args:
             to: Slack channel
             body: Message body
+
+        Raises:
+            IOError: If message could not be sent.
         """
         import requests
 
         # no sender or host given?
-        if self._token is None:
+        if not self.is_configured:
             log.error('No API token set for Slack.')
             return
 
         # send message
-        requests.post('https://slack.com/api/chat.postMessage',
-                      data={'token': self._token, 'channel': to, 'text': body})
+        res = requests.post('https://slack.com/api/chat.postMessage',
+                            data={'token': self._token, 'channel': to, 'text': body}, timeout=30)
+        res.raise_for_status()
+        if not res.json().get('ok', False):
+            raise IOError('Slack API returned error: %s' % res.json().get('error'))
+
+
+class Notifier:
+    """Delivers notifications in the background, so that a slow mail server never blocks the daemon.
+
+    Notifications are queued and delivered by a single worker, which runs the blocking calls of Mailer and Slack in a
+    thread. After the first notification of a burst, the worker waits a little for more, and all notifications for
+    the same recipient in a burst are combined into a single digest, e.g. for all tasks of an array job. Failed
+    deliveries are retried with exponential backoff.
+    """
+
+    def __init__(self, mailer: Mailer = None, slack: Slack = None, delay: float = 10., retries: int = 5,
+                 retry_delay: float = 30., digest_bodies: int = 10):
+        """Creates a new notifier.
+
+        Args:
+            mailer: Mailer instance for sending emails.
+            slack: Slack instance for sending messages.
+            delay: Time in seconds to wait for more notifications after the first one of a burst.
+            retries: Number of retries for failed deliveries.
+            retry_delay: Delay in seconds before the first retry, doubled for each further one.
+            digest_bodies: Maximum number of full messages in a digest, for all others only subjects are listed.
+        """
+        self._mailer = mailer
+        self._slack = slack
+        self._delay = delay
+        self._retries = retries
+        self._retry_delay = retry_delay
+        self._digest_bodies = digest_bodies
+        self._queue = asyncio.Queue()
+        self._pending = 0
+        self._task = asyncio.ensure_future(self._worker())
+
+    @property
+    def pending(self) -> int:
+        """Number of notifications that are queued, being delivered, or waiting for a retry."""
+        return self._pending
+
+    def close(self):
+        """Stop delivering notifications, all queued ones are lost."""
+        self._task.cancel()
+
+    def notify(self, channel: str, to: str, subject: str, body: str):
+        """Queue a notification.
+
+        Args:
+            channel: Either "email" or "slack".
+            to: Email address or Slack channel.
+            subject: Subject of message, also used as its summary in digests.
+            body: Message body.
+        """
+        self._queue.put_nowait((channel, to, subject, body, 0))
+        self._pending += 1
+
+    async def _worker(self):
+        """Deliver queued notifications forever."""
+        loop = asyncio.get_event_loop()
+
+        while True:
+            # wait for first notification of a burst, then collect the rest
+            batch = [await self._queue.get()]
+            await asyncio.sleep(self._delay)
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            # group by recipient
+            groups = collections.OrderedDict()
+            for channel, to, subject, body, attempt in batch:
+                groups.setdefault((channel, to), []).append((subject, body, attempt))
+
+            # deliver them
+            for (channel, to), messages in groups.items():
+                try:
+                    await loop.run_in_executor(None, self._deliver, channel, to, messages)
+                    self._pending -= len(messages)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    self._retry(channel, to, messages)
+
+            # close connection, if nothing else is waiting
+            if self._queue.empty() and self._mailer is not None:
+                await loop.run_in_executor(None, self._mailer.close)
+
+    def _deliver(self, channel: str, to: str, messages: list):
+        """Deliver messages for a single recipient, combined into a digest, if there are several.
+
+        Args:
+            channel: Either "email" or "slack".
+            to: Email address or Slack channel.
+            messages: List of tuples with subject, body, and number of failed attempts.
+        """
+
+        # combine messages
+        subject, body = messages[0][:2] if len(messages) == 1 else self.digest(messages, self._digest_bodies)
+
+        # send it
+        if channel == 'email':
+            if self._mailer is None:
+                log.error('No mailer configured for sending emails.')
+                return
+            log.info('Sending email to %s...', to)
+            self._mailer.send(to=to, subject=subject, body=body)
+        elif channel == 'slack':
+            if self._slack is None:
+                log.error('No Slack configured for sending messages.')
+                return
+            log.info('Sending Slack message to #%s...', to)
+            self._slack.send(to=to, body=body)
+        else:
+            log.error('Unknown notification channel %s.', channel)
+
+    def _retry(self, channel: str, to: str, messages: list):
+        """Queue failed messages again after a delay or give up on them.
+
+        Args:
+            channel: Either "email" or "slack".
+            to: Email address or Slack channel.
+            messages: List of tuples with subject, body, and number of failed attempts.
+        """
+
+        # given up?
+        attempt = max(m[2] for m in messages) + 1
+        if attempt > self._retries:
+            log.exception('Could not deliver %d notifications to %s, giving up.', len(messages), to)
+            self._pending -= len(messages)
+            return
+
+        # try again later
+        delay = self._retry_delay * 2 ** (attempt - 1)
+        log.warning('Could not deliver %d notifications to %s, retrying in %gs...', len(messages), to, delay,
+                    exc_info=True)
+        loop = asyncio.get_event_loop()
+        for subject, body, _ in messages:
+            loop.call_later(delay, self._queue.put_nowait, (channel, to, subject, body, attempt))
+
+    @staticmethod
+    def digest(messages: list, max_bodies: int = 10) -> (str, str):
+        """Combine several messages into a single one.
+
+        Args:
+            messages: List of tuples starting with subject and body.
+            max_bodies: Maximum number of full messages, for all others only subjects are listed.
+
+        Returns:
+            Tuple of subject and body of digest.
+        """
+        subject = 'PyBS: %d job notifications' % len(messages)
+        lines = [m[0] for m in messages]
+        for m in messages[:max_bodies]:
+            lines.extend(['', '-' * 70, m[0], '', m[1]])
+        if len(messages) > max_bodies:
+            lines.extend(['', '-' * 70, '%d more messages not shown.' % (len(messages) - max_bodies)])
+        return subject, '\n'.join(lines)
 
 
-__all__ = ['Mailer', 'Slack']
+__all__ = ['Mailer', 'Slack', 'Notifier']
@@ -0,0 +1,329 @@
+import asyncio
+import bisect
+import math
+import threading
+import time
+
+
+# default buckets for durations in seconds
+DURATION_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.)
+
+# buckets for the time jobs wait in the queue, from a second to a week
+WAIT_BUCKETS = (1., 5., 15., 60., 300., 900., 3600., 4 * 3600., 12 * 3600., 86400., 7 * 86400.)
+
+
+def _format_value(value: float) -> str:
+    """Format a sample value for the text exposition format."""
+    if value == math.inf:
+        return '+Inf'
+    if value != value:
+        return 'NaN'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = None) -> str:
+    """Format labels for the text exposition format.
+
+    Args:
+        names: Names of labels.
+        values: Values of labels.
+        extra: Additional, already formatted label, like 'le="0.5"'.
+
+    Returns:
+        Labels in curly braces or empty string, if there are none.
+    """
+    labels = ['%s="%s"' % (name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+              for name, value in zip(names, values)]
+    if extra is not None:
+        labels.append(extra)
+    return '{%s}' % ','.join(labels) if labels else ''
+
+
+class Metric:
+    """Base class for all metrics, which are stored separately for every combination of label values.
+
+    Metrics may be updated from worker threads, so all changes are protected by a lock.
+    """
+
+    type = None
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        """Creates a new metric.
+
+        Args:
+            name: Name of metric.
+            documentation: Help text for metric.
+            labels: Names of labels.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        """Get values of all labels in the right order."""
+        if set(labels) != set(self.labels):
+            raise ValueError('Metric %s needs labels %s.' % (self.name, ', '.join(self.labels)))
+        return tuple(labels[name] for name in self.labels)
+
+    def samples(self) -> list:
+        """Returns all samples as tuples of suffix, formatted labels, and value."""
+        with self._lock:
+            values = sorted(self._values.items())
+        return [('', _format_labels(self.labels, key), value) for key, value in values]
+
+    def render(self) -> list:
+        """Returns lines in the text exposition format."""
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.type)]
+        lines.extend('%s%s%s %s' % (self.name, suffix, labels, _format_value(value))
+                     for suffix, labels, value in self.samples())
+        return lines
+
+
+class Counter(Metric):
+    """A value that only ever increases, like the number of handled requests."""
+
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        """Increase counter.
+
+        Args:
+            amount: Amount to add.
+            **labels: Values for all labels.
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that can go up and down, like the number of waiting jobs.
+
+    Instead of being set, a gauge can also read its value from a function at every scrape, which must be cheap.
+    """
+
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        Metric.__init__(self, name, documentation, labels)
+        self._function = None
+
+    def set(self, value: float, **labels):
+        """Set gauge to a new value.
+
+        Args:
+            value: New value.
+            **labels: Values for all labels.
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels):
+        """Change gauge by the given amount.
+
+        Args:
+            amount: Amount to add, may be negative.
+            **labels: Values for all labels.
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set_function(self, function):
+        """Read value from a function at every scrape, only for gauges without labels.
+
+        Args:
+            function: Function returning the current value.
+        """
+        self._function = function
+
+    def samples(self) -> list:
+        if self._function is not None:
+            return [('', '', self._function())]
+        return Metric.samples(self)
+
+
+class Histogram(Metric):
+    """Counts observed values, like durations, in buckets."""
+
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DURATION_BUCKETS):
+        """Creates a new histogram.
+
+        Args:
+            name: Name of metric.
+            documentation: Help text for metric.
+            labels: Names of labels.
+            buckets: Upper bounds of buckets in ascending order, a bucket for infinity is added automatically.
+        """
+        Metric.__init__(self, name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels):
+        """Add a value to the histogram.
+
+        Args:
+            value: Observed value.
+            **labels: Values for all labels.
+        """
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.))
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def time(self, **labels) -> 'Timer':
+        """Returns a context manager that observes the time spent in it.
+
+        Args:
+            **labels: Values for all labels.
+        """
+        return Timer(self, labels)
+
+    def samples(self) -> list:
+        with self._lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        samples = []
+        for key, (counts, total) in values:
+            # buckets are cumulative
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append(('_bucket', _format_labels(self.labels, key, 'le="%s"' % _format_value(bound)),
+                                cumulative))
+            samples.append(('_sum', _format_labels(self.labels, key), total))
+            samples.append(('_count', _format_labels(self.labels, key), cumulative))
+        return samples
+
+
+class Timer:
+    """Context manager that observes the time spent in it in a histogram."""
+
+    def __init__(self, histogram: Histogram, labels: dict):
+        self._histogram = histogram
+        self._labels = labels
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self._histogram.observe(time.perf_counter() - self._start, **self._labels)
+
+
+class Metrics:
+    """All metrics of PyBS, which are updated by the daemon, the RPC server, and the database as they go.
+
+    Nothing is queried, when the metrics are scraped. Only the number of waiting and running jobs in the whole
+    cluster is refreshed from the database with every heartbeat of the daemon, since other nodes change it, too.
+    """
+
+    def __init__(self):
+        """Creates all metrics."""
+        # jobs
+        self.jobs = Gauge('pybs_jobs', 'Number of waiting and running jobs in the cluster.', ('state',))
+        self.jobs_finished = Counter('pybs_jobs_finished_total', 'Number of jobs finished on or cancelled via this '
+                                     'node.', ('state',))
+        self.submit_to_start = Histogram('pybs_job_wait_seconds', 'Time from submission to start of jobs on this '
+                                         'node.', buckets=WAIT_BUCKETS)
+
+        # resources
+        self.cpus = Gauge('pybs_cpus', 'Number of CPUs for jobs on this node.')
+        self.used_cpus = Gauge('pybs_cpus_used', 'Number of CPUs reserved for running jobs on this node.')
+        self.mem = Gauge('pybs_memory_bytes', 'Memory for jobs on this node.')
+        self.used_mem = Gauge('pybs_memory_used_bytes', 'Memory requested by running jobs on this node.')
+
+        # scheduler
+        self.scheduling_pass = Histogram('pybs_scheduling_pass_seconds', 'Duration of scheduling passes.')
+        self.started_jobs = Counter('pybs_jobs_started_total', 'Number of jobs started by scheduling passes.')
+
+        # RPC
+        self.rpc_requests = Counter('pybs_rpc_requests_total', 'Number of handled RPC requests.',
+                                    ('method', 'status'))
+        self.rpc_latency = Histogram('pybs_rpc_request_seconds', 'Duration of RPC requests.', ('method',))
+
+        # database
+        self.db_latency = Histogram('pybs_db_operation_seconds', 'Duration of database operations in the worker '
+                                    'thread, including commit.', ('operation',))
+
+        # notifications
+        self.notifications = Gauge('pybs_notifications_pending', 'Number of notifications waiting for delivery.')
+
+    def __iter__(self):
+        """Iterate over all metrics."""
+        return iter([m for m in vars(self).values() if isinstance(m, Metric)])
+
+    def render(self) -> str:
+        """Returns all metrics in the text exposition format of Prometheus."""
+        return '\n'.join(line for metric in self for line in metric.render()) + '\n'
+
+
+class MetricsServer:
+    """Serves metrics over HTTP for Prometheus and similar tools."""
+
+    def __init__(self, metrics: Metrics, port: int, host: str = '127.0.0.1'):
+        """Creates a new metrics server.
+
+        Args:
+            metrics: Metrics to serve.
+            port: Port to listen on.
+            host: Address to listen on, only local by default.
+        """
+        self._metrics = metrics
+        self._port = port
+        self._host = host
+        self._server = None
+
+    async def open(self):
+        """Open server."""
+        self._server = await asyncio.start_server(self.handle_request, self._host, self._port)
+
+    def close(self):
+        """Close server."""
+        self._server.close()
+
+    async def wait_closed(self):
+        """Wait for server to be closed."""
+        await self._server.wait_closed()
+
+    async def handle_request(self, reader, writer):
+        """Answer a single HTTP request and close the connection.
+
+        Args:
+            reader: Stream to read from.
+            writer: Stream to write to.
+        """
+        try:
+            # read request line and skip headers
+            request = (await reader.readline()).decode('latin-1').split()
+            while (await reader.readline()).strip():
+                pass
+
+            # only metrics are served
+            if len(request) >= 2 and request[0] in ('GET', 'HEAD') and request[1].split('?')[0] in ('/', '/metrics'):
+                status, body = '200 OK', self._metrics.render().encode()
+            else:
+                status, body = '404 Not Found', b'Not found\n'
+
+            # send response
+            writer.write(('HTTP/1.0 %s\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                          'Content-Length: %d\r\nConnection: close\r\n\r\n' % (status, len(body))).encode())
+            if request and request[0] != 'HEAD':
+                writer.write(body)
+            await writer.drain()
+
+        except ConnectionError:
+            # client went away
+            pass
+
+        finally:
+            writer.close()
+
+
+__all__ = ['Metrics', 'MetricsServer', 'Counter', 'Gauge', 'Histogram']
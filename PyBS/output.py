@@ -0,0 +1,67 @@
+import os
+
+
+def tail_file(filename: str, lines: int = 10, block_size: int = 4096) -> list:
+    """Returns the last lines of a file without reading all of it.
+
+    Args:
+        filename: Name of file to read.
+        lines: Number of lines to return.
+        block_size: Number of bytes to read at once, going backwards from the end of the file.
+
+    Returns:
+        List of lines.
+    """
+
+    with open(filename, 'rb') as f:
+        # start at end of file
+        pos = f.seek(0, os.SEEK_END)
+        data = b''
+
+        # read blocks backwards until we got enough lines, ignoring a trailing line break
+        while pos > 0 and data.count(b'\n', 0, len(data) - 1) < lines:
+            size = min(block_size, pos)
+            pos -= size
+            f.seek(pos)
+            data = f.read(size) + data
+
+    # split and return last lines
+    data = data[:-1] if data.endswith(b'\n') else data
+    return [line.decode('utf-8', 'replace') for line in data.split(b'\n')[-lines:]] if data else []
+
+
+def trim_file(filename: str, max_size: int) -> bool:
+    """Cut a file that grew larger than the given size down to its last half, starting at a line break if possible.
+
+    The file is rewritten in place, so a process writing to it must have opened it for appending, otherwise it would
+    continue writing at its old position. Data written while the file is trimmed may get lost.
+
+    Args:
+        filename: Name of file to trim.
+        max_size: Maximum size in bytes.
+
+    Returns:
+        Whether the file has been trimmed.
+    """
+
+    with open(filename, 'r+b') as f:
+        # small enough?
+        size = f.seek(0, os.SEEK_END)
+        if size <= max_size:
+            return False
+
+        # read last half, dropping the first incomplete line
+        f.seek(size - max_size // 2)
+        data = f.read()
+        pos = data.find(b'\n')
+        if 0 <= pos < len(data) - 1:
+            data = data[pos + 1:]
+
+        # and write it to start of file
+        f.seek(0)
+        f.write(data)
+        f.truncate()
+        return True
+
+
+__all__ = ['tail_file', 'trim_file']
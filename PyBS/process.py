@@ -0,0 +1,254 @@
+import asyncio
+import logging
+import os
+import resource
+import signal
+import time
+
+log = logging.getLogger(__name__)
+
+
+def process_start_time(pid: int) -> int:
+    """Returns the start time of a process, which together with its PID identifies it uniquely.
+
+    Args:
+        pid: ID of process.
+
+    Returns:
+        Start time of process in clock ticks after boot, or None, if it does not exist (anymore) or is a zombie.
+    """
+    try:
+        with open('/proc/%d/stat' % pid, 'r') as f:
+            stat = f.read()
+    except (FileNotFoundError, ProcessLookupError):
+        return None
+
+    # name of executable is in parentheses and may contain spaces, so split after it
+    fields = stat[stat.rindex(')') + 2:].split()
+
+    # state is 3rd field and start time is 22nd field in /proc/<pid>/stat
+    return None if fields[0] in 'ZX' else int(fields[19])
+
+
+class AdoptedProcess:
+    """A process of a job that has been started by an earlier instance of the daemon.
+
+    Since it is no child of this process, it cannot be waited for directly, so it is polled until it is gone and its
+    exit code remains unknown.
+    """
+
+    def __init__(self, pid: int, start_time: int = None, poll_interval: float = 5.):
+        """Creates a new adopted process.
+
+        Args:
+            pid: ID of process.
+            start_time: Start time of process as returned by process_start_time(). If None, only the PID is checked.
+            poll_interval: Interval in seconds for checking, whether process is still alive.
+        """
+        self.pid = pid
+        self.returncode = None
+        self._start_time = start_time
+        self._poll_interval = poll_interval
+        self._group_leader = None
+
+    def is_alive(self) -> bool:
+        """Whether the process is still running and has not been replaced by another one with the same PID."""
+
+        # without start time, we can only check for the PID
+        if self._start_time is None:
+            try:
+                os.kill(self.pid, 0)
+                return True
+            except ProcessLookupError:
+                return False
+            except PermissionError:
+                # process exists, but belongs to someone else
+                return True
+
+        # otherwise compare start times
+        return process_start_time(self.pid) == self._start_time
+
+    def is_group_leader(self) -> bool:
+        """Whether the process leads its own process group, i.e. has been started in a new session.
+
+        Since this cannot be determined anymore after the process is gone, the first answer is kept.
+        """
+        if self._group_leader is None:
+            try:
+                self._group_leader = os.getpgid(self.pid) == self.pid and self.is_alive()
+            except ProcessLookupError:
+                self._group_leader = False
+        return self._group_leader
+
+    def terminate(self):
+        """Ask the process to terminate."""
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        """Kill the process."""
+        self.send_signal(signal.SIGKILL)
+
+    def send_signal(self, sig: int):
+        """Send a signal to the process, if it is still alive.
+
+        Args:
+            sig: Signal to send.
+        """
+        if self.is_alive():
+            try:
+                os.kill(self.pid, sig)
+            except ProcessLookupError:
+                pass
+
+    async def wait(self):
+        """Wait for the process to finish."""
+        while self.is_alive():
+            await asyncio.sleep(self._poll_interval)
+
+
+async def terminate(proc, grace: float, group: bool = False):
+    """Terminate a process and kill it, if it is still alive after a grace period.
+
+    Args:
+        proc: Process to terminate, either an asyncio process or an AdoptedProcess.
+        grace: Time in seconds the process gets for shutting down after SIGTERM.
+        group: If True, signal the whole process group of the process, which must have been started in a new session,
+            and wait for all of its processes.
+    """
+
+    def send(sig):
+        try:
+            if group:
+                os.killpg(proc.pid, sig)
+            else:
+                proc.send_signal(sig)
+        except ProcessLookupError:
+            # gone already
+            pass
+
+    def alive():
+        if group:
+            return group_alive(proc.pid)
+        return proc.is_alive() if isinstance(proc, AdoptedProcess) else proc.returncode is None
+
+    # ask nicely and wait for process, or all processes in its group
+    send(signal.SIGTERM)
+    deadline = time.monotonic() + grace
+    while alive() and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+
+    # still alive?
+    if alive():
+        log.warning('Process %d did not terminate within %.0fs, killing it...', proc.pid, grace)
+        send(signal.SIGKILL)
+
+
+def group_alive(pgid: int) -> bool:
+    """Whether any process in the given process group is still alive.
+
+    Args:
+        pgid: ID of process group.
+
+    Returns:
+        Whether process group still exists.
+    """
+    try:
+        os.killpg(pgid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # processes exist, but belong to someone else
+        return True
+
+
+class Cgroup:
+    """A control group (v2) for limiting the resources of a single job.
+
+    The cgroups are created below a root directory, which must have been delegated to the daemon, e.g. by systemd
+    with Delegate=yes, and which must have the memory controller enabled for its children.
+    """
+
+    def __init__(self, root: str, name: str):
+        """Creates a new cgroup object, without creating the cgroup itself.
+
+        Args:
+            root: Directory of parent cgroup.
+            name: Name of cgroup.
+        """
+        self.path = os.path.join(root, name)
+
+    def create(self, mem: int = None):
+        """Create cgroup and set its limits.
+
+        Args:
+            mem: Maximum memory in bytes, including swap. If None, no limit.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        if mem is not None:
+            self._write('memory.max', str(mem))
+            if os.path.exists(os.path.join(self.path, 'memory.swap.max')):
+                self._write('memory.swap.max', '0')
+
+    def attach(self):
+        """Move the calling process into the cgroup, used right before executing a job."""
+        self._write('cgroup.procs', str(os.getpid()))
+
+    def oom_killed(self) -> int:
+        """Returns the number of processes in the cgroup that have been killed for exceeding the memory limit."""
+        try:
+            with open(os.path.join(self.path, 'memory.events'), 'r') as f:
+                events = dict(line.split() for line in f if line.strip())
+            return int(events.get('oom_kill', 0))
+        except OSError:
+            return 0
+
+    def remove(self):
+        """Remove the cgroup, which only works after all its processes are gone."""
+        try:
+            os.rmdir(self.path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            log.warning('Could not remove cgroup %s: %s', self.path, e)
+
+    def _write(self, filename: str, value: str):
+        """Write a value to a control file of the cgroup, without any buffering."""
+        fd = os.open(os.path.join(self.path, filename), os.O_WRONLY)
+        try:
+            os.write(fd, value.encode())
+        finally:
+            os.close(fd)
+
+
+def limit_resources(mem: int = None, cgroup: Cgroup = None, cores: list = None):
+    """Returns a function for applying resource limits to a new process before it executes the job script.
+
+    Only plain system calls without any locks happen in there, so that it can safely be used as preexec_fn, although
+    the daemon runs database queries in other threads.
+
+    Args:
+        mem: Maximum address space in bytes for each process of the job, only used without cgroup. If None, no limit.
+        cgroup: Cgroup to move the process into, which limits the memory of the whole job.
+        cores: CPU cores to pin the process to. If None, it may run on all cores.
+
+    Returns:
+        Function to call in new process, or None, if there is nothing to do.
+    """
+
+    # nothing to do?
+    if mem is None and cgroup is None and cores is None:
+        return None
+
+    def preexec():
+        if cores is not None:
+            os.sched_setaffinity(0, cores)
+        if cgroup is not None:
+            cgroup.attach()
+        elif mem is not None:
+            resource.setrlimit(resource.RLIMIT_AS, (mem, mem))
+
+    return preexec
+
+
+__all__ = ['process_start_time', 'AdoptedProcess', 'terminate', 'group_alive', 'Cgroup', 'limit_resources']
@@ -0,0 +1,174 @@
+import asyncio
+import contextlib
+import cProfile
+import io
+import logging
+import pstats
+import threading
+import time
+from sqlalchemy import event
+
+log = logging.getLogger(__name__)
+
+
+class Span:
+    """Context manager that measures the time spent in it and reports it to the tracer."""
+
+    __slots__ = ('_tracer', '_name', '_start')
+
+    def __init__(self, tracer: 'Tracer', name: str):
+        self._tracer = tracer
+        self._name = name
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self._tracer.record('spans', self._name, time.perf_counter() - self._start)
+
+
+class Tracer:
+    """Opt-in timing of hot paths of the daemon, with a log for slow operations.
+
+    Code paths wrap themselves in span(), which costs next to nothing as long as tracing is disabled. Database queries
+    are timed via SQLAlchemy events and attributed to the operation that was passed to Database.run(), like
+    "PyBSdaemon.status.query". If tracing is enabled permanently, slow spans and queries are logged. While profile()
+    runs, the number of calls and the total and maximum duration are aggregated for all of them, too.
+
+    Spans and queries can be recorded from worker threads, so aggregates are protected by a lock.
+    """
+
+    def __init__(self, enabled: bool = False, slow_threshold: float = 1.):
+        """Creates a new tracer.
+
+        Args:
+            enabled: If True, trace all the time, otherwise only while profiling.
+            slow_threshold: Operations taking longer than this many seconds are logged, while tracing.
+        """
+        self.enabled = enabled
+        self.slow_threshold = slow_threshold
+        self._windows = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._null = contextlib.nullcontext()
+
+    def span(self, name: str):
+        """Returns a context manager that records the time spent in it.
+
+        Args:
+            name: Name of span, usually the name of the function.
+        """
+        return Span(self, name) if self.enabled or self._windows else self._null
+
+    @contextlib.contextmanager
+    def operation(self, name: str):
+        """Attribute all queries in the current thread to the given operation.
+
+        Args:
+            name: Name of operation.
+        """
+        previous = getattr(self._local, 'operation', None)
+        self._local.operation = name
+        try:
+            with self.span(name):
+                yield
+        finally:
+            self._local.operation = previous
+
+    def record(self, kind: str, name: str, duration: float, detail: str = None):
+        """Add a duration to the aggregates of running profiles and log it, if it was slow.
+
+        Args:
+            kind: Either "spans" or "queries".
+            name: Name of span or operation.
+            duration: Duration in seconds.
+            detail: Further information for the log, like the SQL statement.
+        """
+        with self._lock:
+            for window in self._windows:
+                stats = window[kind]
+                entry = stats.get(name)
+                if entry is None:
+                    stats[name] = [1, duration, duration]
+                else:
+                    entry[0] += 1
+                    entry[1] += duration
+                    entry[2] = max(entry[2], duration)
+
+        # slow?
+        if self.slow_threshold is not None and duration > self.slow_threshold:
+            if detail is None:
+                log.warning('Slow operation %s took %.3fs.', name, duration)
+            else:
+                log.warning('Slow query in %s took %.3fs: %s', name, duration, detail)
+
+    def instrument(self, engine: 'Engine'):
+        """Time all queries of an engine.
+
+        Args:
+            engine: Engine to instrument.
+        """
+        event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self.enabled or self._windows:
+            conn.info.setdefault('pybs_query_start', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get('pybs_query_start')
+        if starts:
+            self.record('queries', getattr(self._local, 'operation', None) or 'unknown',
+                        time.perf_counter() - starts.pop(), ' '.join(statement.split())[:200])
+
+    async def profile(self, seconds: float, limit: int = 30, sort: str = 'cumulative') -> dict:
+        """Profile the event loop thread with cProfile and trace all spans and queries for a while.
+
+        Only the thread running the event loop is profiled, database operations in worker threads show up as
+        queries instead.
+
+        Args:
+            seconds: Duration of profile in seconds.
+            limit: Maximum number of functions to return.
+            sort: Sort functions by "cumulative" or "tottime".
+
+        Returns:
+            Dictionary with the top functions and all spans and queries recorded in the meantime.
+        """
+        # check parameters
+        if sort not in ('cumulative', 'tottime'):
+            raise ValueError('Cannot sort by %s.' % sort)
+        if self._windows:
+            raise ValueError('Profiling is running already.')
+
+        # start profiler and trace spans
+        window = {'spans': {}, 'queries': {}, 'profiler': cProfile.Profile()}
+        with self._lock:
+            self._windows.append(window)
+        window['profiler'].enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            window['profiler'].disable()
+            with self._lock:
+                self._windows.remove(window)
+
+        # aggregate functions
+        stats = pstats.Stats(window['profiler'], stream=io.StringIO()).sort_stats(sort)
+        functions = []
+        for func in stats.fcn_list[:limit]:
+            calls, ncalls, tottime, cumtime, _ = stats.stats[func]
+            functions.append({'function': '%s:%d(%s)' % func, 'ncalls': ncalls, 'primitive_calls': calls,
+                              'tottime': tottime, 'cumtime': cumtime})
+
+        # return it together with spans and queries, slowest in total first
+        result = {kind: [{'name': name, 'count': count, 'total': total, 'max': maximum}
+                         for name, (count, total, maximum) in sorted(window[kind].items(), key=lambda s: -s[1][1])]
+                  for kind in ('spans', 'queries')}
+        result.update({'seconds': seconds, 'functions': functions})
+        return result
+
+
+__all__ = ['Tracer']
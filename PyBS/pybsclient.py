@@ -12,6 +12,17 @@ class PyBSclient:
         """Creates a new client."""
         self._rpc_client = RpcClient()
 
+    def pipeline(self, calls: list) -> list:
+        """Call several methods on the daemon at once.
+
+        Args:
+            calls: List of tuples with name of method and dictionary of parameters.
+
+        Returns:
+            List of results of methods.
+        """
+        return self._rpc_client.pipeline(calls)
+
     def list_waiting(self):
         """Get a list of waiting jobs.
 
@@ -47,11 +58,79 @@ class PyBSclient:
         """
         return self._rpc_client('list_finished', limit=limit)
 
-    def submit(self, filename: str) -> dict:
+    def list_jobs(self, user: str = None, state=None, name: str = None, node: str = None, columns: list = None,
+                  order: str = 'id', after: list = None, limit: int = 100, count: bool = False) -> dict:
+        """Get a page of the jobs matching the given filters, with only the requested columns.
+
+        Args:
+            user: Only jobs of this user.
+            state: Only jobs in this state or in one of the states in this list.
+            name: Only jobs whose name matches this pattern, in which * and ? are wildcards.
+            node: Only jobs running or run on this node.
+            columns: Columns to return. If None, all are returned.
+            order: Order of jobs, either "id", "queue", "started", or "finished".
+            after: Cursor returned with the previous page.
+            limit: Maximum number of jobs in page.
+            count: If True, only count the matching jobs.
+
+        Returns:
+            Dictionary with list of jobs and the cursor for the next page, which is None for the last page. If count
+            is set, the total number of matching jobs and the number of them in each state instead.
+        """
+        return self._rpc_client('list_jobs', user=user, state=state, name=name, node=node, columns=columns,
+                                order=order, after=after, limit=limit, count=count)
+
+    def iter_jobs(self, page_size: int = 1000, **kwargs):
+        """Iterate over all jobs matching the given filters, fetching them page by page.
+
+        Args:
+            page_size: Number of jobs to fetch at once.
+            **kwargs: Filters, columns, and order as for list_jobs().
+
+        Yields:
+            Dictionaries with job infos.
+        """
+        after = None
+        while True:
+            page = self.list_jobs(after=after, limit=page_size, **kwargs)
+            yield from page['jobs']
+            after = page['next']
+            if after is None:
+                break
+
+    def status(self, finished: int = 5, limit: int = None) -> dict:
+        """Get running, waiting and recently finished jobs plus CPU usage in a single call.
+
+        Args:
+            finished: Maximum number of finished jobs to return.
+            limit: Maximum number of running and of waiting jobs to return. If None, all are returned.
+
+        Returns:
+            Dictionary with lists of running, waiting, and finished jobs, the total number of running and waiting
+            jobs, the number of used and total CPUs on this node, and the capacity of all nodes that reported
+            recently.
+        """
+        return self._rpc_client('status', finished=finished, limit=limit)
+
+    def accounting(self, user: str = None, since: float = None, group_by: str = 'username') -> list:
+        """Get the resources consumed by finished jobs, aggregated per user.
+
+        Args:
+            user: Only include jobs of this user.
+            since: Only include jobs that finished after this UNIX timestamp.
+            group_by: Either "username" or "name" for aggregating per user or per job name.
+
+        Returns:
+            List of dictionaries with number of jobs and failed jobs, total CPU times, peak RSS, and I/O bytes.
+        """
+        return self._rpc_client('accounting', user=user, since=since, group_by=group_by)
+
+    def submit(self, filename: str, depend: str = None) -> dict:
         """Submit a new script to the queue.
 
         Args:
             filename: Name of file to submit.
+            depend: Dependencies like "afterok:123", overriding those in the PBS header.
 
         Returns:
             Dictionary with new job ID.
@@ -64,10 +143,31 @@ class PyBSclient:
         if stat.S_IXGRP & os.stat(filename)[stat.ST_MODE] and stat.S_IXUSR & os.stat(filename)[stat.ST_MODE]:
             # submit job
             return self._rpc_client('submit', filename=os.path.abspath(filename),
-                                    user=pwd.getpwuid(os.getuid()).pw_name)
+                                    user=pwd.getpwuid(os.getuid()).pw_name, depend=depend)
         else:
             raise OSError('File %s not executable.' % os.path.abspath(filename))
 
+    def submit_many(self, filenames: list, depend: str = None) -> dict:
+        """Submit several scripts to the queue at once.
+
+        Args:
+            filenames: Names of files to submit.
+            depend: Dependencies like "afterok:123" for all jobs, overriding those in the PBS headers.
+
+        Returns:
+            Dictionary with IDs of new jobs.
+        """
+
+        # check that files are executable
+        for filename in filenames:
+            mode = os.stat(filename)[stat.ST_MODE]
+            if not (stat.S_IXGRP & mode and stat.S_IXUSR & mode):
+                raise OSError('File %s not executable.' % os.path.abspath(filename))
+
+        # submit jobs
+        return self._rpc_client('submit_many', filenames=[os.path.abspath(f) for f in filenames],
+                                user=pwd.getpwuid(os.getuid()).pw_name, depend=depend)
+
     def remove(self, job_id: int) -> dict:
         """Remove an existing job.
 
@@ -89,6 +189,22 @@ class PyBSclient:
         """
         return self._rpc_client('run', job_id=job_id)
 
+    def tail(self, job_id: int, lines: int = 10, follow: bool = False, stream: str = 'output'):
+        """Get the last lines of output of a job and optionally follow new output.
+
+        Args:
+            job_id: ID of job.
+            lines: Number of lines to return.
+            follow: If True, follow new output of a running job.
+            stream: Either "output" or "error".
+
+        Returns:
+            List of lines or, if following, a generator yielding all new output as it is written.
+        """
+        if follow:
+            return self._rpc_client.stream('tail', job_id=job_id, lines=lines, follow=True, stream=stream)
+        return self._rpc_client('tail', job_id=job_id, lines=lines, stream=stream)
+
     def get_cpus(self) -> (int, int):
         """Returns the currently occupied and the total number of CPUs on this host.
 
@@ -97,6 +213,28 @@ class PyBSclient:
         """
         return self._rpc_client('get_cpus')
 
+    def get_mem(self) -> (int, int):
+        """Returns the currently requested and the total memory for jobs on this host.
+
+        Returns:
+            Tuple of currently requested and total memory in bytes, the latter None if memory is not tracked.
+        """
+        return self._rpc_client('get_mem')
+
+    def profile(self, seconds: float = 10., limit: int = 30, sort: str = 'cumulative') -> dict:
+        """Profile the daemon for a while.
+
+        Args:
+            seconds: Duration of profile in seconds.
+            limit: Maximum number of functions to return.
+            sort: Sort functions by "cumulative" or "tottime".
+
+        Returns:
+            Dictionary with the top functions, and the number of calls and the total and maximum duration of all spans
+            and of all database queries per operation.
+        """
+        return self._rpc_client('profile', seconds=seconds, limit=limit, sort=sort)
+
     def config(self) -> dict:
         """Returns current configuration.
 
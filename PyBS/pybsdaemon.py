@@ -1,14 +1,25 @@
 import asyncio
+import codecs
 import datetime
+import json
 import logging
 import os
 import socket
 import subprocess
+import sys
+import time
 
-from sqlalchemy import or_, func
+from sqlalchemy import DateTime, and_, case, func, or_
 from sqlalchemy.orm import Query
 
-from .db import Job
+from .db import Job, JobArray, JobNode, JobDependency, JobHistory, JobState, FINISHED_STATES, Node
+from .mailer import Notifier
+from .metrics import Metrics
+from .profiling import Tracer
+from .output import tail_file, trim_file
+from .process import AdoptedProcess, Cgroup, group_alive, limit_resources, process_start_time, terminate
+from .scheduler import Scheduler
+from .topology import Topology, format_cpulist, parse_cpulist
 
 log = logging.getLogger(__name__)
 
@@ -29,12 +40,41 @@ Last 10 lines of standard output (if any):
 Last 10 lines of error output (if any):
 {8}"""
 
+# script that runs jobs and reports their exit code and resource usage
+WRAPPER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wrapper.py')
+
+# resource usage reported by the wrapper, stored in columns of the same name
+USAGE_COLUMNS = ('cpu_user', 'cpu_system', 'max_rss', 'io_read', 'io_write')
+
+# columns of jobs that can be listed
+LIST_COLUMNS = ('id', 'name', 'username', 'ncpus', 'mem', 'walltime', 'priority', 'nodes', 'node', 'cores', 'filename',
+                'submitted', 'started', 'finished', 'state', 'exit_code', 'array_id', 'array_index')
+
+# orders for listing jobs as tuples of column and whether it is descending, the unique ID always comes last
+LIST_ORDERS = {
+    'id': (('id', False),),
+    'queue': (('priority', True), ('submitted', False), ('id', False)),
+    'started': (('started', False), ('id', False)),
+    'finished': (('finished', True), ('id', True))
+}
+
+# maximum number of jobs in a single page of a listing
+MAX_LIST_LIMIT = 10000
+
+# interval in seconds for checking the size of spool files
+SPOOL_CHECK_INTERVAL = 5
+
 
 class PyBSdaemon:
     """The PyBS daemon that runs all jobs"""
 
     def __init__(self, database: 'Database', nodename: str = None, ncpus: int = 4, root_dir: str = '/',
-                 mailer: 'Mailer' = None, slack: 'Slack' = None):
+                 mailer: 'Mailer' = None, slack: 'Slack' = None, poll_interval: float = 30, backfill: bool = True,
+                 reconcile_interval: float = 300, archive_age: float = None, archive_batch: int = 1000,
+                 heartbeat_interval: float = 30, scheduler: Scheduler = None, mem: int = None,
+                 cgroup_root: str = None, kill_grace: float = 30, cpu_affinity: bool = False,
+                 notification_delay: float = 10, metrics: Metrics = None, tracer: Tracer = None,
+                 state_dir: str = None, spool_size: int = 10 * 1024 ** 2):
         """Creates a new PyBS daemon.
 
         Args:
@@ -44,27 +84,101 @@ class PyBSdaemon:
             root_dir: Root directory for all jobs.
             mailer: Mailer instance for sending emails.
             slack: Slack instance for sending messages.
+            poll_interval: Interval in seconds for polling the database for jobs submitted on other nodes.
+            backfill: If True, start smaller jobs when the next job in line does not fit.
+            reconcile_interval: Interval in seconds for reconciling used CPUs with the database.
+            archive_age: Age in days after which finished jobs are moved to the history. If None, never.
+            archive_batch: Maximum number of jobs to move to the history in one transaction.
+            heartbeat_interval: Interval in seconds for reporting the capacity of this node to the database.
+            scheduler: Scheduling policy. If None, jobs are started strictly by priority and submission time.
+            mem: Memory in bytes available for jobs on node. If None, memory requests are not taken into account.
+            cgroup_root: Directory of a delegated cgroup (v2), below which a cgroup is created for every job with a
+                memory request. If None, memory is limited for every process of a job separately.
+            kill_grace: Time in seconds a job gets for shutting down after SIGTERM, before it is killed.
+            cpu_affinity: If True, pin every job to its own set of CPU cores, taking NUMA nodes into account.
+            notification_delay: Time in seconds to collect notifications for combining them into a single digest.
+            metrics: Metrics to update, e.g. shared with the RPC server and the database. If None, a new one is created.
+            tracer: Tracer for timing hot paths. If None, they are only timed while profiling.
+            state_dir: Directory for the output of jobs without output files in their header, and for the exit code and
+                resource usage of finished jobs, which must survive a restart of the daemon. If None, ~/.pybs is used.
+            spool_size: Maximum size in bytes of a spool file in the state directory, larger ones are cut down to the
+                last half of it.
         """
         self._task = None
         self._ncpus = ncpus
+        self._mem = mem
+        self._cgroup_root = cgroup_root
+        self._kill_grace = kill_grace
+        self._topology = Topology() if cpu_affinity else None
         self._root_dir = root_dir
+        self._state_dir = os.path.expanduser('~/.pybs') if state_dir is None else state_dir
+        self._spool_size = spool_size
         self._db = database
-        self._mailer = mailer
-        self._slack = slack
+        self._notifier = Notifier(mailer, slack, delay=notification_delay)
         self._hostname = socket.gethostname() if nodename is None else nodename
         self._processes = {}
-        self._used_cpus = 0
-
-        # start periodic task
+        self._terminating = {}
+        self._outputs = {}
+        self._reserved = {}
+        self._reserved_changes = None
+        self._walltime_exceeded = set()
+        self._poll_interval = poll_interval
+        self._backfill = backfill
+        self._scheduler = Scheduler() if scheduler is None else scheduler
+        self._reconcile_interval = reconcile_interval
+        self._last_reconcile = None
+        self._archive_age = archive_age
+        self._archive_batch = archive_batch
+        self._archive_task = None
+        self._heartbeat_interval = heartbeat_interval
+        self._wakeup = asyncio.Event()
+
+        # directory for output and status files of jobs
+        os.makedirs(self._state_dir, exist_ok=True)
+
+        # tracing
+        self._tracer = Tracer() if tracer is None else tracer
+
+        # metrics that are read at every scrape
+        self._metrics = Metrics() if metrics is None else metrics
+        self._metrics.cpus.set_function(lambda: self._ncpus)
+        self._metrics.used_cpus.set_function(self._get_used_cpus)
+        self._metrics.mem.set_function(lambda: float('nan') if self._mem is None else self._mem)
+        self._metrics.used_mem.set_function(self._get_used_mem)
+        self._metrics.notifications.set_function(lambda: self._notifier.pending)
+
+        # with more CPUs than cores, some jobs cannot be pinned
+        if self._topology is not None and len(self._topology.cores) < ncpus:
+            log.warning('Only %d of %d CPUs are available as cores for pinning jobs.', len(self._topology.cores),
+                        ncpus)
+
+        # start periodic tasks
         self._task = asyncio.ensure_future(self._main_loop())
+        if self._archive_age is not None:
+            self._archive_task = asyncio.ensure_future(self._archive_loop())
+        self._heartbeat_task = asyncio.ensure_future(self._heartbeat_loop())
+        self._spool_task = asyncio.ensure_future(self._spool_loop())
 
     def close(self):
         """Close daemon."""
         self._task.cancel()
+        self._heartbeat_task.cancel()
+        self._spool_task.cancel()
+        self._notifier.close()
+        if self._archive_task is not None:
+            self._archive_task.cancel()
 
     async def _main_loop(self):
         """Main loop for daemon that starts new jobs."""
 
+        # first take care of jobs that were running before a restart
+        try:
+            await self._recover()
+        except asyncio.CancelledError:
+            raise
+        except:
+            log.exception('Could not recover running jobs.')
+
         # sleep a little, before we start jobs
         await asyncio.sleep(10)
 
@@ -72,82 +186,432 @@ class PyBSdaemon:
         while True:
             # catch exceptions
             try:
-                # sleep a little
-                await asyncio.sleep(1)
+                # wait for a wake-up, but poll every now and then for jobs submitted on other nodes
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self._poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+
+                # reconcile used CPUs with database on start and every now and then
+                now = time.time()
+                if self._last_reconcile is None or now - self._last_reconcile > self._reconcile_interval:
+                    await self._reconcile()
+                    self._last_reconcile = now
+
+                # number of available CPUs and memory
+                available_cpus = self._ncpus - self._get_used_cpus()
+                available_mem = None if self._mem is None else self._mem - self._get_used_mem()
+
+                # start jobs if possible and, if successful, try again right away for backfilling
+                if await self._start_jobs(available_cpus, available_mem) > 0:
+                    self._schedule()
+
+            except asyncio.CancelledError:
+                # daemon is closing
+                raise
+
+            except:
+                log.exception('Something went wrong.')
+
+    async def _archive_loop(self):
+        """Periodically move old finished jobs to the history."""
+
+        # Run forever
+        while True:
+            # catch exceptions
+            try:
+                # move jobs in batches and give other tasks a chance to run in between
+                before = datetime.datetime.now() - datetime.timedelta(days=self._archive_age)
+                count = 0
+                while True:
+                    moved = await self._db.run(self._archive_jobs, before)
+                    count += moved
+                    if moved < self._archive_batch:
+                        break
+                    await asyncio.sleep(0.1)
+
+                # log it
+                if count > 0:
+                    log.info('Moved %d finished jobs to history.', count)
+
+            except asyncio.CancelledError:
+                # daemon is closing
+                raise
+
+            except:
+                log.exception('Something went wrong.')
+
+            # sleep an hour
+            await asyncio.sleep(3600)
+
+    async def _heartbeat_loop(self):
+        """Periodically report capacity of this node to the database."""
+
+        # Run forever
+        while True:
+            # catch exceptions
+            try:
+                await self._db.run(self._send_heartbeat, self._get_used_cpus())
+
+                # number of jobs in the cluster, which is updated as jobs come and go, but changes on other nodes, too
+                for state, count in (await self._db.run(self._count_jobs)).items():
+                    self._metrics.jobs.set(count, state=state)
 
-                # update used cpus
-                self._used_cpus = self._get_used_cpus()
+            except asyncio.CancelledError:
+                # daemon is closing
+                raise
+
+            except:
+                log.exception('Something went wrong.')
 
-                # number of available CPUs
-                available_cpus = self._ncpus - self._used_cpus
+            # sleep until next heartbeat
+            await asyncio.sleep(self._heartbeat_interval)
 
-                # start job if possible
-                if not await self._start_job(available_cpus):
-                    # sleep a little longer
-                    await asyncio.sleep(10)
+    async def _spool_loop(self):
+        """Periodically cut down spool files of running jobs that grew too large."""
+
+        # Run forever
+        while True:
+            # catch exceptions
+            try:
+                # only files in the state directory, output files given in the header are the user's business
+                for job_id, outputs in list(self._outputs.items()):
+                    for kind in ('output', 'error'):
+                        if outputs[kind] == self._state_file(job_id, kind) and \
+                                trim_file(outputs[kind], self._spool_size):
+                            log.info('Cut down %s of job %d to last %d bytes.', kind, job_id, self._spool_size // 2)
+
+            except asyncio.CancelledError:
+                # daemon is closing
+                raise
 
             except:
                 log.exception('Something went wrong.')
 
-    def _get_used_cpus(self):
+            # sleep until next check
+            await asyncio.sleep(SPOOL_CHECK_INTERVAL)
+
+    def _send_heartbeat(self, session: 'Session', used_cpus: int):
+        """Store capacity of this node in the database.
+
+        Args:
+            session: Database session to use.
+            used_cpus: Number of used CPUs.
+        """
+
+        # get node or create it
+        node = session.query(Node).filter(Node.name == self._hostname).first()
+        if node is None:
+            node = Node(name=self._hostname)
+            session.add(node)
+
+        # update it
+        node.ncpus = self._ncpus
+        node.used_cpus = used_cpus
+        node.mem = self._mem
+        node.heartbeat = datetime.datetime.now()
+
+    @staticmethod
+    def _count_jobs(session: 'Session') -> dict:
+        """Count waiting and running jobs in the whole cluster.
+
+        Args:
+            session: Database session to use.
+
+        Returns:
+            Dictionary with number of jobs for both states.
+        """
+        counts = dict(session.query(Job.state, func.count())
+                      .filter(Job.state.in_([JobState.waiting, JobState.running]))
+                      .group_by(Job.state))
+        return {state.value: counts.get(state, 0) for state in (JobState.waiting, JobState.running)}
+
+    def _archive_jobs(self, session: 'Session', before: datetime.datetime) -> int:
+        """Move one batch of finished jobs to the history.
+
+        Args:
+            session: Database session to use.
+            before: Only move jobs finished before this time.
+
+        Returns:
+            Number of moved jobs.
+        """
+
+        # get IDs of oldest finished jobs, but always keep the newest job, so that databases deriving the next ID from
+        # the largest existing one, like MySQL before 8.0 after a restart, never reuse an ID from the history
+        newest = session.query(func.max(Job.id)).scalar_subquery()
+        job_ids = [job.id for job in session.query(Job.id)
+                   .filter(Job.finished < before, Job.id < newest)
+                   .order_by(Job.finished.asc())
+                   .limit(self._archive_batch)]
+        if len(job_ids) == 0:
+            return 0
+
+        # copy them to history
+        columns = [c.name for c in JobHistory.__table__.columns]
+        select = session.query(*[Job.__table__.c[c] for c in columns]).filter(Job.id.in_(job_ids))
+        session.execute(JobHistory.__table__.insert().from_select(columns, select))
+
+        # and delete them
+        session.query(JobNode).filter(JobNode.job_id.in_(job_ids)).delete(synchronize_session=False)
+        session.query(JobDependency).filter(JobDependency.job_id.in_(job_ids)).delete(synchronize_session=False)
+        session.query(Job).filter(Job.id.in_(job_ids)).delete(synchronize_session=False)
+        return len(job_ids)
+
+    def _schedule(self):
+        """Wake up main loop for an immediate scheduling pass."""
+        self._wakeup.set()
+
+    def _get_used_cpus(self) -> int:
         """Get number of used CPUs."""
-        with self._db() as session:
-            # sum CPUs of jobs running on this node
-            result = session.query(func.sum(Job.ncpus).label('used_cpus'))\
-                .filter(Job.started != None, Job.finished == None, Job.nodes == self._hostname)\
-                .first()
+        with self._tracer.span('PyBSdaemon._get_used_cpus'):
+            return sum(ncpus for ncpus, _, _ in self._reserved.values())
 
-            # if result is None, no Job was running, so return 0
-            return 0 if result.used_cpus is None else int(result.used_cpus)
+    def _get_used_mem(self) -> int:
+        """Get used memory in bytes, as requested by the running jobs."""
+        return sum(mem for _, mem, _ in self._reserved.values())
 
-    async def _start_job(self, available_cpus: int) -> bool:
-        """Try to start a new job.
+    def _assign_cores(self, ncpus: int) -> list:
+        """Pick free cores for a new job.
 
         Args:
+            ncpus: Number of requested CPUs.
+
+        Returns:
+            List of cores or None, if jobs are not pinned or not enough cores are free.
+        """
+        if self._topology is None:
+            return None
+        used = set(core for _, _, cores in self._reserved.values() if cores is not None for core in cores)
+        return self._topology.assign(ncpus, used)
+
+    def _reserve(self, job_id: int, ncpus: int, mem: int = None, cores: list = None):
+        """Reserve CPUs, memory, and cores for a job.
+
+        Args:
+            job_id: ID of job.
+            ncpus: Number of CPUs to reserve.
+            mem: Memory in bytes to reserve, None if job did not request any.
+            cores: Cores assigned to job, None if it is not pinned.
+        """
+        self._reserved[job_id] = (ncpus, mem or 0, cores)
+        if self._reserved_changes is not None:
+            self._reserved_changes.append((job_id, self._reserved[job_id]))
+
+    def _release(self, job_id: int):
+        """Release CPUs and memory reserved for a job.
+
+        Args:
+            job_id: ID of job.
+        """
+        self._reserved.pop(job_id, None)
+        if self._reserved_changes is not None:
+            self._reserved_changes.append((job_id, None))
+
+    async def _reconcile(self):
+        """Replace the CPU, memory, and core reservations of this node with those found in the database."""
+
+        def get_running(session):
+            # get CPUs, memory, and cores of jobs running on this node
+            jobs = session.query(Job.id, Job.ncpus, Job.mem, Job.cores)\
+                .filter(Job.state == JobState.running, Job.node == self._hostname)
+            return {job.id: (job.ncpus, job.mem or 0, None if job.cores is None else parse_cpulist(job.cores))
+                    for job in jobs}
+
+        # get reservations from database and remember all changes in the meantime
+        self._reserved_changes = []
+        try:
+            reserved = await self._db.run(get_running)
+        finally:
+            changes, self._reserved_changes = self._reserved_changes, None
+
+        # apply changes
+        for job_id, reservation in changes:
+            if reservation is None:
+                reserved.pop(job_id, None)
+            else:
+                reserved[job_id] = reservation
+
+        # cores of jobs that are just starting are not in the database yet
+        for job_id, (ncpus, mem, cores) in reserved.items():
+            if cores is None and job_id in self._reserved:
+                reserved[job_id] = (ncpus, mem, self._reserved[job_id][2])
+
+        # removed jobs are not running anymore in the database, but their processes may still be, e.g. during the
+        # grace period after SIGTERM, so keep their reservations until _finish_job() releases them
+        for job_id, reservation in self._reserved.items():
+            if job_id not in reserved and (job_id in self._processes or job_id in self._terminating):
+                reserved[job_id] = reservation
+
+        # log changes
+        if reserved != self._reserved:
+            log.warning('Reconciled used CPUs from %d to %d.', self._get_used_cpus(),
+                        sum(ncpus for ncpus, _, _ in reserved.values()))
+        self._reserved = reserved
+
+    def _dispatch_query(self, session: 'Session', available_cpus: int, available_mem: int = None) -> Query:
+        """Build query for waiting jobs that may be started on this node, in the order they should be started.
+
+        Args:
+            session: Database session to use.
             available_cpus: number of available CPUs.
+            available_mem: available memory in bytes, None if not taken into account.
 
         Returns:
-            Whether a new job has been started.
+            Query for waiting jobs.
         """
 
-        # open session
-        with self._db() as session:
-            # find job to process and lock row
-            query = session.query(Job)
+        # waiting jobs only
+        query = session.query(Job).filter(Job.state == JobState.waiting)
 
-            # not started, not finished, not too many requested cores
-            query = query.filter(Job.started == None, Job.finished == None, Job.ncpus <= available_cpus)
+        # when backfilling, we can skip all jobs requesting too many cores or too much memory
+        if self._backfill:
+            query = query.filter(Job.ncpus <= available_cpus)
+            if available_mem is not None:
+                query = query.filter(or_(Job.mem == None, Job.mem <= available_mem))
 
-            # if nodes is not NULL, _hostname must be at beginning, between two commas, or at end of nodes
-            # this looks simpler, but works on MySQL only:
-            #   .filter(or_(Job.nodes == None, func.find_in_set(self._hostname, Job.nodes) > 0))
-            query = query.filter(or_(Job.nodes == None, Job.nodes == self._hostname,
-                                     Job.nodes.like(self._hostname + ',%'),
-                                     Job.nodes.like('%,' + self._hostname + ',%'),
-                                     Job.nodes.like('%,' + self._hostname)))
+        # job must either not be restricted to any nodes or allowed on this one
+        allowed_nodes = session.query(JobNode).filter(JobNode.job_id == Job.id)
+        query = query.filter(or_(~allowed_nodes.exists(),
+                                 allowed_nodes.filter(JobNode.node == self._hostname).exists()))
 
-            # sort by priority and by oldest first
-            query = query.order_by(Job.priority.desc(), Job.submitted.asc())
+        # and all its dependencies must be satisfied, i.e. deleted
+        query = query.filter(~session.query(JobDependency).filter(JobDependency.job_id == Job.id).exists())
 
-            # lock row for later update and pick first
-            job = query.with_for_update().first()
+        # sort by priority and by oldest first
+        return query.order_by(Job.priority.desc(), Job.submitted.asc(), Job.id.asc())
 
-            # none available?
-            if job is None:
-                return False
+    async def _start_jobs(self, available_cpus: int, available_mem: int = None) -> int:
+        """Start as many new jobs as fit into the available CPUs and memory.
 
-            # set Started/Hostname and remember job id
-            job.started = datetime.datetime.now()
-            job.nodes = self._hostname
-            session.flush()
-            job_id = job.id
+        Jobs are picked by the scheduler, by default in order of priority and submission time. With backfilling
+        enabled, smaller jobs further down the queue are started if the next job in line does not fit, otherwise the
+        pass stops at the first job that does not fit.
 
-        # and finally start job
-        log.info('Preparing job %d...', job_id)
-        asyncio.ensure_future(self._run_job(job_id))
+        Args:
+            available_cpus: number of available CPUs.
+            available_mem: available memory in bytes, None if not taken into account.
+
+        Returns:
+            Number of started jobs.
+        """
+
+        # nothing to do?
+        if available_cpus <= 0:
+            return 0
+
+        def claim_jobs(session):
+            # find jobs to process
+            query = self._dispatch_query(session, available_cpus, available_mem)
+
+            # skip jobs that are being claimed by other nodes right now, if supported
+            if self._supports_skip_locked(session.get_bind().dialect):
+                query = query.with_for_update(skip_locked=True)
+
+            # let scheduler pick jobs and claim them, unless another node was faster
+            now = datetime.datetime.now()
+            return [(job_id, ncpus, mem)
+                    for job_id, ncpus, mem in self._scheduler.pick(session, query, available_cpus, self._backfill,
+                                                                   available_mem)
+                    if self._claim_job(session, job_id, now)]
+
+        # claim jobs
+        with self._metrics.scheduling_pass.time(), self._tracer.span('PyBSdaemon._start_jobs'):
+            claimed = await self._db.run(claim_jobs)
+        self._metrics.started_jobs.inc(len(claimed))
+        self._jobs_started(len(claimed))
+
+        # reserve CPUs, memory, and cores and finally start jobs
+        for job_id, ncpus, mem in claimed:
+            self._reserve(job_id, ncpus, mem, self._assign_cores(ncpus))
+            log.info('Preparing job %d...', job_id)
+            asyncio.ensure_future(self._run_job(job_id))
+
+        # return number of started jobs
+        return len(claimed)
+
+    def _jobs_started(self, count: int):
+        """Update number of waiting and running jobs for started jobs.
+
+        Args:
+            count: Number of started jobs.
+        """
+        self._metrics.jobs.inc(-count, state=JobState.waiting.value)
+        self._metrics.jobs.inc(count, state=JobState.running.value)
+
+    def _resolve_dependencies(self, session: 'Session', job_id: int, state: JobState):
+        """Delete all dependencies on a finished job that are satisfied now and cancel the jobs with dependencies
+        that never can be.
 
-        # successfully started a job
-        return True
+        Args:
+            session: Database session to use.
+            job_id: ID of finished job.
+            state: State of finished job.
+        """
+
+        # cancelling a job may affect further jobs
+        finished = [(job_id, state)]
+        while finished:
+            job_id, state = finished.pop()
+            dependencies = session.query(JobDependency).filter(JobDependency.depends_on == job_id)
+
+            # delete satisfied dependencies
+            types = [t for t, states in JobDependency.TYPES.items() if state in states]
+            dependencies.filter(JobDependency.type.in_(types)).delete(synchronize_session=False)
+
+            # all others can never be satisfied, so cancel their waiting jobs
+            job_ids = [job.id for job in session.query(Job.id)
+                       .filter(Job.id.in_(dependencies.with_entities(JobDependency.job_id)),
+                               Job.state == JobState.waiting)]
+            dependencies.delete(synchronize_session=False)
+            if not job_ids:
+                continue
+            log.info('Cancelling jobs %s, since job %d finished as %s.',
+                     ', '.join(str(i) for i in job_ids), job_id, state.value)
+            session.query(Job) \
+                .filter(Job.id.in_(job_ids)) \
+                .update({Job.state: JobState.cancelled, Job.finished: datetime.datetime.now()},
+                        synchronize_session=False)
+            session.query(JobDependency).filter(JobDependency.job_id.in_(job_ids)).delete(synchronize_session=False)
+            finished.extend((i, JobState.cancelled) for i in job_ids)
+
+    def _claim_job(self, session: 'Session', job_id: int, now: datetime.datetime) -> bool:
+        """Atomically mark a waiting job as running on this node.
+
+        Since the state is checked in the same UPDATE statement, a job can never be claimed by two nodes, even on
+        databases that do not support locking rows.
+
+        Args:
+            session: Database session to use.
+            job_id: ID of job to claim.
+            now: Start time for job.
+
+        Returns:
+            Whether job has been claimed.
+        """
+        count = session.query(Job) \
+            .filter(Job.id == job_id, Job.state == JobState.waiting) \
+            .update({Job.state: JobState.running, Job.started: now, Job.node: self._hostname},
+                    synchronize_session=False)
+        return count == 1
+
+    @staticmethod
+    def _supports_skip_locked(dialect: 'Dialect') -> bool:
+        """Whether the given database supports SELECT ... FOR UPDATE SKIP LOCKED.
+
+        Args:
+            dialect: Dialect of database.
+
+        Returns:
+            Whether SKIP LOCKED is supported.
+        """
+        version = dialect.server_version_info or ()
+        if dialect.name == 'postgresql':
+            return version >= (9, 5)
+        elif dialect.name == 'mysql':
+            return version >= ((10, 6) if getattr(dialect, 'is_mariadb', False) else (8, 0, 1))
+        return False
 
     async def _run_job(self, job_id: int):
         """Prepare a job, run it, and analyse output.
@@ -156,115 +620,640 @@ class PyBSdaemon:
             job_id: ID of job to run.
         """
 
-        header = {}
+        header, filename = {}, None
+        return_code, outs, errs, usage = None, None, None, None
+        watchdog, finished = None, False
         try:
-            # get job
-            with self._db() as session:
+            def get_filename(session):
                 # get job
                 job = session.query(Job).filter(Job.id == job_id).first()
                 if job is None:
                     # could not find job in DB
                     log.error('Could not find job %d in database.', job_id)
-                    return
-
-                # store filename
-                filename = os.path.join(self._root_dir, job.filename)
+                    return None
+                if job.state != JobState.running:
+                    # job has been cancelled in the meantime
+                    log.info('Job %d has been cancelled before start.', job_id)
+                    return None
+
+                # time it waited in the queue
+                if job.submitted is not None and job.started is not None:
+                    self._metrics.submit_to_start.observe((job.started - job.submitted).total_seconds())
+
+                # return filename, PBS header, index within array job, and limits
+                return os.path.join(self._root_dir, job.filename), self._get_header(job), job.array_index, \
+                    job.ncpus, job.mem, job.walltime
+
+            # get filename and header of script
+            script = await self._db.run(get_filename)
+            if script is None:
+                return
+            filename, header, array_index, ncpus, mem, walltime = script
 
             # log it
             log.info('Starting job %d from %s...', job_id, filename)
 
-            # parse PBS header
-            header = Job.parse_pbs_header(filename)
-
             # get working directory
             cwd = os.path.dirname(filename)
 
-            # run job
-            proc = await asyncio.create_subprocess_shell(filename, cwd=cwd,
-                                                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-            # store it
+            # output and error go directly into files, if not given or they cannot be opened, into spool files in the
+            # state directory, so that they never depend on the daemon and survive a restart of it
+            files = {}
+            for kind in ('output', 'error'):
+                files[kind] = self._open_output(cwd, header.get(kind))
+                if files[kind] is None:
+                    files[kind] = self._open_output(cwd, self._state_file(job_id, kind), append=True)
+            self._outputs[job_id] = {kind: None if f is None else f.name for kind, f in files.items()}
+
+            # pass job ID, index within array job, and CPUs to script
+            env = dict(os.environ, PBS_JOBID=str(job_id), OMP_NUM_THREADS=str(ncpus))
+            if array_index is not None:
+                env['PBS_ARRAY_INDEX'] = str(array_index)
+            cores = self._reserved[job_id][2] if job_id in self._reserved else None
+            if cores is not None:
+                env['PYBS_CPUS'] = format_cpulist(cores)
+
+            # limit memory of whole job with a cgroup, if possible, otherwise of every single process
+            cgroup = self._create_cgroup(job_id, mem)
+
+            # run job through wrapper in its own session, so that it can be signalled as a whole, the wrapper
+            # reports the exit code and resource usage of the job in a status file
+            try:
+                with self._tracer.span('PyBSdaemon._run_job.spawn'):
+                    proc = await asyncio.create_subprocess_exec(
+                        sys.executable, '-I', WRAPPER, self._state_file(job_id, 'status'), filename, cwd=cwd, env=env,
+                        start_new_session=True, stdin=subprocess.DEVNULL,
+                        stdout=subprocess.DEVNULL if files['output'] is None else files['output'],
+                        stderr=subprocess.DEVNULL if files['error'] is None else files['error'],
+                        preexec_fn=limit_resources(mem, cgroup, cores))
+            finally:
+                # child has its own copies of the files now
+                for f in files.values():
+                    if f is not None:
+                        f.close()
+
+            # store it, also in database, so that we can find it again after a restart
             self._processes[job_id] = proc
+            await self._db.run(self._set_pid, job_id, proc.pid, process_start_time(proc.pid),
+                               None if cores is None else format_cpulist(cores))
+
+            # terminate it, when it exceeds its walltime
+            if walltime is not None:
+                watchdog = asyncio.ensure_future(self._enforce_walltime(job_id, walltime))
 
             # wait for process
-            outs, errs = await proc.communicate()
+            await proc.wait()
             return_code = proc.returncode
+            _, usage = self._read_status(job_id)
 
-            # write output and error
-            for kind, lines in [('output', outs), ('error', errs)]:
-                try:
-                    if kind in header:
-                        # write lines
-                        with open(os.path.join(cwd, header[kind]), 'wb') as f:
-                            f.write(lines)
-
-                        # set file permissions
-                        os.chmod(os.path.join(cwd, header[kind]), 0o664)
-                except (IOError, PermissionError, ValueError):
-                    # Could not write file.
-                    pass
+            # wait for the rest of its process group, which would otherwise use CPUs that are free again
+            await self._wait_group(job_id, proc)
+
+            # get last lines of output and error
+            outs, errs = [self._tail_output(self._outputs[job_id][kind]) for kind in ('output', 'error')]
+
+        except asyncio.CancelledError:
+            # daemon is closing
+            raise
+
+        except:
+            # e.g. spawning failed, job is marked as failed below
+            log.exception('Could not run job %d.', job_id)
 
         finally:
-            # remove process
-            if job_id in self._processes:
-                del self._processes[job_id]
+            # clean up and set finished
+            if watchdog is not None:
+                watchdog.cancel()
+            state = JobState.done if return_code == 0 else JobState.failed
+            finished = await self._finish_job(job_id, state, header, return_code, outs, errs, usage)
 
-            # set Finished
-            with self._db() as session:
-                # get job
+        # log it, unless job has been cancelled in the meantime
+        if finished:
+            log.info('Finished job %d from %s...', job_id, filename)
+
+    async def _finish_job(self, job_id: int, state: JobState, header: dict, return_code: int, outs: list,
+                          errs: list, usage: dict = None) -> bool:
+        """Clean up after a job has finished and mark it as finished in the database.
+
+        Args:
+            job_id: ID of job.
+            state: New state of job.
+            header: PBS header of job.
+            return_code: Exit code of job, None if unknown.
+            outs: Last lines of output.
+            errs: Last lines of error output.
+            usage: Resource usage of job as reported by the wrapper, None if unknown.
+
+        Returns:
+            Whether the job has been marked as finished, False if it has been cancelled in the meantime.
+        """
+
+        # remove process
+        if job_id in self._processes:
+            del self._processes[job_id]
+        self._terminating.pop(job_id, None)
+        self._outputs.pop(job_id, None)
+        self._remove_state_files(job_id)
+
+        # a job that had to be terminated failed, whatever its exit code says
+        if job_id in self._walltime_exceeded:
+            self._walltime_exceeded.discard(job_id)
+            state = JobState.failed
+
+        # remove cgroup
+        self._remove_cgroup(job_id)
+
+        def set_finished(session):
+            # get job
+            job = session.query(Job).filter(Job.id == job_id).first()
+            if job is None or job.state not in (JobState.running, JobState.cancelled):
+                # could not find job in DB
+                return False, None
+
+            # store exit code and resource usage, also for cancelled jobs, which have been using their CPUs until now
+            job.exit_code = return_code
+            for key, value in (usage or {}).items():
+                setattr(job, key, value)
+            if job.finished is None:
+                job.finished = datetime.datetime.now()
+
+            # a cancelled job keeps its state and has released its dependent jobs already
+            if job.state == JobState.cancelled:
+                return False, None
+
+            # set finished and state
+            job.finished = datetime.datetime.now()
+            job.state = state
+
+            # release dependent jobs
+            self._resolve_dependencies(session, job_id, state)
+
+            # compose message, which is sent outside the transaction
+            return True, self._compose_message(header, job, return_code, outs, errs)
+
+        # set Finished
+        try:
+            finished, message = await self._db.run(set_finished)
+        finally:
+            # free CPUs only now, otherwise a reconcile reading the job as still running in the meantime would reserve
+            # them again, and try to start new jobs
+            self._release(job_id)
+            self._schedule()
+        if finished:
+            self._metrics.jobs.inc(-1, state=JobState.running.value)
+            self._metrics.jobs_finished.inc(state=state.value)
+
+        # send message in background
+        if message is not None:
+            self._notifier.notify(*message)
+        return finished
+
+    def _state_file(self, job_id: int, kind: str) -> str:
+        """Returns the name of a file for a job in the state directory.
+
+        Args:
+            job_id: ID of job.
+            kind: Either "output" or "error" for the spooled output, or "status" for the report of the wrapper.
+
+        Returns:
+            Absolute filename.
+        """
+        return os.path.abspath(os.path.join(self._state_dir, 'job%d.%s' % (job_id, kind)))
+
+    def _remove_state_files(self, job_id: int):
+        """Remove spool and status files of a finished job, a tail that is following them keeps its file open.
+
+        Args:
+            job_id: ID of job.
+        """
+        for kind in ('output', 'error', 'status'):
+            try:
+                os.remove(self._state_file(job_id, kind))
+            except FileNotFoundError:
+                pass
+            except OSError:
+                log.warning('Could not remove %s file of job %d.', kind, job_id)
+
+    def _read_status(self, job_id: int) -> (int, dict):
+        """Read exit code and resource usage of a finished job from the status file written by its wrapper.
+
+        Args:
+            job_id: ID of job.
+
+        Returns:
+            Tuple of exit code and dictionary with CPU times, peak RSS, and I/O bytes, both None, if the wrapper was
+            killed before reporting them.
+        """
+        try:
+            with open(self._state_file(job_id, 'status'), 'r') as f:
+                status = json.load(f)
+        except FileNotFoundError:
+            log.warning('No status reported for job %d.', job_id)
+            return None, None
+        except (OSError, ValueError):
+            log.warning('Could not read status of job %d.', job_id)
+            return None, None
+
+        # only accept known columns
+        return status.get('exit_code'), {key: status.get(key) for key in USAGE_COLUMNS}
+
+    async def _enforce_walltime(self, job_id: int, remaining: float):
+        """Terminate a job, when its walltime has passed.
+
+        Args:
+            job_id: ID of job.
+            remaining: Remaining walltime in seconds.
+        """
+        await asyncio.sleep(max(remaining, 0))
+        log.warning('Job %d exceeded its walltime, terminating it...', job_id)
+        self._walltime_exceeded.add(job_id)
+        self._terminate_job(job_id)
+
+    def _terminate_job(self, job_id: int) -> asyncio.Future:
+        """Terminate all processes of a running job, unless this is happening already.
+
+        Jobs started in their own session are signalled as a whole process group, first with SIGTERM and, after the
+        grace period, with SIGKILL. Only adopted jobs of older versions are signalled individually.
+
+        Args:
+            job_id: ID of job.
+
+        Returns:
+            Future that is done, when all processes are gone.
+        """
+        if job_id not in self._terminating:
+            proc = self._processes[job_id]
+            group = not isinstance(proc, AdoptedProcess) or proc.is_group_leader()
+            self._terminating[job_id] = asyncio.ensure_future(terminate(proc, self._kill_grace, group))
+        return self._terminating[job_id]
+
+    async def _wait_group(self, job_id: int, proc):
+        """Make sure that no processes of a job are left after its main process has finished.
+
+        Args:
+            job_id: ID of job.
+            proc: Main process of job, which has finished already.
+        """
+
+        # no process group or nothing left?
+        if isinstance(proc, AdoptedProcess) and not proc.is_group_leader() or not group_alive(proc.pid):
+            return
+
+        # wait for termination, if it has been requested, otherwise terminate orphans left by the job
+        if job_id not in self._terminating:
+            log.warning('Job %d left processes behind, terminating them...', job_id)
+        await self._terminate_job(job_id)
+
+    def _create_cgroup(self, job_id: int, mem: int) -> Cgroup:
+        """Create a cgroup for limiting the memory of a job, if configured.
+
+        Args:
+            job_id: ID of job.
+            mem: Requested memory in bytes or None.
+
+        Returns:
+            New cgroup or None, if no cgroup is required or it could not be created.
+        """
+
+        # no cgroups or no limit?
+        if self._cgroup_root is None or mem is None:
+            return None
+
+        # create it
+        cgroup = Cgroup(self._cgroup_root, 'job%d' % job_id)
+        try:
+            cgroup.create(mem)
+            return cgroup
+        except OSError as e:
+            log.warning('Could not create cgroup for job %d, limiting memory per process instead: %s', job_id, e)
+            cgroup.remove()
+            return None
+
+    def _remove_cgroup(self, job_id: int):
+        """Remove the cgroup of a finished job, if any.
+
+        Args:
+            job_id: ID of job.
+        """
+
+        # no cgroups?
+        if self._cgroup_root is None:
+            return
+
+        # report processes that have been killed for using too much memory and remove cgroup
+        cgroup = Cgroup(self._cgroup_root, 'job%d' % job_id)
+        if cgroup.oom_killed() > 0:
+            log.warning('Job %d exceeded its memory limit, %d processes have been killed.', job_id,
+                        cgroup.oom_killed())
+        cgroup.remove()
+
+    @staticmethod
+    def _set_pid(session: 'Session', job_id: int, pid: int, pid_started: int, cores: str = None):
+        """Store process and assigned cores of a running job.
+
+        Args:
+            session: Database session to use.
+            job_id: ID of job.
+            pid: ID of process.
+            pid_started: Start time of process.
+            cores: List of cores the job is pinned to, None if it is not.
+        """
+        session.query(Job) \
+            .filter(Job.id == job_id) \
+            .update({Job.pid: pid, Job.pid_started: pid_started, Job.cores: cores}, synchronize_session=False)
+
+    async def _recover(self):
+        """Recover jobs that have been running on this node when the daemon was stopped.
+
+        Processes that are still alive are adopted and watched until they finish. Jobs that finished in the meantime
+        are finished with the outcome reported by their wrapper, all others are marked as failed, so that their CPUs
+        are available again.
+        """
+
+        def get_running(session):
+            # get all jobs running on this node
+            jobs = session.query(Job).filter(Job.state == JobState.running, Job.node == self._hostname)
+            return [(job.id, job.ncpus, job.mem, None if job.cores is None else parse_cpulist(job.cores),
+                     job.pid, job.pid_started, os.path.join(self._root_dir, job.filename), self._get_header(job),
+                     None if job.walltime is None or job.started is None else
+                     job.walltime - (datetime.datetime.now() - job.started).total_seconds())
+                    for job in jobs]
+
+        def set_failed(session, job_ids):
+            # mark jobs as failed
+            session.query(Job) \
+                .filter(Job.id.in_(job_ids), Job.state == JobState.running) \
+                .update({Job.state: JobState.failed, Job.finished: datetime.datetime.now()},
+                        synchronize_session=False)
+
+            # and update their dependent jobs
+            for job_id in job_ids:
+                self._resolve_dependencies(session, job_id, JobState.failed)
+
+        # loop running jobs
+        dead = []
+        for job_id, ncpus, mem, cores, pid, pid_started, filename, header, remaining in \
+                await self._db.run(get_running):
+            # process still alive or, if not, did it report its outcome?
+            proc = None if pid is None else AdoptedProcess(pid, pid_started)
+            if proc is None or not proc.is_alive() and not os.path.exists(self._state_file(job_id, 'status')):
+                dead.append(job_id)
+                self._remove_cgroup(job_id)
+                self._remove_state_files(job_id)
+                continue
+
+            # adopt it, a finished one just gets finished
+            log.info('Adopting process %d for job %d...', pid, job_id)
+            self._reserve(job_id, ncpus, mem, cores)
+            self._outputs[job_id] = {kind: self._find_output(job_id, os.path.dirname(filename), header, kind)
+                                     for kind in ('output', 'error')}
+            asyncio.ensure_future(self._adopt_job(job_id, proc, header, remaining))
+
+        # mark dead jobs as failed
+        if dead:
+            log.warning('Marking %d jobs without running process as failed...', len(dead))
+            await self._db.run(set_failed, dead)
+            self._metrics.jobs_finished.inc(len(dead), state=JobState.failed.value)
+
+    async def _adopt_job(self, job_id: int, proc: AdoptedProcess, header: dict, remaining: float = None):
+        """Wait for an adopted job to finish.
+
+        Its exit code and resource usage are read from the status file written by its wrapper. If there is none, e.g.
+        for jobs started by older versions, the job is marked as failed, so that dependent jobs waiting for its success
+        are not released.
+
+        Args:
+            job_id: ID of job.
+            proc: Process of job.
+            header: PBS header of job.
+            remaining: Remaining walltime of job in seconds, None if unlimited.
+        """
+        watchdog = None
+        return_code, outs, errs, usage = None, [], [], None
+        try:
+            self._processes[job_id] = proc
+            proc.is_group_leader()  # can only be checked while process is alive
+            if remaining is not None:
+                watchdog = asyncio.ensure_future(self._enforce_walltime(job_id, remaining))
+            await proc.wait()
+            return_code, usage = self._read_status(job_id)
+            await self._wait_group(job_id, proc)
+
+            # get last lines of output and error
+            outs, errs = [self._tail_output(self._outputs[job_id][kind]) for kind in ('output', 'error')]
+
+        finally:
+            if watchdog is not None:
+                watchdog.cancel()
+            if return_code is None:
+                log.warning('Exit code of adopted job %d is unknown, marking it as failed.', job_id)
+            state = JobState.done if return_code == 0 else JobState.failed
+            if await self._finish_job(job_id, state, header, return_code, outs, errs, usage):
+                log.info('Finished adopted job %d.', job_id)
+
+    def _get_header(self, job: Job) -> dict:
+        """Returns the PBS header of a job.
+
+        The header is stored with the job at submission, only for older jobs the script has to be parsed again.
+
+        Args:
+            job: Job to get header for.
+
+        Returns:
+            Dictionary with all header items.
+        """
+        if job.header is not None:
+            return json.loads(job.header)
+        return Job.parse_pbs_header(os.path.join(self._root_dir, job.filename))
+
+    @staticmethod
+    def _open_output(cwd: str, filename: str, append: bool = False):
+        """Open a file for the output of a job.
+
+        Args:
+            cwd: Working directory of job.
+            filename: Filename from PBS header, relative to working directory, or None.
+            append: If True, open file for appending, so that it can be trimmed while the job writes to it.
+
+        Returns:
+            Opened file or None, if no filename was given or file could not be opened.
+        """
+
+        # no filename?
+        if filename is None:
+            return None
+
+        try:
+            # open file and set file permissions
+            f = open(os.path.join(cwd, filename), 'ab' if append else 'wb')
+            os.chmod(f.name, 0o664)
+            return f
+
+        except (IOError, PermissionError, ValueError):
+            # Could not open file.
+            log.warning('Could not open file %s for writing.', filename)
+            return None
+
+    def _find_output(self, job_id: int, cwd: str, header: dict, kind: str) -> str:
+        """Find the file that the output of a running job is written to.
+
+        Args:
+            job_id: ID of job.
+            cwd: Working directory of job.
+            header: PBS header of job.
+            kind: Either "output" or "error".
+
+        Returns:
+            Filename or None, if there is no file.
+        """
+        spool = self._state_file(job_id, kind)
+        if os.path.exists(spool):
+            return spool
+        return None if header.get(kind) is None else os.path.join(cwd, header[kind])
+
+    @staticmethod
+    def _tail_output(filename: str) -> list:
+        """Get last lines of output of a job.
+
+        Args:
+            filename: File that output was written to, or None.
+
+        Returns:
+            List of lines.
+        """
+
+        # no file?
+        if filename is None:
+            return []
+
+        try:
+            # read end of file
+            return tail_file(filename, 10)
+        except (IOError, PermissionError, ValueError):
+            # Could not read file.
+            return []
+
+    async def tail(self, job_id: int, lines: int = 10, follow: bool = False, stream: str = 'output'):
+        """Get the last lines of output of a job and optionally follow new output.
+
+        Args:
+            job_id: ID of job.
+            lines: Number of lines to return.
+            follow: If True, follow new output of a job running on this node.
+            stream: Either "output" or "error".
+
+        Returns:
+            List of lines or, if following, an asynchronous generator yielding all new output as it is written.
+        """
+
+        # check stream
+        if stream not in ('output', 'error'):
+            raise ValueError('Unknown stream %s.' % stream)
+
+        # is job running on this node?
+        if job_id in self._outputs:
+            # we know where to find output
+            target = self._outputs[job_id][stream]
+            if target is None:
+                raise ValueError('No %s file for job.' % stream)
+
+        else:
+            def get_filename(session):
                 job = session.query(Job).filter(Job.id == job_id).first()
                 if job is None:
                     # could not find job in DB
-                    return
+                    raise ValueError('Job not found.')
+                return os.path.join(self._root_dir, job.filename), self._get_header(job)
 
-                # set finished and PID
-                job.finished = datetime.datetime.now()
+            # get filename and header of script
+            filename, header = await self._db.run(get_filename)
 
-                # send email?
-                if 'send_mail' in header:
-                    # really send?
-                    self._send_message(header, job, return_code, outs, errs)
+            # get filename of output from header
+            if stream not in header:
+                raise ValueError('No %s file defined for job.' % stream)
+            target = os.path.join(os.path.dirname(filename), header[stream])
 
-        # log it
-        log.info('Finished job %d from %s...', job_id, filename)
+        # read from file
+        try:
+            offset = os.path.getsize(target)
+            last = tail_file(target, lines)
+        except (IOError, PermissionError, ValueError):
+            raise ValueError('Could not read %s file.' % stream)
+        return self._follow_file(job_id, target, offset, last) if follow else last
 
-    def list_waiting(self):
+    async def _follow_file(self, job_id: int, filename: str, offset: int, last: list):
+        """Follow new output written to a file, while job is running on this node.
+
+        Args:
+            job_id: ID of job.
+            filename: Name of file to follow.
+            offset: Position in file to start reading from.
+            last: Last lines of output so far.
+
+        Yields:
+            Chunks of new output.
+        """
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+        # send last lines first
+        if last:
+            yield '\n'.join(last) + '\n'
+
+        # only read new data
+        with open(filename, 'rb') as f:
+            f.seek(offset)
+            while True:
+                # check before reading, so we don't miss anything written before the end of the job
+                running = job_id in self._processes
+
+                # file has been trimmed? then start over like tail does
+                if os.fstat(f.fileno()).st_size < f.tell():
+                    f.seek(0)
+
+                # got new data?
+                data = f.read(65536)
+                if data:
+                    yield decoder.decode(data)
+                elif running:
+                    await asyncio.sleep(0.5)
+                else:
+                    break
+
+    async def list_waiting(self):
         """Get a list of waiting jobs.
 
         Returns:
             List of dictionaries with job infos.
         """
 
-        # get session
-        with self._db() as session:
-            # do query
+        def query(session):
             jobs = session \
-                .query(Job) \
-                .filter(Job.started == None, Job.finished == None) \
-                .order_by(Job.priority.desc(), Job.submitted.asc())
-
-            # return list
+                .query(*self._list_columns()) \
+                .filter(Job.state == JobState.waiting) \
+                .order_by(Job.priority.desc(), Job.submitted.asc(), Job.id.asc())
             return self._list(jobs)
 
-    def list_running(self):
+        # do query and return list
+        return await self._db.run(query)
+
+    async def list_running(self):
         """Get a list of running jobs.
 
         Returns:
             List of dictionaries with job infos.
         """
 
-        # get session
-        with self._db() as session:
-            # do query
+        def query(session):
             jobs = session \
-                .query(Job) \
-                .filter(Job.started != None, Job.finished == None) \
+                .query(*self._list_columns()) \
+                .filter(Job.state == JobState.running) \
                 .order_by(Job.started.asc())
-
-            # return list
             return self._list(jobs)
 
-    def list_finished(self, limit: int = 5):
+        # do query and return list
+        return await self._db.run(query)
+
+    async def list_finished(self, limit: int = 5):
         """Get a list of running jobs.
 
         Args:
@@ -274,79 +1263,529 @@ class PyBSdaemon:
             List of dictionaries with job infos.
         """
 
-        # get session
-        with self._db() as session:
-            # do query
+        def query(session):
             jobs = session \
-                .query(Job) \
-                .filter(Job.started != None, Job.finished != None) \
+                .query(*self._list_columns()) \
+                .filter(Job.finished != None) \
                 .order_by(Job.finished.desc())\
                 .limit(limit)
-
-            # return list
             return self._list(jobs)
 
-    def _list(self, jobs: Query) -> list:
+        # do query and return list
+        return await self._db.run(query)
+
+    async def status(self, finished: int = 5, limit: int = None) -> dict:
+        """Get running, waiting and recently finished jobs plus CPU usage at once.
+
+        All jobs are fetched in a single query, so that they form a consistent snapshot, i.e. a job that finishes in
+        the meantime never shows up as both running and finished.
+
+        Args:
+            finished: Maximum number of finished jobs to return.
+            limit: Maximum number of running and of waiting jobs to return, the first ones to start or that started
+                first. If None, all are returned.
+
+        Returns:
+            Dictionary with lists of running, waiting, and finished jobs, the total number of running and waiting
+            jobs, the number of used and total CPUs and the used and total memory on this node, and the capacity of
+            all nodes that reported recently.
+        """
+
+        def query(session):
+            # IDs of recently finished jobs, wrapped in a derived table, since MySQL doesn't allow LIMIT in IN
+            recent = session.query(Job.id) \
+                .filter(Job.finished != None) \
+                .order_by(Job.finished.desc()) \
+                .limit(finished) \
+                .subquery()
+            selected = [Job.id.in_(session.query(recent.c.id))]
+
+            # all unfinished jobs or only the first ones of both states
+            if limit is None:
+                selected.append(Job.state.in_([JobState.waiting, JobState.running]))
+            else:
+                for state, order in [(JobState.running, 'started'), (JobState.waiting, 'queue')]:
+                    first = session.query(Job.id) \
+                        .filter(Job.state == state) \
+                        .order_by(*self._list_order(order)) \
+                        .limit(limit) \
+                        .subquery()
+                    selected.append(Job.id.in_(session.query(first.c.id)))
+
+            # fetch them all at once
+            jobs = session \
+                .query(*self._list_columns()) \
+                .filter(or_(*selected))
+
+            # total number of unfinished jobs
+            counts = session \
+                .query(Job.state, func.count()) \
+                .filter(Job.state.in_([JobState.waiting, JobState.running])) \
+                .group_by(Job.state)
+
+            # nodes that reported recently
+            alive = datetime.datetime.now() - datetime.timedelta(seconds=3 * self._heartbeat_interval)
+            nodes = [{'name': node.name, 'ncpus': node.ncpus, 'used_cpus': node.used_cpus}
+                     for node in session.query(Node).filter(Node.heartbeat >= alive).order_by(Node.name)]
+            return self._list(jobs), {state.value: count for state, count in counts}, nodes
+
+        # do query
+        jobs, counts, nodes = await self._db.run(query)
+
+        # sort jobs like list_running(), list_waiting(), and list_finished() do
+        running = sorted([j for j in jobs if j['state'] == JobState.running.value], key=lambda j: j['started'] or 0)
+        waiting = sorted([j for j in jobs if j['state'] == JobState.waiting.value],
+                         key=lambda j: (-j['priority'], j['submitted'] or 0, j['id']))
+        done = sorted([j for j in jobs if j['finished'] is not None], key=lambda j: j['finished'], reverse=True)
+
+        # return it together with CPU and memory usage
+        used_cpus, ncpus = self.get_cpus()
+        used_mem, mem = self.get_mem()
+        return {'running': running, 'waiting': waiting, 'finished': done[:finished],
+                'counts': {state: counts.get(state, 0) for state in ('running', 'waiting')},
+                'used_cpus': used_cpus, 'ncpus': ncpus, 'used_mem': used_mem, 'mem': mem, 'nodes': nodes}
+
+    async def accounting(self, user: str = None, since: float = None, group_by: str = 'username') -> list:
+        """Get the resources consumed by finished jobs, including those moved to the history, aggregated per user.
+
+        Args:
+            user: Only include jobs of this user.
+            since: Only include jobs that finished after this UNIX timestamp.
+            group_by: Either "username" or "name" for aggregating per user or per job name.
+
+        Returns:
+            List of dictionaries with number of jobs and failed jobs, total CPU times, peak RSS, and I/O bytes, for
+            each user or job name, the one with the most consumed CPU time first.
+        """
+
+        # check grouping
+        if group_by not in ('username', 'name'):
+            raise ValueError('Cannot group by %s.' % group_by)
+        since = None if since is None else datetime.datetime.fromtimestamp(since)
+
+        def query(session):
+            # finished jobs from both tables
+            selects = []
+            for table in (Job, JobHistory):
+                select = session.query(getattr(table, group_by).label('key'),
+                                       *[getattr(table, c).label(c) for c in ('state',) + USAGE_COLUMNS]) \
+                    .filter(table.finished != None)
+                if user is not None:
+                    select = select.filter(table.username == user)
+                if since is not None:
+                    select = select.filter(table.finished >= since)
+                selects.append(select)
+            jobs = selects[0].union_all(selects[1]).subquery()
+
+            # aggregate them
+            cpu = func.coalesce(func.sum(jobs.c.cpu_user), 0) + func.coalesce(func.sum(jobs.c.cpu_system), 0)
+            rows = session \
+                .query(jobs.c.key, func.count(), func.sum(case((jobs.c.state == JobState.failed, 1), else_=0)),
+                       func.sum(jobs.c.cpu_user), func.sum(jobs.c.cpu_system), func.max(jobs.c.max_rss),
+                       func.sum(jobs.c.io_read), func.sum(jobs.c.io_write)) \
+                .group_by(jobs.c.key) \
+                .order_by(cpu.desc(), jobs.c.key)
+
+            # some databases return sums as decimals, which cannot be sent as JSON
+            def number(value, cls):
+                return None if value is None else cls(value)
+
+            return [{group_by: key, 'jobs': count, 'failed': int(failed or 0), 'cpu_user': number(cpu_user, float),
+                     'cpu_system': number(cpu_system, float), 'max_rss': number(max_rss, int),
+                     'io_read': number(io_read, int), 'io_write': number(io_write, int)}
+                    for key, count, failed, cpu_user, cpu_system, max_rss, io_read, io_write in rows]
+
+        # do query
+        return await self._db.run(query)
+
+    async def list_jobs(self, user: str = None, state=None, name: str = None, node: str = None, columns: list = None,
+                        order: str = 'id', after: list = None, limit: int = 100, count: bool = False) -> dict:
+        """Get a page of the jobs matching the given filters, with only the requested columns.
+
+        Pages are fetched by keyset instead of an offset: every page ends with a cursor, which is passed as "after"
+        for fetching the next one. So a page deep down a long queue is as fast as the first one, and no jobs are
+        skipped or repeated, when others start or finish in the meantime.
+
+        Args:
+            user: Only jobs of this user.
+            state: Only jobs in this state or in one of the states in this list.
+            name: Only jobs whose name matches this pattern, in which * and ? are wildcards.
+            node: Only jobs running or run on this node.
+            columns: Columns to return, see LIST_COLUMNS. If None, all are returned.
+            order: Order of jobs, either "id", "queue" for the order waiting jobs are started in, "started" or
+                "finished" for the latest first. The latter two skip jobs that have not started or finished yet.
+            after: Cursor returned with the previous page.
+            limit: Maximum number of jobs in page, at most MAX_LIST_LIMIT.
+            count: If True, only count the matching jobs.
+
+        Returns:
+            Dictionary with list of jobs and the cursor for the next page, which is None for the last page. If count
+            is set, the total number of matching jobs and the number of them in each state instead.
+        """
+
+        # check parameters
+        columns = LIST_COLUMNS if columns is None else tuple(columns)
+        unknown = set(columns) - set(LIST_COLUMNS)
+        if unknown:
+            raise ValueError('Unknown columns: %s.' % ', '.join(sorted(unknown)))
+        if order not in LIST_ORDERS:
+            raise ValueError('Cannot sort by %s.' % order)
+        if after is not None:
+            after = self._parse_cursor(order, after)
+        if not 0 < limit <= MAX_LIST_LIMIT:
+            raise ValueError('Limit must be between 1 and %d.' % MAX_LIST_LIMIT)
+        states = None if state is None else [JobState(s) for s in ([state] if isinstance(state, str) else state)]
+
+        # filters
+        criteria = []
+        if user is not None:
+            criteria.append(Job.username == user)
+        if states is not None:
+            criteria.append(Job.state.in_(states))
+        if name is not None:
+            criteria.append(self._name_filter(name))
+        if node is not None:
+            criteria.append(Job.node == node)
+
+        def count_jobs(session):
+            counts = session \
+                .query(Job.state, func.count()) \
+                .filter(*criteria) \
+                .group_by(Job.state)
+            counts = {s.value: c for s, c in counts}
+            return {'count': sum(counts.values()), 'states': counts}
+
+        def query(session):
+            # sort keys must be set, for comparing them with the cursor
+            keys = [key for key, _ in LIST_ORDERS[order]]
+            filters = criteria + [getattr(Job, key) != None for key in keys[:-1]]
+            if after is not None:
+                filters.append(self._after_cursor(order, after))
+
+            # fetch requested columns plus sort keys, and one more job to find out whether there is another page
+            names = columns + tuple(key for key in keys if key not in columns)
+            rows = session \
+                .query(*self._list_columns(names)) \
+                .filter(*filters) \
+                .order_by(*self._list_order(order)) \
+                .limit(limit + 1) \
+                .all()
+
+            # cursor is built from sort keys of last job in page
+            cursor = None
+            if len(rows) > limit:
+                rows = rows[:limit]
+                last = dict(zip(names, rows[-1]))
+                cursor = [last[key].isoformat() if isinstance(last[key], datetime.datetime) else last[key]
+                          for key in keys]
+            return {'jobs': self._list(rows, columns), 'next': cursor}
+
+        # do query
+        return await self._db.run(count_jobs if count else query)
+
+    @staticmethod
+    def _name_filter(pattern: str):
+        """Build filter for job names matching a pattern, in which * and ? are wildcards.
+
+        Args:
+            pattern: Pattern to match.
+
+        Returns:
+            Filter expression.
+        """
+
+        # without wildcards, the index on the name can be used directly
+        if '*' not in pattern and '?' not in pattern:
+            return Job.name == pattern
+
+        # otherwise, translate to LIKE
+        like = pattern.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_').replace('*', '%').replace('?', '_')
+        return Job.name.like(like, escape='\\')
+
+    @staticmethod
+    def _list_columns(columns: tuple = LIST_COLUMNS) -> list:
+        """Get the columns of the job table with the given names.
+
+        Args:
+            columns: Names of columns.
+
+        Returns:
+            List of columns for querying them without loading whole jobs.
+        """
+        return [getattr(Job, c) for c in columns]
+
+    @staticmethod
+    def _list_order(order: str) -> list:
+        """Get the ORDER BY clauses for an order of a listing.
+
+        Args:
+            order: Name of order in LIST_ORDERS.
+
+        Returns:
+            List of clauses.
+        """
+        return [getattr(Job, key).desc() if desc else getattr(Job, key).asc() for key, desc in LIST_ORDERS[order]]
+
+    @staticmethod
+    def _parse_cursor(order: str, cursor) -> list:
+        """Check that a cursor fits an order and convert its dates.
+
+        Args:
+            order: Name of order in LIST_ORDERS.
+            cursor: Values of sort keys of last job in previous page, dates in ISO format.
+
+        Returns:
+            Values of sort keys.
+
+        Raises:
+            ValueError: If cursor does not fit order.
+        """
+
+        # one value for every sort key
+        keys = LIST_ORDERS[order]
+        if not isinstance(cursor, list) or len(cursor) != len(keys):
+            raise ValueError('Invalid cursor.')
+
+        # dates are given as strings, all other keys are integers
+        values = []
+        for (key, _), value in zip(keys, cursor):
+            if isinstance(getattr(Job, key).type, DateTime):
+                try:
+                    value = datetime.datetime.fromisoformat(value)
+                except (TypeError, ValueError):
+                    raise ValueError('Invalid cursor.')
+            elif not isinstance(value, int) or isinstance(value, bool):
+                raise ValueError('Invalid cursor.')
+            values.append(value)
+        return values
+
+    @staticmethod
+    def _after_cursor(order: str, cursor: list):
+        """Build filter for jobs that come after the one a cursor was built from.
+
+        Args:
+            order: Name of order in LIST_ORDERS.
+            cursor: Values of sort keys of last job in previous page, as returned by _parse_cursor().
+
+        Returns:
+            Filter expression.
+        """
+
+        # (a, b, c) > (x, y, z) is expanded to a > x OR (a = x AND (b > y OR (b = y AND c > z)))
+        condition = None
+        for (key, desc), value in reversed(list(zip(LIST_ORDERS[order], cursor))):
+            column = getattr(Job, key)
+            beyond = column < value if desc else column > value
+            condition = beyond if condition is None else or_(beyond, and_(column == value, condition))
+
+        # the same for the first key alone, which lets the database seek directly to the start of the page
+        return and_(column <= value if desc else column >= value, condition)
+
+    def _list(self, rows, columns: tuple = LIST_COLUMNS) -> list:
         """Get a list of jobs.
 
         Args:
-            jobs: Query to execute.
+            rows: Rows of a query for the given columns, further columns in the rows are ignored.
+            columns: Names of queried columns.
 
         Returns:
             List of dictionaries with job infos.
         """
+
+        # dates are sent as timestamps, states as their values, and filenames with the root directory
+        def timestamp(value):
+            return value.timestamp()
+
+        convert = {'submitted': timestamp, 'started': timestamp, 'finished': timestamp,
+                   'state': lambda value: value.value, 'filename': lambda value: os.path.join(self._root_dir, value)}
+        converters = [convert.get(c) for c in columns]
+
+        # convert all rows
         data = []
-        for job in jobs:
-            data.append({
-                'id': job.id,
-                'name': job.name,
-                'username': job.username,
-                'ncpus': job.ncpus,
-                'priority': job.priority,
-                'nodes': job.nodes,
-                'filename': os.path.join(self._root_dir, job.filename),
-                'started': None if job.started is None else job.started.timestamp(),
-                'finished': None if job.finished is None else job.finished.timestamp()
-            })
+        with self._tracer.span('PyBSdaemon._list'):
+            for row in rows:
+                data.append({c: value if f is None or value is None else f(value)
+                             for c, f, value in zip(columns, converters, row)})
         return data
 
-    def submit(self, filename: str, user: str) -> dict:
+    async def submit(self, filename: str, user: str, depend: str = None) -> dict:
         """Submit a new script to the queue.
 
         Args:
             filename: Name of file to submit.
             user: Name of user that submitted job.
+            depend: Dependencies like "afterok:123", overriding those in the PBS header.
+
+        Returns:
+            Dictionary with new job ID, for array jobs also the ID of the array and the IDs of all tasks.
+        """
+
+        # add job
+        job_ids, array_ids = await self._db.run(self._add_jobs, [filename], user, depend)
+        self._metrics.jobs.inc(len(job_ids), state=JobState.waiting.value)
+
+        # log it
+        log.info('Submitted new job %s with ID %d.', filename, job_ids[0])
+
+        # try to start it
+        self._schedule()
+
+        # return ID of new job
+        if array_ids:
+            return {'id': job_ids[0], 'array_id': array_ids[0], 'ids': job_ids}
+        return {'id': job_ids[0]}
+
+    async def submit_many(self, filenames: list, user: str, depend: str = None) -> dict:
+        """Submit several scripts to the queue at once.
+
+        Args:
+            filenames: Names of files to submit.
+            user: Name of user that submitted jobs.
+            depend: Dependencies like "afterok:123" for all jobs, overriding those in the PBS headers.
+
+        Returns:
+            Dictionary with IDs of new jobs, including all tasks of array jobs.
+        """
+
+        # add jobs
+        job_ids, array_ids = await self._db.run(self._add_jobs, filenames, user, depend)
+        self._metrics.jobs.inc(len(job_ids), state=JobState.waiting.value)
+
+        # log it
+        log.info('Submitted %d new jobs from %d files.', len(job_ids), len(filenames))
+
+        # try to start them
+        self._schedule()
+
+        # return IDs of new jobs
+        return {'ids': job_ids}
+
+    def _add_jobs(self, session: 'Session', filenames: list, user: str, depend: str = None) -> (list, list):
+        """Add jobs for the given scripts to the database, expanding array jobs into their tasks.
+
+        Tasks of array jobs are inserted in bulk, without creating an object for each of them.
+
+        Args:
+            session: Database session to use.
+            filenames: Names of files to submit.
+            user: Name of user that submitted jobs.
+            depend: Dependencies like "afterok:123", overriding those in the PBS headers.
 
         Returns:
-            Dictionary with new job ID.
+            Tuple of lists with IDs of all new jobs and of new array jobs.
         """
 
-        # file exists?
-        if not os.path.exists(filename):
-            raise ValueError('File does not exist.')
+        job_ids, array_ids = [], []
+        max_mem = self._max_node_mem(session)
+        for filename in filenames:
+            # file exists?
+            if not os.path.exists(filename):
+                raise ValueError('File %s does not exist.' % filename)
 
-        # get session
-        with self._db() as session:
             # create job
-            job = Job.from_file(filename)
+            with self._tracer.span('Job.parse_pbs_header'):
+                header = Job.parse_pbs_header(filename)
+            job = Job.from_file(filename, header)
+
+            # would wait forever, if it does not fit on any node
+            if job.mem is not None and max_mem is not None and job.mem > max_mem:
+                raise ValueError('Job %s requests more memory than any node has.' % filename)
 
             # set username and filename
             job.username = user
             job.filename = os.path.relpath(filename, self._root_dir)
 
-            # add to database
-            session.add(job)
+            # single job?
+            if 'array' not in header:
+                session.add(job)
+                session.flush()
+                job_ids.append(job.id)
+                self._add_dependencies(session, [job.id], depend or header.get('depend'))
+                continue
+
+            # create array job
+            indices = JobArray.parse_indices(header['array'])
+            array = JobArray(name=job.name, username=user, filename=job.filename, indices=header['array'],
+                             submitted=job.submitted)
+            session.add(array)
             session.flush()
-            jobid = job.id
+            array_ids.append(array.id)
+
+            # insert its tasks, using the job as template
+            session.execute(Job.__table__.insert(), [{
+                'name': '%s[%d]' % (job.name[:90], index), 'username': user, 'filename': job.filename,
+                'ncpus': job.ncpus, 'mem': job.mem, 'walltime': job.walltime, 'priority': job.priority,
+                'nodes': job.nodes, 'submitted': job.submitted,
+                'state': JobState.waiting, 'array_id': array.id, 'array_index': index, 'header': job.header
+            } for index in indices])
+
+            # get their IDs and add allowed nodes
+            task_ids = [t.id for t in session.query(Job.id)
+                        .filter(Job.array_id == array.id)
+                        .order_by(Job.array_index)]
+            if job.nodes is not None:
+                session.execute(JobNode.__table__.insert(), [{'job_id': task_id, 'node': n.node}
+                                                             for task_id in task_ids for n in job.allowed_nodes])
+            self._add_dependencies(session, task_ids, depend or header.get('depend'))
+            job_ids.extend(task_ids)
+
+        # return IDs
+        return job_ids, array_ids
+
+    def _max_node_mem(self, session: 'Session') -> int:
+        """Get the largest memory for jobs on any node.
 
-            # log it
-            log.info('Submitted new job %s with ID %d.', filename, jobid)
+        Args:
+            session: Database session to use.
 
-        # return ID of new job
-        return {'id': jobid}
+        Returns:
+            Memory in bytes or None, if any node does not take memory into account.
+        """
+
+        # this node might not have sent a heartbeat yet
+        mems = [mem for mem, in session.query(Node.mem)] + [self._mem]
+        return None if None in mems else max(mems)
 
-    def remove(self, job_id: int) -> dict:
-        """Remove an existing job.
+    @staticmethod
+    def _add_dependencies(session: 'Session', job_ids: list, depend: str):
+        """Add dependencies for new jobs, skipping those that are satisfied already.
+
+        Must be called after the new jobs have been written, so that, at least on sqlite, no job can finish between
+        checking its state and adding the dependency. On other databases, the row of the job is locked instead.
+
+        Args:
+            session: Database session to use.
+            job_ids: IDs of new jobs.
+            depend: Dependencies like "afterok:123" or None.
+        """
+
+        # no dependencies?
+        if not depend:
+            return
+
+        # check all of them
+        dependencies = {}
+        for dep_type, job_id in JobDependency.parse(depend):
+            # get state of job, which might have been moved to the history already
+            job = session.query(Job.state).filter(Job.id == job_id).with_for_update().first() or \
+                session.query(JobHistory.state).filter(JobHistory.id == job_id).first()
+            if job is None:
+                raise ValueError('Job %d to depend on not found.' % job_id)
+
+            # not finished yet?
+            if job.state not in FINISHED_STATES:
+                dependencies[job_id] = dep_type
+            elif job.state not in JobDependency.TYPES[dep_type]:
+                raise ValueError('Dependency %s:%d can never be satisfied.' % (dep_type, job_id))
+
+        # add remaining ones
+        if dependencies:
+            session.execute(JobDependency.__table__.insert(), [
+                {'job_id': job_id, 'depends_on': depends_on, 'type': dep_type}
+                for job_id in job_ids for depends_on, dep_type in dependencies.items()])
+
+    async def remove(self, job_id: int) -> dict:
+        """Cancel a waiting or running job.
 
         Args:
             job_id: ID of job to remove.
@@ -355,30 +1794,42 @@ class PyBSdaemon:
             Dictionary with success message.
         """
 
-        # get job
-        with self._db() as session:
+        def cancel_job(session):
             # get job
             job = session.query(Job).filter(Job.id == job_id).first()
             if job is None:
                 # could not find job in DB
                 raise ValueError('Job not found.')
-            ncpus = job.ncpus
-
-            # delete it
-            log.info('Deleting job %d...', job_id)
-            session.delete(job)
-
-        # got a running process?
+            if job.state in FINISHED_STATES:
+                raise ValueError('Job already finished.')
+
+            # cancel it and update dependent jobs
+            state = job.state
+            job.state = JobState.cancelled
+            job.finished = datetime.datetime.now()
+            session.query(JobDependency).filter(JobDependency.job_id == job_id).delete(synchronize_session=False)
+            self._resolve_dependencies(session, job_id, JobState.cancelled)
+            return state
+
+        # cancel job
+        log.info('Cancelling job %d...', job_id)
+        state = await self._db.run(cancel_job)
+        self._metrics.jobs.inc(-1, state=state.value)
+        self._metrics.jobs_finished.inc(state=JobState.cancelled.value)
+
+        # got a running process? CPUs are released, when all its processes are gone
         if job_id in self._processes:
-            # kill job
-            log.info('Killing running process for job %s...', job_id)
-            self._processes[job_id].kill()
+            log.info('Terminating running processes for job %s...', job_id)
+            self._terminate_job(job_id)
+
+        # queue has changed
+        self._schedule()
 
         # send success
         return {'success': True}
 
-    def run(self, job_id: int) -> dict:
-        """Start a waiting job now.
+    async def run(self, job_id: int) -> dict:
+        """Start a waiting job now, even if not enough CPUs, memory, or cores are free.
 
         Args:
             job_id: ID of job to start.
@@ -387,20 +1838,26 @@ class PyBSdaemon:
             Dictionary with success message.
         """
 
-        # get job
-        with self._db() as session:
+        def claim_job(session):
             # get job
             job = session.query(Job).filter(Job.id == job_id).first()
             if job is None:
                 # could not find job in DB
-                ValueError('Job not found.')
+                raise ValueError('Job not found.')
 
-            # set started
-            job.started = datetime.datetime.now()
-            session.flush()
+            # set started, unless it has been started in the meantime
+            if job.state != JobState.waiting or not self._claim_job(session, job_id, datetime.datetime.now()):
+                raise ValueError('Job already started.')
+            return job.ncpus, job.mem
+
+        # claim job and reserve CPUs, memory, and cores, even if not enough are free, since the job is started now on
+        # purpose, so the node may be overcommitted, and the job is not pinned, if not enough cores are free
+        ncpus, mem = await self._db.run(claim_job)
+        self._jobs_started(1)
+        self._reserve(job_id, ncpus, mem, self._assign_cores(ncpus))
 
-            # and finally start job
-            asyncio.ensure_future(self._run_job(job.id))
+        # and finally start job
+        asyncio.ensure_future(self._run_job(job_id))
 
         # send success
         return {'success': True}
@@ -411,7 +1868,15 @@ class PyBSdaemon:
         Returns:
             Tuple of currently occupied and total number of CPUs.
         """
-        return self._used_cpus, self._ncpus
+        return self._get_used_cpus(), self._ncpus
+
+    def get_mem(self) -> (int, int):
+        """Returns the currently requested and the total memory for jobs on this host.
+
+        Returns:
+            Tuple of currently requested and total memory in bytes, the latter None if memory is not tracked.
+        """
+        return self._get_used_mem(), self._mem
 
     def config(self) -> dict:
         """Returns current configuration.
@@ -420,7 +1885,8 @@ class PyBSdaemon:
             Dictionary with current configuration.
         """
         return {
-            'ncpus': self._ncpus
+            'ncpus': self._ncpus,
+            'mem': self._mem
         }
 
     def setconfig(self, key: str, value: str) -> dict:
@@ -437,46 +1903,69 @@ class PyBSdaemon:
         # check key
         if key == 'ncpus':
             self._ncpus = int(value)
+        elif key == 'mem':
+            self._mem = None if value.lower() in ('', 'none') else Job.parse_size(value)
         else:
             raise ValueError('Unknown parameter %s' % key)
 
+        # available resources might have changed
+        self._schedule()
+
         # send success
         return {'success': True}
 
-    def _send_message(self, header: dict, job: 'Job', return_code: int, outs: list, errs: list):
-        """Send message to wherever is requested.
+    async def profile(self, seconds: float = 10., limit: int = 30, sort: str = 'cumulative') -> dict:
+        """Profile the daemon for a while.
+
+        Args:
+            seconds: Duration of profile in seconds.
+            limit: Maximum number of functions to return.
+            sort: Sort functions by "cumulative" or "tottime".
+
+        Returns:
+            Dictionary with the top functions from cProfile, and the number of calls and the total and maximum
+            duration of all spans and of all database queries per operation.
+        """
+        log.info('Profiling daemon for %gs...', seconds)
+        return await self._tracer.profile(seconds, limit, sort)
+
+    @staticmethod
+    def _compose_message(header: dict, job: 'Job', return_code: int, outs: list, errs: list) -> tuple:
+        """Compose message for a finished job, if one is requested.
 
         Args:
             header: PBS header for job.
             job: The database entry for the job.
             return_code: Return code from the script.
-            outs: Output lines from job script.
-            errs: Error lines from job script.
+            outs: Last lines of output from job script.
+            errs: Last lines of error output from job script.
+
+        Returns:
+            Tuple of channel, recipient, subject, and body for Notifier.notify() or None, if no message is requested.
         """
 
         # was a message requested for this return code?
-        mode = header['send_mail']
-        if ('e' not in mode and return_code == 0) or ('a' not in mode and return_code != 0):
-            return
+        mode = header.get('send_mail')
+        if mode is None or ('e' not in mode and return_code == 0) or ('a' not in mode and return_code != 0):
+            return None
 
         # out and err
         out, err = None, None
         if outs is not None and errs is not None:
-            out = '\n'.join(outs.decode('utf-8').split('\n')[-10:])
-            err = '\n'.join(errs.decode('utf-8').split('\n')[-10:])
+            out = '\n'.join(outs)
+            err = '\n'.join(errs)
 
         # compile body
         body = MAIL_BODY.format(job.id, job.name, job.submitted, job.started, job.finished, job.filename,
                                 return_code, out, err)
 
-        # send email?
+        # send email or Slack message?
+        subject = 'PyBS JOB {0} {1} {2}'.format(job.id, job.name, 'finished' if return_code == 0 else 'failed')
         if 'email' in header:
-            log.info('Sending email to %s...', header['email'])
-            subject = 'PyBS JOB {0} {1} {2}'.format(job.id, job.name, 'finished' if return_code == 0 else 'failed')
-            self._mailer.send(to=header['email'], subject=subject, body=body)
+            return 'email', header['email'], subject, body
         elif 'slack' in header:
-            log.info('Sending Slack message to #%s...', header['slack'])
-            self._slack.send(to=header['slack'], body=body)
+            return 'slack', header['slack'], subject, body
+        return None
 
 
 __all__ = ['PyBSdaemon']
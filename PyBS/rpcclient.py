@@ -1,6 +1,8 @@
 import asyncio
 import json
 
+from .rpcserver import MAX_MESSAGE_SIZE
+
 
 class RpcError(Exception):
     """Exception for all RPC errors."""
@@ -13,6 +15,8 @@ class RpcClient:
     def __init__(self, host: str = 'localhost', port: int = 16219):
         """Create a new RPC client.
 
+        The connection to the server is opened on the first call and then used for all further calls.
+
         Args:
             host: Hostname of server.
             port: Port on server to connect to.
@@ -20,6 +24,10 @@ class RpcClient:
         self._cur_id = 1
         self._host = host
         self._port = port
+        self._reader = None
+        self._writer = None
+        self._read_task = None
+        self._pending = {}
 
     def __call__(self, command: str, **kwargs):
         """Calls a command on the server.
@@ -37,6 +45,49 @@ class RpcClient:
         result = loop.run_until_complete(self._send_command(command, **kwargs))
         return result
 
+    def pipeline(self, calls: list) -> list:
+        """Calls several commands on the server in a single batch.
+
+        Args:
+            calls: List of tuples with name of command and dictionary of parameters.
+
+        Returns:
+            List of results of commands.
+        """
+
+        # get event loop, run commands and return results
+        loop = asyncio.get_event_loop()
+        return loop.run_until_complete(self._send_commands(calls))
+
+    def stream(self, command: str, **kwargs):
+        """Calls a command on the server that streams its results.
+
+        Args:
+            command: Name of command to run.
+            **kwargs: Parameters for command
+
+        Yields:
+            Results streamed by command.
+        """
+
+        # get event loop and iterate over results
+        loop = asyncio.get_event_loop()
+        results = self._stream_command(command, **kwargs)
+        try:
+            while True:
+                try:
+                    yield loop.run_until_complete(results.__anext__())
+                except StopAsyncIteration:
+                    break
+        finally:
+            loop.run_until_complete(results.aclose())
+
+    def close(self):
+        """Close connection to server."""
+        if self._writer is not None:
+            self._writer.close()
+            self._reader, self._writer = None, None
+
     async def _send_command(self, command: str, **kwargs):
         """Actually send a command to the server and wait for results.
 
@@ -47,30 +98,148 @@ class RpcClient:
         Returns:
             Result of command.
         """
+        results = await self._send_commands([(command, kwargs)])
+        return results[0]
+
+    async def _send_commands(self, calls: list) -> list:
+        """Actually send several commands to the server at once and wait for all results.
+
+        Args:
+            calls: List of tuples with name of command and dictionary of parameters.
+
+        Returns:
+            List of results of commands.
+        """
+
+        # send commands
+        ids = await self._send(calls)
 
-        # open connection
-        reader, writer = await asyncio.open_connection(self._host, self._port)
+        try:
+            # wait for all replies
+            replies = []
+            for i in ids:
+                replies.append(await self._receive(i))
+                del self._pending[i]
+        finally:
+            for i in ids:
+                self._pending.pop(i, None)
 
-        # build message
-        message = {
-            'jsonrpc': '2.0',
-            'method': command,
-            'params': kwargs,
-            'id': self._cur_id
-        }
-        self._cur_id += 1
+        # decode them
+        return [self._decode(rpc) for rpc in replies]
+
+    async def _stream_command(self, command: str, **kwargs):
+        """Actually send a command to the server and yield all streamed results.
+
+        Args:
+            command: Name of command to run.
+            **kwargs: Parameters for command
+
+        Yields:
+            Results streamed by command.
+        """
 
         # send command
-        writer.write((json.dumps(message) + '\n').encode())
+        rpc_id, = await self._send([(command, kwargs)])
+
+        try:
+            while True:
+                # wait for next message
+                rpc = await self._receive(rpc_id)
+
+                # streamed result or final reply?
+                if rpc.get('method') == 'stream':
+                    yield rpc['params']['result']
+                else:
+                    self._decode(rpc)
+                    break
+
+        finally:
+            del self._pending[rpc_id]
+
+    async def _send(self, calls: list) -> list:
+        """Send commands to the server, opening a connection if necessary.
+
+        Args:
+            calls: List of tuples with name of command and dictionary of parameters.
 
-        # wait for reply
-        data = await reader.readline()
+        Returns:
+            List of IDs of sent commands.
+        """
 
-        # close socket
-        writer.close()
+        # open connection, if not open yet
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(self._host, self._port,
+                                                                       limit=MAX_MESSAGE_SIZE)
+
+        # build messages and wait for replies
+        ids, messages = [], []
+        for command, params in calls:
+            messages.append({
+                'jsonrpc': '2.0',
+                'method': command,
+                'params': params,
+                'id': self._cur_id
+            })
+            self._pending[self._cur_id] = asyncio.Queue()
+            ids.append(self._cur_id)
+            self._cur_id += 1
+
+        # send commands, several of them as a batch
+        self._writer.write((json.dumps(messages[0] if len(messages) == 1 else messages) + '\n').encode())
+        await self._writer.drain()
+        return ids
+
+    async def _receive(self, rpc_id: int) -> dict:
+        """Wait for the next message for the given command.
+
+        Args:
+            rpc_id: ID of command.
+
+        Returns:
+            Next message from server for command.
+        """
 
-        # decode data
-        rpc = json.loads(data.decode())
+        # make sure that someone is reading from the server
+        queue = self._pending[rpc_id]
+        if queue.empty() and (self._read_task is None or self._read_task.done()):
+            self._read_task = asyncio.ensure_future(self._read_loop())
+
+        # wait for message
+        return await queue.get()
+
+    async def _read_loop(self):
+        """Read messages from the server and pass them on to the commands, until none is waiting anymore."""
+        try:
+            while any(queue.empty() for queue in self._pending.values()):
+                # read next message
+                data = await self._reader.readline()
+                if not data:
+                    raise ConnectionError
+
+                # replies to a batch come in a list
+                rpcs = json.loads(data.decode())
+                for rpc in rpcs if isinstance(rpcs, list) else [rpcs]:
+                    # find command it belongs to, streamed results carry the ID in their parameters
+                    rpc_id = rpc['params']['id'] if rpc.get('method') == 'stream' else rpc.get('id')
+                    if rpc_id in self._pending:
+                        self._pending[rpc_id].put_nowait(rpc)
+
+        except (ConnectionError, ValueError):
+            # connection is gone or broken, so let all waiting commands fail
+            self.close()
+            for queue in self._pending.values():
+                queue.put_nowait({'error': {'message': 'Connection to server closed.'}})
+
+    @staticmethod
+    def _decode(rpc: dict):
+        """Decode a reply from the server.
+
+        Args:
+            rpc: Reply from server.
+
+        Returns:
+            Result of command.
+        """
 
         # got an error?
         if 'error' in rpc:
@@ -1,25 +1,42 @@
 import asyncio
+import contextlib
+import inspect
 import json
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+
+# maximum size of a single message in bytes, which may contain thousands of jobs
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
 
 
 class RpcServer:
     """Server for remote procedure calls."""
 
-    def __init__(self, handler, port: int):
+    def __init__(self, handler, port: int, batch=None, metrics: 'Metrics' = None, tracer: 'Tracer' = None):
         """Creates a new RPC server.
 
         Args:
             handler: Object that implements the methods that this server serves.
             port: Port for clients to connect to.
+            batch: Optional function returning an asynchronous context manager, in which all requests of a batch are
+                handled.
+            metrics: If given, number and duration of requests are recorded there for every method.
+            tracer: If given, decoding and handling of requests are timed as spans.
         """
         self._handler = handler
+        self._metrics = metrics
+        self._tracer = tracer
         self._port = port
+        self._batch = batch
         self._server = None
 
     async def open(self):
         """Open server."""
         self._server = await asyncio.start_server(self.handle_request, '127.0.0.1', self._port,
-                                                  loop=asyncio.get_event_loop())
+                                                  limit=MAX_MESSAGE_SIZE)
 
     def close(self):
         """Close server."""
@@ -30,53 +47,213 @@ class RpcServer:
         await self._server.wait_closed()
 
     async def handle_request(self, reader, writer):
-        """Handle a request from a client.
+        """Handle all requests from a client until it closes the connection.
+
+        Requests are newline-delimited and handled concurrently, so responses may be sent in a different order and
+        need to be matched by their ID. When the client closes its side of the connection, all pending requests are
+        still finished and answered, only streams are stopped.
 
         Args:
             reader: Stream to read from.
             writer: Stream to write to.
         """
 
-        # read data and decode it
-        data = await reader.readline()
-        message = data.decode()
+        # only one response may be written at a time
+        lock = asyncio.Lock()
+        tasks, streams, eof = set(), set(), asyncio.Event()
+
+        try:
+            while True:
+                # read next request
+                data = await reader.readline()
+                if not data:
+                    break
+
+                # handle it in the background
+                task = asyncio.ensure_future(self._handle_message(data, writer, lock, streams, eof))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+        except ConnectionError:
+            # client went away
+            pass
+
+        finally:
+            try:
+                # streams would run forever, so stop them
+                eof.set()
+                for task in streams:
+                    task.cancel()
+
+                # but let all other requests finish, since they may have changed the state of the daemon already, and
+                # send their responses, if the client is still listening
+                if tasks:
+                    await asyncio.shield(asyncio.gather(*tasks, return_exceptions=True))
+
+            finally:
+                # close socket
+                writer.close()
+
+    async def _handle_message(self, data: bytes, writer, lock: asyncio.Lock, streams: set, eof: asyncio.Event):
+        """Handle a single request or a batch of requests and send the response.
+
+        Args:
+            data: Request to handle.
+            writer: Stream to write to.
+            lock: Lock for writing to stream.
+            streams: Tasks that are streaming results to the client.
+            eof: Set when the client has closed its side of the connection.
+        """
 
         # parse json
-        rpc = json.loads(message)
+        try:
+            with self._span('RpcServer.decode'):
+                rpc = json.loads(data.decode())
+        except ValueError:
+            res = {'jsonrpc': '2.0', 'error': {'code': -32700, 'message': 'Parse error'}, 'id': None}
+            await self._send(writer, lock, json.dumps(res))
+            return
+
+        # single request?
+        if not isinstance(rpc, list):
+            res = await self._call(rpc, writer, lock, streams, eof)
+            await self._send(writer, lock, json.dumps(res))
+            return
+
+        # empty batch
+        if len(rpc) == 0:
+            res = {'jsonrpc': '2.0', 'error': {'code': -32600, 'message': 'Invalid Request'}, 'id': None}
+            await self._send(writer, lock, json.dumps(res))
+            return
+
+        # handle all requests of batch concurrently and send all responses at once
+        calls = [self._call(r, writer, lock, streams, eof) for r in rpc]
+        if self._batch is None:
+            res = await asyncio.gather(*calls, return_exceptions=True)
+        else:
+            async with self._batch():
+                res = await asyncio.gather(*calls, return_exceptions=True)
+
+        # a failed or stopped request must not cost the others their responses
+        for i, r in enumerate(res):
+            if isinstance(r, BaseException):
+                if not isinstance(r, asyncio.CancelledError):
+                    log.error('Error in request %d of batch.', i, exc_info=r)
+                res[i] = {'jsonrpc': '2.0', 'error': {'code': -32603, 'message': 'Internal error'},
+                          'id': rpc[i].get('id') if isinstance(rpc[i], dict) else None}
+        await self._send(writer, lock, json.dumps(res))
+
+    async def _call(self, rpc, writer, lock: asyncio.Lock, streams: set, eof: asyncio.Event) -> dict:
+        """Call the method for a single request.
+
+        Args:
+            rpc: Parsed request.
+            writer: Stream to write streamed results to.
+            lock: Lock for writing to stream.
+            streams: Tasks that are streaming results to the client, the current one is added while streaming.
+            eof: Set when the client has closed its side of the connection.
+
+        Returns:
+            Response for request.
+        """
+
+        # check request
+        if not isinstance(rpc, dict) or 'method' not in rpc:
+            return {'jsonrpc': '2.0', 'error': {'code': -32600, 'message': 'Invalid Request'}, 'id': None}
 
         # get method on handler
         if not hasattr(self._handler, rpc['method']):
-            res = {'jsonrpc': '2.0', 'error': {'code': -32601, 'message': 'Method not found'}, 'id': rpc['id']}
-            await self._send(writer, json.dumps(res))
-            return
+            return {'jsonrpc': '2.0', 'error': {'code': -32601, 'message': 'Method not found'}, 'id': rpc.get('id')}
         method = getattr(self._handler, rpc['method'])
 
-        # call method
+        # check parameters against signature of method, so that a TypeError raised within it is not mistaken for them
+        params = rpc.get('params', {})
+        try:
+            if not isinstance(params, dict):
+                raise TypeError('Parameters must be given by name.')
+            inspect.signature(method).bind(**params)
+        except TypeError as e:
+            return {'jsonrpc': '2.0', 'error': {'code': -32602, 'message': 'Invalid params: %s' % str(e)},
+                    'id': rpc.get('id')}
+
+        # call method and wait for it, if it is a coroutine
+        start, status = time.perf_counter(), 'error'
         try:
-            result = method(**rpc['params'])
+            with self._span('rpc.%s' % rpc['method']):
+                result = method(**params)
+                if inspect.isawaitable(result):
+                    result = await result
+            status = 'ok'
         except ValueError as e:
-            res = {'jsonrpc': '2.0', 'error': {'code': -32603, 'message': str(e)}, 'id': rpc['id']}
-            await self._send(writer, json.dumps(res))
-            return
+            return {'jsonrpc': '2.0', 'error': {'code': -32603, 'message': str(e)}, 'id': rpc.get('id')}
+        except Exception:
+            log.exception('Error in RPC method %s.', rpc['method'])
+            return {'jsonrpc': '2.0', 'error': {'code': -32603, 'message': 'Internal error'}, 'id': rpc.get('id')}
+        finally:
+            if self._metrics is not None:
+                self._metrics.rpc_requests.inc(method=rpc['method'], status=status)
+                self._metrics.rpc_latency.observe(time.perf_counter() - start, method=rpc['method'])
+
+        # got a stream of results?
+        if inspect.isasyncgen(result):
+            # client closed its side of the connection already, so it would not be stopped
+            if eof.is_set():
+                await result.aclose()
+                return {'jsonrpc': '2.0', 'error': {'code': -32603, 'message': 'Connection closed.'},
+                        'id': rpc.get('id')}
+
+            # register stream, so that it can be stopped, when the client closes its side of the connection
+            task = asyncio.current_task()
+            streams.add(task)
+            try:
+                await self._stream(writer, lock, result, rpc.get('id'))
+            except ValueError as e:
+                return {'jsonrpc': '2.0', 'error': {'code': -32603, 'message': str(e)}, 'id': rpc.get('id')}
+            except ConnectionError:
+                # client went away, so nobody gets the response anyway
+                raise
+            except Exception:
+                log.exception('Error in streaming RPC method %s.', rpc['method'])
+                return {'jsonrpc': '2.0', 'error': {'code': -32603, 'message': 'Internal error'}, 'id': rpc.get('id')}
+            finally:
+                streams.discard(task)
+            result = True
 
-        # send response
-        res = {'jsonrpc': '2.0', 'result': result, 'id': rpc['id']}
-        await self._send(writer, json.dumps(res))
+        # return response
+        return {'jsonrpc': '2.0', 'result': result, 'id': rpc.get('id')}
 
-    async def _send(self, writer, message: str):
-        """Send a message to the client and close connection.
+    def _span(self, name: str):
+        """Returns a span for the tracer, if any."""
+        return contextlib.nullcontext() if self._tracer is None else self._tracer.span(name)
+
+    async def _stream(self, writer, lock: asyncio.Lock, results, rpc_id):
+        """Send all results yielded by an asynchronous generator as notifications to the client.
 
         Args:
             writer: Stream to write to.
-            message: Message to send.
+            lock: Lock for writing to stream.
+            results: Asynchronous generator yielding results.
+            rpc_id: ID of request.
         """
+        try:
+            async for result in results:
+                msg = {'jsonrpc': '2.0', 'method': 'stream', 'params': {'id': rpc_id, 'result': result}}
+                await self._send(writer, lock, json.dumps(msg))
+        finally:
+            # also stop generator if client went away
+            await results.aclose()
 
-        # send response
-        writer.write((message + '\n').encode())
-        await writer.drain()
+    async def _send(self, writer, lock: asyncio.Lock, message: str):
+        """Send a message to the client.
 
-        # close socket
-        writer.close()
+        Args:
+            writer: Stream to write to.
+            lock: Lock for writing to stream.
+            message: Message to send.
+        """
+        async with lock:
+            writer.write((message + '\n').encode())
+            await writer.drain()
 
 
-__all__ = ['RpcServer']
+__all__ = ['RpcServer', 'MAX_MESSAGE_SIZE']
@@ -0,0 +1,258 @@
+import datetime
+import time
+from sqlalchemy import case, func, literal_column
+from sqlalchemy.orm import Query, Session
+
+from .db import Job, JobHistory, JobState
+
+
+# consumed CPU time is aggregated in this many buckets per half-life, which are decayed as a whole
+FAIRSHARE_BUCKETS = 4
+
+
+class Scheduler:
+    """Scheduling policy that decides which waiting jobs to start next.
+
+    Without any options, jobs are started strictly by priority and submission time. Otherwise jobs are scored by
+    score(), which takes into account the priority of the job, how long it has been waiting, and how much CPU time its
+    user consumed recently, and users can be limited to a maximum number of CPUs in the whole cluster.
+
+    All decisions are made from aggregates that are fetched once per scheduling pass, or even less often for the
+    consumed CPU time, so that the costs do not depend on the number of waiting jobs. Derived classes can change the
+    policy by overriding score().
+    """
+
+    def __init__(self, user_cpu_limit: int = None, user_cpu_limits: dict = None, fairshare_halflife: float = None,
+                 fairshare_weight: float = 10., priority_aging: float = 0., usage_refresh: float = 60.):
+        """Creates a new scheduler.
+
+        Args:
+            user_cpu_limit: Maximum number of CPUs a single user can use in the whole cluster. If None, no limit.
+            user_cpu_limits: Dictionary with limits for single users, overriding user_cpu_limit.
+            fairshare_halflife: Half-life in hours for the consumed CPU time of users. If None, no fair-share.
+            fairshare_weight: Number of priority points a user loses, who consumed all of the recent CPU time.
+            priority_aging: Number of priority points a job gains for every hour it is waiting.
+            usage_refresh: Interval in seconds for refreshing the consumed CPU time of users from the database.
+        """
+        self._user_cpu_limit = user_cpu_limit
+        self._user_cpu_limits = {} if user_cpu_limits is None else user_cpu_limits
+        self._fairshare_halflife = fairshare_halflife
+        self._fairshare_weight = fairshare_weight
+        self._priority_aging = priority_aging
+        self._usage_refresh = usage_refresh
+
+        # aggregates
+        self._used_cpus = {}
+        self._usage = {}
+        self._last_usage_refresh = None
+
+    @property
+    def is_strict(self) -> bool:
+        """Whether jobs are started strictly by priority and submission time."""
+        return self._user_cpu_limit is None and not self._user_cpu_limits and self._fairshare_halflife is None and \
+            self._priority_aging == 0.
+
+    def user_cpu_limit(self, username: str) -> int:
+        """Returns the maximum number of CPUs for the given user.
+
+        Args:
+            username: Name of user.
+
+        Returns:
+            Maximum number of CPUs or None, if unlimited.
+        """
+        return self._user_cpu_limits.get(username, self._user_cpu_limit)
+
+    def pick(self, session: Session, query: Query, available_cpus: int, backfill: bool,
+             available_mem: int = None) -> list:
+        """Pick jobs to start from the given query.
+
+        Args:
+            session: Database session to use.
+            query: Query for waiting jobs that may be started on this node, ordered by priority and submission time.
+            available_cpus: Number of available CPUs.
+            backfill: If True, start smaller jobs when the next job in line does not fit.
+            available_mem: Available memory in bytes. If None, memory is not taken into account.
+
+        Returns:
+            List of tuples with ID, number of CPUs, and memory for all jobs to start, in the order they should be
+            started.
+        """
+
+        # every job needs at least one CPU, so we never start more jobs than we have CPUs
+        if self.is_strict:
+            candidates = query.with_entities(Job.id, Job.ncpus, Job.mem, Job.username).limit(available_cpus).all()
+        else:
+            candidates = self._candidates(session, query, available_cpus)
+
+        # pick as many as fit
+        picked = []
+        free_cpus, free_mem = available_cpus, available_mem
+        for job in candidates:
+            # user reached limit? then this job must not block the others
+            if not self._within_limit(job.username, job.ncpus):
+                continue
+
+            # does job fit? jobs without memory request never block
+            mem = job.mem or 0
+            if job.ncpus > free_cpus or (free_mem is not None and mem > free_mem):
+                if backfill:
+                    continue
+                break
+
+            # pick job
+            free_cpus -= job.ncpus
+            if free_mem is not None:
+                free_mem -= mem
+            if not self.is_strict:
+                self._used_cpus[job.username] = self._used_cpus.get(job.username, 0) + job.ncpus
+            picked.append((job.id, job.ncpus, mem))
+
+            # node full?
+            if free_cpus <= 0:
+                break
+        return picked
+
+    def score(self, job, now: datetime.datetime) -> float:
+        """Calculate the score of a waiting job, jobs with higher scores are started first.
+
+        Args:
+            job: Job with at least username, priority, and submitted.
+            now: Current time.
+
+        Returns:
+            Score of job.
+        """
+
+        # start with priority
+        score = float(job.priority)
+
+        # add aging
+        if self._priority_aging and job.submitted is not None:
+            score += self._priority_aging * (now - job.submitted).total_seconds() / 3600.
+
+        # subtract share of recently consumed CPU time
+        if self._fairshare_halflife is not None:
+            total = sum(self._usage.values())
+            if total > 0:
+                score -= self._fairshare_weight * self._usage.get(job.username, 0.) / total
+        return score
+
+    def _within_limit(self, username: str, ncpus: int) -> bool:
+        """Whether the given user may use the given number of additional CPUs."""
+        limit = self.user_cpu_limit(username)
+        return limit is None or self._used_cpus.get(username, 0) + ncpus <= limit
+
+    def _candidates(self, session: Session, query: Query, available_cpus: int) -> list:
+        """Fetch the first waiting jobs of every user and sort them by their score.
+
+        Args:
+            session: Database session to use.
+            query: Query for waiting jobs that may be started on this node.
+            available_cpus: Number of available CPUs.
+
+        Returns:
+            List of candidates.
+        """
+
+        # update aggregates
+        self._refresh(session)
+
+        # get users with waiting jobs, one after the other using the index, which is much faster than a DISTINCT
+        # on a long queue with only a few users
+        users = []
+        while True:
+            username = session.query(func.min(Job.username)) \
+                .filter(Job.state == JobState.waiting, Job.username > (users[-1] if users else '')) \
+                .scalar()
+            if username is None:
+                break
+            users.append(username)
+
+        # fetch first jobs of each user, who has not reached the limit yet, a single user can never start more jobs
+        # than we have CPUs
+        candidates = []
+        for username in users:
+            if not self._within_limit(username, 1):
+                continue
+            candidates.extend(query
+                              .with_entities(Job.id, Job.ncpus, Job.mem, Job.username, Job.priority, Job.submitted)
+                              .filter(Job.username == username)
+                              .limit(available_cpus)
+                              .all())
+
+        # sort them by score and, for equal scores, by submission
+        now = datetime.datetime.now()
+        return sorted(candidates, key=lambda job: (-self.score(job, now), job.submitted or now, job.id))
+
+    def _refresh(self, session: Session):
+        """Refresh aggregates from the database.
+
+        Args:
+            session: Database session to use.
+        """
+
+        # used CPUs of all users in the whole cluster
+        self._used_cpus = dict(session.query(Job.username, func.sum(Job.ncpus))
+                               .filter(Job.state == JobState.running)
+                               .group_by(Job.username)
+                               .all())
+
+        # consumed CPU time, which doesn't change that fast
+        if self._fairshare_halflife is None:
+            return
+        if self._last_usage_refresh is not None and time.time() - self._last_usage_refresh < self._usage_refresh:
+            return
+        self._last_usage_refresh = time.time()
+
+        # jobs that finished in the last five half-lives, older ones hardly matter, are summed up by the database in
+        # buckets by their end, so that only a few rows per user are fetched, each bucket is decayed by its middle
+        now = datetime.datetime.now()
+        halflife = self._fairshare_halflife * 3600.
+        width = halflife / FAIRSHARE_BUCKETS
+        bounds = [now - datetime.timedelta(seconds=(i + 1) * width) for i in range(5 * FAIRSHARE_BUCKETS)]
+        usage = {}
+        for table in (Job, JobHistory):
+            bucket = case(*[(table.finished >= bound, i) for i, bound in enumerate(bounds)])
+            cpu_time = func.sum(table.ncpus * self._seconds(session, table.started, table.finished))
+            rows = session \
+                .query(table.username, bucket, cpu_time) \
+                .filter(table.finished >= bounds[-1], table.started != None) \
+                .group_by(table.username, bucket)
+            for username, i, seconds in rows:
+                decay = 0.5 ** ((i + .5) / FAIRSHARE_BUCKETS)
+                usage[username] = usage.get(username, 0.) + float(seconds or 0.) * decay
+
+        # running jobs count fully
+        cpu_time = func.sum(Job.ncpus * self._seconds(session, Job.started, now))
+        rows = session \
+            .query(Job.username, cpu_time) \
+            .filter(Job.state == JobState.running, Job.started != None) \
+            .group_by(Job.username)
+        for username, seconds in rows:
+            usage[username] = usage.get(username, 0.) + float(seconds or 0.)
+        self._usage = usage
+
+    @staticmethod
+    def _seconds(session: Session, start, end):
+        """Build an expression for the number of seconds between two dates, which every database does differently.
+
+        Args:
+            session: Database session to use.
+            start: Start date, a column or a datetime.
+            end: End date, a column or a datetime.
+
+        Returns:
+            SQL expression.
+        """
+        dialect = session.get_bind().dialect.name
+        if dialect == 'sqlite':
+            return (func.julianday(end) - func.julianday(start)) * 86400.
+        elif dialect == 'mysql':
+            return func.timestampdiff(literal_column('SECOND'), start, end)
+        elif dialect == 'postgresql':
+            return func.extract('epoch', end - start)
+        raise ValueError('Fair-share is not supported on %s.' % dialect)
+
+
+__all__ = ['Scheduler']
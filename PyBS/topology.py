@@ -0,0 +1,118 @@
+import glob
+import os
+import re
+
+
+def parse_cpulist(cpulist: str) -> list:
+    """Parse a list of CPUs in the format used by the kernel, e.g. "0-3,8,10-11".
+
+    Args:
+        cpulist: List of CPUs.
+
+    Returns:
+        Sorted list of CPU numbers.
+    """
+    cpus = set()
+    for item in cpulist.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        m = re.match(r'^(\d+)(?:-(\d+))?$', item)
+        if m is None:
+            raise ValueError('Invalid list of CPUs: %s' % cpulist)
+        first = int(m.group(1))
+        cpus.update(range(first, int(m.group(2) or first) + 1))
+    return sorted(cpus)
+
+
+def format_cpulist(cpus) -> str:
+    """Format CPU numbers as list in the format used by the kernel, e.g. "0-3,8,10-11".
+
+    Args:
+        cpus: CPU numbers.
+
+    Returns:
+        List of CPUs.
+    """
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join('%d' % a if a == b else '%d-%d' % (a, b) for a, b in ranges)
+
+
+class Topology:
+    """The CPU cores of a node that are available for jobs, grouped by NUMA node.
+
+    Cores are assigned to jobs, so that each job runs on cores of as few NUMA nodes as possible, and jobs do not share
+    caches and memory bandwidth with other jobs more than necessary.
+    """
+
+    def __init__(self, nodes: list = None):
+        """Creates a new topology.
+
+        Args:
+            nodes: List of lists of cores, one for each NUMA node. If None, read from /sys.
+        """
+        self.nodes = self._read_nodes() if nodes is None else [sorted(node) for node in nodes if node]
+        self.cores = sorted(core for node in self.nodes for core in node)
+
+    @staticmethod
+    def _read_nodes() -> list:
+        """Read NUMA nodes from /sys, only using the cores the daemon itself is allowed to run on.
+
+        Returns:
+            List of lists of cores, one for each NUMA node.
+        """
+
+        # cores the daemon may use
+        allowed = os.sched_getaffinity(0)
+
+        # get NUMA nodes, if available
+        nodes = []
+        for filename in sorted(glob.glob('/sys/devices/system/node/node*/cpulist')):
+            with open(filename, 'r') as f:
+                cores = [core for core in parse_cpulist(f.read()) if core in allowed]
+            if cores:
+                nodes.append(cores)
+
+        # otherwise a single node with all cores
+        return nodes if nodes else [sorted(allowed)]
+
+    def assign(self, ncpus: int, used) -> list:
+        """Pick cores for a new job.
+
+        If possible, all cores are taken from a single NUMA node, namely the one with the fewest free cores that still
+        fit, so that larger holes remain for larger jobs. Otherwise, cores are taken from the nodes with the most free
+        cores first.
+
+        Args:
+            ncpus: Number of requested cores.
+            used: Cores used by other jobs.
+
+        Returns:
+            Sorted list of cores or None, if not enough cores are free.
+        """
+
+        # get free cores on each node
+        free = [[core for core in node if core not in used] for node in self.nodes]
+        if sum(len(cores) for cores in free) < ncpus:
+            return None
+
+        # fits into a single node?
+        fitting = [cores for cores in free if len(cores) >= ncpus]
+        if fitting:
+            return min(fitting, key=len)[:ncpus]
+
+        # spread over nodes
+        assigned = []
+        for cores in sorted(free, key=len, reverse=True):
+            assigned.extend(cores[:ncpus - len(assigned)])
+            if len(assigned) == ncpus:
+                break
+        return sorted(assigned)
+
+
+__all__ = ['parse_cpulist', 'format_cpulist', 'Topology']
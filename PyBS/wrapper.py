@@ -0,0 +1,67 @@
+"""Runs the script of a job and reports its exit code and resource usage to the daemon.
+
+The daemon cannot get the resource usage of its children from asyncio, which reaps them itself, so this script is run
+in between: it starts the job script in a shell, waits for it with os.wait4(), writes the exit code and resource usage
+as JSON to a status file, and finally exits like the shell did. Since the status file survives a restart of the
+daemon, the outcome of jobs that have been adopted by a new daemon is known, too.
+
+It is executed as a script in isolated mode and must therefore not import anything from PyBS.
+
+Usage: python -I wrapper.py <status file> <command>
+"""
+import json
+import os
+import resource
+import signal
+import sys
+
+
+def main():
+    status_file, command = sys.argv[1], sys.argv[2]
+
+    # the whole process group is signalled, when the job is terminated, so wait for the job to finish instead
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    # start job script like subprocess does with shell=True
+    pid = os.fork()
+    if pid == 0:
+        try:
+            # Python ignores SIGPIPE and SIGXFSZ, restore them for the job like subprocess does, and SIGTERM, too
+            for sig in (signal.SIGPIPE, signal.SIGXFSZ, signal.SIGTERM):
+                signal.signal(sig, signal.SIG_DFL)
+            os.execv('/bin/sh', ['/bin/sh', '-c', command])
+        finally:
+            os._exit(127)
+
+    # wait for it, retrying on interrupts
+    _, status, rusage = os.wait4(pid, 0)
+
+    # report exit code and usage, sizes are given in KB and in blocks of 512 bytes on Linux
+    report = {
+        'exit_code': os.waitstatus_to_exitcode(status),
+        'cpu_user': rusage.ru_utime,
+        'cpu_system': rusage.ru_stime,
+        'max_rss': rusage.ru_maxrss * 1024,
+        'io_read': rusage.ru_inblock * 512,
+        'io_write': rusage.ru_oublock * 512
+    }
+    try:
+        # write to temporary file first, so that the daemon never reads a partial report
+        with open(status_file + '.tmp', 'w') as f:
+            json.dump(report, f)
+        os.replace(status_file + '.tmp', status_file)
+    except OSError:
+        # state directory is gone
+        pass
+
+    # exit like the job, re-raising the signal that killed it, but without dumping another core
+    if os.WIFSIGNALED(status):
+        sig = os.WTERMSIG(status)
+        resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+        signal.signal(sig, signal.SIG_DFL)
+        os.kill(os.getpid(), sig)
+    sys.exit(os.waitstatus_to_exitcode(status))
+
+
+if __name__ == '__main__':
+    main()
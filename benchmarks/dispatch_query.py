@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""Measures the duration of the query used for finding jobs to start.
+
+Fills a temporary sqlite database with a given number of finished jobs plus a small queue of waiting jobs, of which
+some are restricted to other nodes, and times the dispatch query of the daemon.
+"""
+import argparse
+import asyncio
+import datetime
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from PyBS import PyBSdaemon
+from PyBS.db import Database, Job, JobNode
+
+
+def fill(database: Database, historic: int, waiting: int):
+    """Fill database with jobs.
+
+    Args:
+        database: Database to fill.
+        historic: Number of finished jobs.
+        waiting: Number of waiting jobs.
+    """
+    now = datetime.datetime.now()
+    with database() as session:
+        # finished jobs in chunks
+        for offset in range(0, historic, 10000):
+            session.execute(Job.__table__.insert(), [{
+                'name': 'old', 'username': 'bench', 'filename': 'old.sh', 'ncpus': 1, 'priority': 0, 'node': 'bench',
+                'submitted': now, 'started': now, 'finished': now - datetime.timedelta(seconds=i)
+            } for i in range(offset, min(offset + 10000, historic))])
+
+        # waiting jobs, every other one restricted to another node
+        for i in range(waiting):
+            job = Job(name='new', username='bench', filename='new.sh', ncpus=1, priority=i % 3, submitted=now)
+            if i % 2 == 0:
+                job.nodes = 'other'
+                job.allowed_nodes = [JobNode(node='other')]
+            session.add(job)
+
+
+async def run(args):
+    # create and fill temporary database
+    tmp = tempfile.mkdtemp()
+    database = Database('sqlite:///' + os.path.join(tmp, 'pybs.db'))
+    print('Filling database with %d finished and %d waiting jobs...' % (args.historic, args.waiting))
+    fill(database, args.historic, args.waiting)
+
+    # create daemon, which will not start any jobs during the benchmark
+    daemon = PyBSdaemon(database, nodename='bench', ncpus=args.ncpus, root_dir='/', state_dir=tmp)
+
+    # time query
+    durations = []
+    with database() as session:
+        for i in range(args.repeat):
+            start = time.perf_counter()
+            jobs = daemon._dispatch_query(session, args.ncpus).limit(args.ncpus).all()
+            durations.append(time.perf_counter() - start)
+    daemon.close()
+
+    # print results
+    print('Dispatch query with %d historic jobs: found %d jobs, min %.2fms, mean %.2fms' %
+          (args.historic, len(jobs), min(durations) * 1000., sum(durations) / len(durations) * 1000.))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Dispatch query benchmark')
+    parser.add_argument('historic', type=int, nargs='?', help='number of finished jobs in database', default=10000)
+    parser.add_argument('-w', '--waiting', type=int, help='number of waiting jobs', default=100)
+    parser.add_argument('-n', '--ncpus', type=int, help='number of CPUs for daemon', default=8)
+    parser.add_argument('-r', '--repeat', type=int, help='number of repetitions', default=20)
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""Checks that the event loop of the daemon stays responsive while it starts jobs and database queries are slow.
+
+Every query is artificially delayed, while a ticker measures how late the event loop wakes it up. A number of trivial
+jobs is submitted at once to a daemon with as many CPUs, so that all of them are started, run, and finished
+concurrently, while some listings are requested, too. With the database running in worker threads, the lag should
+stay far below the delay of a query. Since the wrappers of the jobs compete with the daemon for the CPUs, the
+number of jobs defaults to four per CPU, more of them slow down the whole host, not just the event loop.
+
+Exits with 0, if all jobs finished successfully and the maximum lag stayed below the given limit, and with 1 otherwise,
+so that it can be run as a check in CI.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from sqlalchemy import event
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from PyBS import PyBSdaemon
+from PyBS.db import Database, Job, JobState, FINISHED_STATES
+
+
+SCRIPT = """#!/bin/sh
+#PBS -N responsiveness
+#PBS -l ncpus=1
+true
+"""
+
+
+async def ticker(interval: float, lags: list):
+    """Measure how late the event loop wakes up the ticker."""
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+def count_states(session, job_ids: list) -> dict:
+    """Returns number of jobs in each state."""
+    counts = {}
+    for job in session.query(Job).filter(Job.id.in_(job_ids)):
+        counts[job.state] = counts.get(job.state, 0) + 1
+    return counts
+
+
+async def run(args) -> bool:
+    # create temporary database and job script
+    tmp = tempfile.mkdtemp()
+    database = Database('sqlite:///' + os.path.join(tmp, 'pybs.db'))
+    script = os.path.join(tmp, 'job.sh')
+    with open(script, 'w') as f:
+        f.write(SCRIPT)
+    os.chmod(script, 0o775)
+
+    # create daemon with a CPU for every job and wait for its initial delay
+    daemon = PyBSdaemon(database, nodename='bench', ncpus=args.jobs, root_dir='/', state_dir=tmp)
+    await asyncio.sleep(args.warmup)
+
+    # delay all queries from now on and start ticker
+    event.listen(database._engine, 'before_cursor_execute', lambda *a, **kw: time.sleep(args.delay))
+    lags = []
+    tick = asyncio.ensure_future(ticker(0.01, lags))
+
+    # submit all jobs at once and run some slow listings concurrently
+    start = time.perf_counter()
+    results = await asyncio.gather(*[daemon.submit(script, 'bench') for _ in range(args.jobs)],
+                                   *[daemon.list_waiting() for _ in range(args.queries)])
+    job_ids = [r['id'] for r in results[:args.jobs]]
+
+    # wait for all jobs to finish
+    while True:
+        counts = await database.run(count_states, job_ids)
+        if sum(counts.get(state, 0) for state in FINISHED_STATES) == len(job_ids):
+            break
+        if time.perf_counter() - start > args.timeout:
+            break
+        await asyncio.sleep(0.1)
+    duration = time.perf_counter() - start
+    tick.cancel()
+    daemon.close()
+
+    # print results
+    max_lag = max(lags)
+    done = counts.get(JobState.done, 0)
+    print('%d of %d jobs done with queries delayed by %.3fs in %.2fs, maximum event loop lag was %.1fms' %
+          (done, args.jobs, args.delay, duration, max_lag * 1000.))
+
+    # check them
+    success = True
+    if done < args.jobs:
+        print('Not all jobs finished successfully: %s' % ', '.join('%s=%d' % (s.value, n) for s, n in counts.items()))
+        success = False
+    if max_lag * 1000. > args.max_lag_ms:
+        print('Event loop lag exceeded %.1fms.' % args.max_lag_ms)
+        success = False
+    return success
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Event loop responsiveness check')
+    parser.add_argument('-j', '--jobs', type=int, help='number of jobs to start concurrently',
+                        default=4 * os.cpu_count())
+    parser.add_argument('-d', '--delay', type=float, help='delay for each query in seconds', default=0.1)
+    parser.add_argument('-q', '--queries', type=int, help='number of concurrent listings', default=8)
+    parser.add_argument('-l', '--max-lag-ms', type=float, help='maximum allowed event loop lag in ms', default=50.)
+    parser.add_argument('-t', '--timeout', type=float, help='maximum time for all jobs to finish', default=120.)
+    parser.add_argument('-w', '--warmup', type=float, help='time to wait for daemon to start', default=11.)
+    args = parser.parse_args()
+    success = asyncio.get_event_loop().run_until_complete(run(args))
+    sys.exit(0 if success else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""Checks that no job is ever started twice when several daemons share a single database.
+
+Starts a number of daemons with different node names in separate processes, all polling one database in short
+intervals, and fills the queue with trivial jobs, which append their ID to a common log file. When all jobs are
+finished, every ID must appear exactly once in the log.
+"""
+import argparse
+import asyncio
+import collections
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from PyBS import PyBSdaemon
+from PyBS.db import Database, Job, JobState, FINISHED_STATES
+
+
+SCRIPT = """#!/bin/sh
+echo $PBS_JOBID >> {0}
+"""
+
+
+def _count_unfinished(database: Database) -> int:
+    """Returns number of unfinished jobs."""
+    with database() as session:
+        return session.query(Job).filter(~Job.state.in_(FINISHED_STATES)).count()
+
+
+async def run_daemon(args, node: str):
+    # create daemon polling the database all the time
+    database = Database(args.database)
+    daemon = PyBSdaemon(database, nodename=node, ncpus=args.ncpus, root_dir='/', poll_interval=args.poll,
+                        heartbeat_interval=1, state_dir=tempfile.mkdtemp())
+
+    # wait for all jobs to finish
+    while _count_unfinished(database) > 0:
+        await asyncio.sleep(0.5)
+    daemon.close()
+    database.close()
+
+
+def daemon_process(args, node: str):
+    asyncio.get_event_loop().run_until_complete(run_daemon(args, node))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Multi-node claiming stress test')
+    parser.add_argument('-d', '--daemons', type=int, help='number of daemons', default=4)
+    parser.add_argument('-j', '--jobs', type=int, help='number of jobs', default=500)
+    parser.add_argument('-n', '--ncpus', type=int, help='number of CPUs per daemon', default=4)
+    parser.add_argument('-p', '--poll', type=float, help='poll interval of daemons', default=0.05)
+    parser.add_argument('--database', type=str, help='database URI, defaults to a temporary sqlite file')
+    args = parser.parse_args()
+
+    # create job script and log
+    tmp = tempfile.mkdtemp()
+    log_file = os.path.join(tmp, 'started.log')
+    script = os.path.join(tmp, 'job.sh')
+    with open(script, 'w') as f:
+        f.write(SCRIPT.format(log_file))
+    os.chmod(script, 0o775)
+
+    # create database and fill queue
+    if args.database is None:
+        args.database = 'sqlite:///' + os.path.join(tmp, 'pybs.db')
+    database = Database(args.database)
+    with database() as session:
+        session.query(Job).delete()
+        for i in range(args.jobs):
+            job = Job.from_file(script)
+            job.username = 'stress'
+            job.filename = os.path.relpath(script, '/')
+            session.add(job)
+
+    # run daemons
+    print('Running %d jobs on %d daemons...' % (args.jobs, args.daemons))
+    start = time.time()
+    processes = [multiprocessing.Process(target=daemon_process, args=(args, 'node%d' % i))
+                 for i in range(args.daemons)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+    print('Finished after %.1fs.' % (time.time() - start))
+
+    # count starts per job
+    with open(log_file, 'r') as f:
+        starts = collections.Counter(int(line) for line in f if line.strip())
+    with database() as session:
+        jobs = session.query(Job.id, Job.node, Job.state).all()
+    per_node = collections.Counter(job.node for job in jobs)
+    print('Jobs per node: %s' % ', '.join('%s: %d' % (n, c) for n, c in sorted(per_node.items(), key=str)))
+
+    # check results
+    twice = [job_id for job_id, count in starts.items() if count > 1]
+    missing = [job.id for job in jobs if job.id not in starts]
+    failed = [job.id for job in jobs if job.state != JobState.done]
+    print('Started twice: %d, never started: %d, not done: %d' % (len(twice), len(missing), len(failed)))
+    if twice or missing or failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""Checks that notifications are delivered in the background, combined into digests, and retried.
+
+Runs a minimal SMTP server on localhost, which answers every command after a delay and refuses the first connections,
+if requested. Then a burst of notifications is queued, like for all tasks of an array job, while a ticker measures how
+late the event loop wakes it up. All notifications should arrive as a single digest over a single connection.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from PyBS.mailer import Mailer, Notifier
+
+
+class SmtpServer:
+    """A minimal SMTP server that only counts connections and messages."""
+
+    def __init__(self, delay: float, refuse: int):
+        """Creates a new server.
+
+        Args:
+            delay: Delay in seconds before each reply.
+            refuse: Number of connections to close right away.
+        """
+        self.delay = delay
+        self.refuse = refuse
+        self.connections = 0
+        self.messages = []
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # refuse connection?
+        self.connections += 1
+        if self.connections <= self.refuse:
+            writer.close()
+            return
+
+        async def reply(line: str):
+            await asyncio.sleep(self.delay)
+            writer.write((line + '\r\n').encode())
+            await writer.drain()
+
+        # talk SMTP
+        await reply('220 localhost ready')
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            command = line.decode().strip().upper()
+            if command.startswith('DATA'):
+                await reply('354 go ahead')
+                data = []
+                while True:
+                    line = await reader.readline()
+                    if line in (b'.\r\n', b''):
+                        break
+                    data.append(line.decode())
+                self.messages.append(''.join(data))
+                await reply('250 ok')
+            elif command.startswith('QUIT'):
+                await reply('221 bye')
+                break
+            else:
+                await reply('250 ok')
+        writer.close()
+
+
+async def ticker(interval: float, lags: list):
+    """Measure how late the event loop wakes up the ticker."""
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+async def run(args):
+    # start SMTP server
+    smtp = SmtpServer(args.delay, args.refuse)
+    server = await asyncio.start_server(smtp.handle, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+
+    # create notifier and start ticker
+    notifier = Notifier(Mailer(sender='pybs@localhost', host='127.0.0.1:%d' % port), delay=0.5, retry_delay=0.5)
+    lags = []
+    tick = asyncio.ensure_future(ticker(0.01, lags))
+
+    # queue burst of notifications and a single one for another recipient
+    start = time.perf_counter()
+    for i in range(args.notifications):
+        notifier.notify('email', 'user@localhost', 'PyBS JOB %d task[%d] finished' % (i, i), 'Exit code: 0')
+    notifier.notify('email', 'other@localhost', 'PyBS JOB 0 single finished', 'Exit code: 0')
+    queued = time.perf_counter() - start
+
+    # wait for delivery
+    while len(smtp.messages) < 2 and time.perf_counter() - start < 60:
+        await asyncio.sleep(0.1)
+    duration = time.perf_counter() - start
+    tick.cancel()
+    notifier.close()
+    server.close()
+
+    # print results
+    print('Queued %d notifications in %.3fms, delivered %d messages over %d connections after %.2fs' %
+          (args.notifications + 1, queued * 1000., len(smtp.messages), smtp.connections, duration))
+    print('Maximum event loop lag was %.3fs with an SMTP delay of %.2fs per reply' % (max(lags), args.delay))
+    if len(smtp.messages) != 2 or max(lags) > 0.1:
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Notification delivery check')
+    parser.add_argument('notifications', type=int, nargs='?', help='number of notifications in burst', default=500)
+    parser.add_argument('-d', '--delay', type=float, help='delay of SMTP server for each reply', default=0.2)
+    parser.add_argument('-r', '--refuse', type=int, help='number of connections to refuse', default=1)
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(run(args))
+
+
+if __name__ == '__main__':
+    main()
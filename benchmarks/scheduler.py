@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""Measures the costs of the scheduling policies and checks their fairness.
+
+Fills a temporary sqlite database with a deep queue, in which a single user submitted most of the jobs before all
+others, plus some finished jobs of that user. Then times one scheduling pass with the strict and the fair-share policy
+and prints, whose jobs would be started.
+"""
+import argparse
+import asyncio
+import collections
+import datetime
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from PyBS import PyBSdaemon
+from PyBS.db import Database, Job, JobState
+from PyBS.scheduler import Scheduler
+
+
+def fill(database: Database, waiting: int, users: int):
+    """Fill database with jobs.
+
+    Args:
+        database: Database to fill.
+        waiting: Number of waiting jobs.
+        users: Number of users besides the one submitting most of the jobs.
+    """
+    now = datetime.datetime.now()
+    with database() as session:
+        # the heavy user submitted 90% of the jobs first
+        heavy = int(waiting * 0.9)
+        rows = [{'name': 'sweep', 'username': 'heavy', 'filename': 'sweep.sh', 'ncpus': 1, 'priority': 0,
+                 'submitted': now - datetime.timedelta(hours=2), 'state': JobState.waiting}
+                for _ in range(heavy)]
+
+        # other users later
+        rows += [{'name': 'job', 'username': 'user%d' % (i % users), 'filename': 'job.sh', 'ncpus': 1, 'priority': 0,
+                  'submitted': now - datetime.timedelta(hours=1), 'state': JobState.waiting}
+                 for i in range(waiting - heavy)]
+
+        # and the heavy user already consumed a lot of CPU time
+        rows += [{'name': 'old', 'username': 'heavy', 'filename': 'old.sh', 'ncpus': 8, 'priority': 0,
+                  'submitted': now, 'started': now - datetime.timedelta(hours=3),
+                  'finished': now - datetime.timedelta(hours=1), 'state': JobState.done}
+                 for _ in range(100)]
+
+        # insert in chunks
+        for offset in range(0, len(rows), 10000):
+            session.execute(Job.__table__.insert(), rows[offset:offset + 10000])
+
+
+async def run(args):
+    # create and fill temporary database
+    tmp = tempfile.mkdtemp()
+    database = Database('sqlite:///' + os.path.join(tmp, 'pybs.db'))
+    print('Filling database with %d waiting jobs of %d users...' % (args.waiting, args.users + 1))
+    fill(database, args.waiting, args.users)
+
+    # create daemon, which will not start any jobs during the benchmark
+    daemon = PyBSdaemon(database, nodename='bench', ncpus=args.ncpus, root_dir='/', state_dir=tmp)
+
+    # compare policies
+    policies = [
+        ('strict', Scheduler()),
+        ('fair-share', Scheduler(user_cpu_limit=args.limit, fairshare_halflife=24., priority_aging=0.1))
+    ]
+    for name, scheduler in policies:
+        durations = []
+        with database() as session:
+            for i in range(args.repeat):
+                start = time.perf_counter()
+                picked = scheduler.pick(session, daemon._dispatch_query(session, args.ncpus), args.ncpus, True)
+                durations.append(time.perf_counter() - start)
+                scheduler._used_cpus = {}
+            users = collections.Counter(session.query(Job.username).filter(Job.id == job_id).scalar()
+                                        for job_id, _, _ in picked)
+
+        # print results
+        print('%-10s min %6.2fms, mean %6.2fms, started jobs per user: %s' %
+              (name, min(durations) * 1000., sum(durations) / len(durations) * 1000.,
+               ', '.join('%s: %d' % u for u in sorted(users.items()))))
+    daemon.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Scheduling policy benchmark')
+    parser.add_argument('waiting', type=int, nargs='?', help='number of waiting jobs', default=100000)
+    parser.add_argument('-u', '--users', type=int, help='number of other users', default=5)
+    parser.add_argument('-n', '--ncpus', type=int, help='number of CPUs for daemon', default=16)
+    parser.add_argument('-l', '--limit', type=int, help='CPU limit per user for fair-share policy', default=8)
+    parser.add_argument('-r', '--repeat', type=int, help='number of repetitions', default=10)
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""Measures the latency between submitting a job and its start.
+
+Runs a PyBS daemon against a temporary sqlite database, submits trivial jobs one after another at random times and
+reports how long it took for each job to be started by the daemon.
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from PyBS import PyBSdaemon
+from PyBS.db import Database, Job
+
+
+SCRIPT = """#!/bin/sh
+#PBS -N latency
+#PBS -l ncpus=1
+true
+"""
+
+
+def _job_times(database: Database, job_id: int) -> (float, float):
+    """Returns start and finish time of the given job."""
+    with database() as session:
+        job = session.query(Job).filter(Job.id == job_id).first()
+        return job.started, job.finished
+
+
+async def run(args):
+    # create temporary database and job script
+    tmp = tempfile.mkdtemp()
+    database = Database('sqlite:///' + os.path.join(tmp, 'pybs.db'))
+    script = os.path.join(tmp, 'job.sh')
+    with open(script, 'w') as f:
+        f.write(SCRIPT)
+    os.chmod(script, 0o775)
+
+    # start daemon and wait for its initial delay
+    daemon = PyBSdaemon(database, nodename='bench', ncpus=args.ncpus, root_dir='/', state_dir=tmp)
+    await asyncio.sleep(args.warmup)
+
+    latencies = []
+    for i in range(args.jobs):
+        # submit at random point in time
+        await asyncio.sleep(random.uniform(0, args.spread))
+        submitted = time.time()
+        job_id = (await daemon.submit(script, 'bench'))['id']
+
+        # wait for start
+        while True:
+            started, finished = _job_times(database, job_id)
+            if started is not None:
+                latencies.append(time.time() - submitted)
+                break
+            await asyncio.sleep(0.01)
+
+        # wait for job to finish, so that next job doesn't depend on this one
+        while _job_times(database, job_id)[1] is None:
+            await asyncio.sleep(0.01)
+
+        print('Job %d started after %.3fs' % (i + 1, latencies[-1]))
+
+    daemon.close()
+
+    # print statistics
+    print('Submit-to-start latency for %d jobs: mean %.3fs, median %.3fs, max %.3fs' %
+          (len(latencies), statistics.mean(latencies), statistics.median(latencies), max(latencies)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Submit-to-start latency benchmark')
+    parser.add_argument('-j', '--jobs', type=int, help='number of jobs to submit', default=10)
+    parser.add_argument('-n', '--ncpus', type=int, help='number of CPUs for daemon', default=4)
+    parser.add_argument('-s', '--spread', type=float, help='maximum random delay between submissions', default=2.)
+    parser.add_argument('-w', '--warmup', type=float, help='time to wait for daemon to start', default=11.)
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(run(args))
+
+
+if __name__ == '__main__':
+    main()
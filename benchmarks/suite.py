@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+"""Benchmark suite for the daemon, writing JSON results that can be compared between commits.
+
+Starts a PyBS daemon with an RPC server and metrics in a separate process, just like pybsd does, against a temporary
+sqlite database or the given one, e.g. a local MySQL. Then drives it through the RPC interface with these workloads,
+in this order:
+
+    submit   thousands of single submits of trivial "true" jobs, while the daemon has no CPUs
+    stat     concurrent clients calling "status", while all those jobs are waiting
+    drain    gives the daemon its CPUs and waits for all jobs to finish
+    latency  submits jobs one by one to the idle daemon and waits for each to start
+    array    submits array jobs and waits for all of their tasks to finish
+
+Reported are submit throughput, submit-to-start latency percentiles, scheduling overhead per job, RPC latencies, and
+the RSS of the daemon after each workload. With --compare, the results are compared to those of an earlier run.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from PyBS import PyBSdaemon, RpcServer, RpcClient
+from PyBS.db import Database, Job, JobArray, JobDependency, JobHistory, JobNode, Node, FINISHED_STATES
+from PyBS.metrics import Metrics, MetricsServer
+
+
+SCRIPT = """#!/bin/sh
+#PBS -N bench
+#PBS -l ncpus=1
+true
+"""
+
+ARRAY_SCRIPT = """#!/bin/sh
+#PBS -N sweep
+#PBS -l ncpus=1
+#PBS -J 1-{0}
+true
+"""
+
+# time the daemon waits after its start, before it starts any jobs
+DAEMON_WARMUP = 10.5
+
+# results that get better when they get larger, all others get better when they get smaller
+HIGHER_IS_BETTER = ('throughput', 'requests_per_second')
+
+
+def percentiles(values: list) -> dict:
+    """Summarize a list of durations in seconds.
+
+    Args:
+        values: Durations.
+
+    Returns:
+        Dictionary with mean, median, 90th and 99th percentiles, and maximum.
+    """
+    if not values:
+        return {}
+    q = statistics.quantiles(values, n=100, method='inclusive') if len(values) > 1 else [values[0]] * 99
+    return {'mean': statistics.mean(values), 'p50': q[49], 'p90': q[89], 'p99': q[98], 'max': max(values)}
+
+
+def serve(args, ready):
+    """Run daemon, RPC server, and metrics server until SIGTERM, like pybsd.
+
+    Args:
+        args: Command line arguments.
+        ready: Event to set, when servers are open.
+    """
+    logging.basicConfig(level=logging.WARNING)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    # create daemon without CPUs, so that submitted jobs stay in queue
+    metrics = Metrics()
+    database = Database(args.database, metrics=metrics)
+    daemon = PyBSdaemon(database, nodename='bench', ncpus=0, root_dir='/', metrics=metrics,
+                        state_dir=tempfile.mkdtemp())
+    server = RpcServer(daemon, args.port, batch=database.batch, metrics=metrics)
+    metrics_server = MetricsServer(metrics, args.metrics_port)
+    loop.run_until_complete(server.open())
+    loop.run_until_complete(metrics_server.open())
+
+    # run until terminated
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    ready.set()
+    loop.run_forever()
+    daemon.close()
+    server.close()
+    metrics_server.close()
+
+
+class Benchmark:
+    """Drives a running daemon with workloads."""
+
+    def __init__(self, args, pid: int, tmp: str):
+        """Creates a new benchmark.
+
+        Args:
+            args: Command line arguments.
+            pid: Process ID of daemon.
+            tmp: Temporary directory for job scripts.
+        """
+        self.args = args
+        self.pid = pid
+        self.started = time.time()
+        self.client = RpcClient(port=args.port)
+        self.database = Database(args.database)
+
+        # create job scripts
+        self.script = self._write_script(tmp, 'job.sh', SCRIPT)
+        self.array_script = self._write_script(tmp, 'array.sh', ARRAY_SCRIPT.format(args.array_tasks))
+
+    @staticmethod
+    def _write_script(tmp: str, name: str, content: str) -> str:
+        filename = os.path.join(tmp, name)
+        with open(filename, 'w') as f:
+            f.write(content)
+        os.chmod(filename, 0o775)
+        return filename
+
+    def rss(self) -> dict:
+        """Returns the current and peak RSS of the daemon in bytes."""
+        result = {}
+        with open('/proc/%d/status' % self.pid, 'r') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in ('VmRSS', 'VmHWM'):
+                    result['rss' if key == 'VmRSS' else 'peak_rss'] = int(value.split()[0]) * 1024
+        return result
+
+    def scrape(self) -> dict:
+        """Returns all samples from the metrics endpoint of the daemon."""
+        text = urllib.request.urlopen('http://127.0.0.1:%d/metrics' % self.args.metrics_port).read().decode()
+        samples = {}
+        for line in text.splitlines():
+            if line and not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                samples[name] = float(value)
+        return samples
+
+    def unfinished(self) -> int:
+        """Returns the number of unfinished jobs."""
+        with self.database() as session:
+            return session.query(Job.id).filter(~Job.state.in_(FINISHED_STATES)).count()
+
+    def wait_finished(self, timeout: float):
+        """Wait for all jobs to finish."""
+        deadline = time.time() + timeout
+        while self.unfinished() > 0:
+            if time.time() > deadline:
+                raise RuntimeError('Jobs did not finish within %gs.' % timeout)
+            time.sleep(0.2)
+
+    def wait_ready(self):
+        """Wait for daemon to be ready to start jobs."""
+        time.sleep(max(0., self.started + DAEMON_WARMUP - time.time()))
+
+    def give_cpus(self):
+        """Give daemon its CPUs, after it is ready to start jobs."""
+        self.wait_ready()
+        self.client('setconfig', key='ncpus', value=str(self.args.ncpus))
+
+    def idle(self):
+        """Give daemon its CPUs and wait for jobs of previous workloads to finish."""
+        self.give_cpus()
+        self.wait_finished(self.args.timeout)
+
+    def run_submit(self) -> dict:
+        """Submit single jobs one after another."""
+        latencies = []
+        start = time.perf_counter()
+        for i in range(self.args.jobs):
+            t = time.perf_counter()
+            self.client('submit', filename=self.script, user='bench%d' % (i % self.args.users))
+            latencies.append(time.perf_counter() - t)
+        duration = time.perf_counter() - start
+        return {'jobs': self.args.jobs, 'seconds': duration, 'throughput': self.args.jobs / duration,
+                'rpc_latency': percentiles(latencies)}
+
+    def run_stat(self) -> dict:
+        """Call status from several clients at once."""
+        with multiprocessing.Pool(self.args.clients) as pool:
+            results = pool.starmap(stat_client, [(self.args.port, self.args.stat_seconds)] * self.args.clients)
+        latencies = [lat for result in results for lat in result]
+        return {'clients': self.args.clients, 'queue': self.unfinished(), 'requests': len(latencies),
+                'requests_per_second': len(latencies) / self.args.stat_seconds, 'rpc_latency': percentiles(latencies)}
+
+    def run_drain(self) -> dict:
+        """Give daemon its CPUs and wait for the queue to drain."""
+        self.wait_ready()
+        jobs = self.unfinished()
+        before = self.scrape()
+        start = time.perf_counter()
+        self.give_cpus()
+        self.wait_finished(self.args.timeout)
+        duration = time.perf_counter() - start
+        after = self.scrape()
+
+        # scheduling overhead from metrics
+        def delta(name):
+            return after.get(name, 0.) - before.get(name, 0.)
+        started = delta('pybs_jobs_started_total')
+        return {'jobs': jobs, 'seconds': duration, 'throughput': jobs / duration,
+                'scheduling_passes': delta('pybs_scheduling_pass_seconds_count'),
+                'scheduling_per_job': delta('pybs_scheduling_pass_seconds_sum') / started if started else None}
+
+    def run_latency(self) -> dict:
+        """Submit jobs one by one and wait for them to start."""
+        self.idle()
+        latencies, observed = [], []
+        for i in range(self.args.latency_jobs):
+            submitted = time.time()
+            job_id = self.client('submit', filename=self.script, user='bench')['id']
+
+            # wait for start
+            while True:
+                with self.database() as session:
+                    job = session.query(Job.submitted, Job.started).filter(Job.id == job_id).first()
+                if job.started is not None:
+                    break
+                time.sleep(0.005)
+            observed.append(time.time() - submitted)
+            latencies.append((job.started - job.submitted).total_seconds())
+
+            # wait for it to finish, so that node is idle again
+            self.wait_finished(self.args.timeout)
+        return {'jobs': self.args.latency_jobs, 'submit_to_start': percentiles(latencies),
+                'observed': percentiles(observed)}
+
+    def run_array(self) -> dict:
+        """Submit array jobs and wait for all tasks to finish."""
+        self.idle()
+        latencies = []
+        start = time.perf_counter()
+        for i in range(self.args.arrays):
+            t = time.perf_counter()
+            self.client('submit', filename=self.array_script, user='bench')
+            latencies.append(time.perf_counter() - t)
+        submitted = time.perf_counter() - start
+        self.wait_finished(self.args.timeout)
+        duration = time.perf_counter() - start
+        tasks = self.args.arrays * self.args.array_tasks
+        return {'arrays': self.args.arrays, 'tasks': tasks, 'submit_latency': percentiles(latencies),
+                'submit_seconds': submitted, 'seconds': duration, 'throughput': tasks / duration}
+
+
+def stat_client(port: int, seconds: float) -> list:
+    """Call status for a while and return latencies."""
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    client = RpcClient(port=port)
+    latencies = []
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        t = time.perf_counter()
+        client('status', finished=5)
+        latencies.append(time.perf_counter() - t)
+    client.close()
+    return latencies
+
+
+def clear_database(uri: str):
+    """Delete all jobs and nodes from database."""
+    database = Database(uri)
+    with database() as session:
+        for table in (JobDependency, JobNode, Job, JobArray, JobHistory, Node):
+            session.query(table).delete()
+    database.close()
+
+
+def compare(results: dict, baseline: dict, path: str = ''):
+    """Print all numbers of the results next to those of a baseline.
+
+    Args:
+        results: Results of this run.
+        baseline: Results of earlier run.
+        path: Path of current node in results.
+    """
+    for key, value in results.items():
+        name = '%s.%s' % (path, key) if path else key
+        old = baseline.get(key) if isinstance(baseline, dict) else None
+        if isinstance(value, dict):
+            compare(value, old, name)
+        elif isinstance(value, (int, float)) and isinstance(old, (int, float)) and old != 0:
+            change = value / old - 1.
+            better = change > 0 if key in HIGHER_IS_BETTER else change < 0
+            flag = '' if abs(change) < 0.1 else (' better' if better else ' WORSE')
+            print('%-45s %14.6g %14.6g %+8.1f%%%s' % (name, old, value, change * 100., flag))
+
+
+def git_commit() -> str:
+    """Returns the current commit of the repository or None."""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='PyBS benchmark suite')
+    parser.add_argument('-o', '--output', type=str, help='file to write JSON results to', default='benchmark.json')
+    parser.add_argument('-c', '--compare', type=str, help='JSON results of an earlier run to compare with')
+    parser.add_argument('-w', '--workloads', type=str, help='comma-separated list of workloads to run',
+                        default='submit,stat,drain,latency,array')
+    parser.add_argument('-j', '--jobs', type=int, help='number of jobs to submit', default=2000)
+    parser.add_argument('-u', '--users', type=int, help='number of users submitting jobs', default=4)
+    parser.add_argument('-n', '--ncpus', type=int, help='number of CPUs for daemon',
+                        default=len(os.sched_getaffinity(0)))
+    parser.add_argument('--clients', type=int, help='number of concurrent stat clients', default=4)
+    parser.add_argument('--stat-seconds', type=float, help='duration of stat workload', default=10.)
+    parser.add_argument('--latency-jobs', type=int, help='number of jobs for latency workload', default=20)
+    parser.add_argument('--arrays', type=int, help='number of array jobs', default=2)
+    parser.add_argument('--array-tasks', type=int, help='number of tasks per array job', default=500)
+    parser.add_argument('--timeout', type=float, help='maximum time for running all jobs of a workload', default=600.)
+    parser.add_argument('--port', type=int, help='RPC port of daemon', default=26219)
+    parser.add_argument('--metrics-port', type=int, help='metrics port of daemon', default=26220)
+    parser.add_argument('--database', type=str, help='database URI, which is emptied first, e.g. of a local MySQL; '
+                                                     'defaults to a temporary sqlite file')
+    args = parser.parse_args()
+    workloads = [w.strip() for w in args.workloads.split(',') if w.strip()]
+
+    # create empty database
+    tmp = tempfile.mkdtemp()
+    if args.database is None:
+        args.database = 'sqlite:///' + os.path.join(tmp, 'pybs.db')
+    clear_database(args.database)
+
+    # start daemon
+    ready = multiprocessing.Event()
+    daemon = multiprocessing.Process(target=serve, args=(args, ready))
+    daemon.start()
+    try:
+        if not ready.wait(60):
+            raise RuntimeError('Daemon did not start.')
+
+        # run workloads
+        bench = Benchmark(args, daemon.pid, tmp)
+        results = {}
+        for workload in workloads:
+            print('Running %s...' % workload)
+            results[workload] = getattr(bench, 'run_' + workload)()
+            results[workload].update(bench.rss())
+            print(json.dumps(results[workload], indent=2))
+        bench.client.close()
+
+    finally:
+        # stop daemon
+        daemon.terminate()
+        daemon.join()
+
+    # write results, without credentials of database
+    output = {
+        'commit': git_commit(),
+        'date': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'database': args.database.split(':')[0],
+        'args': {k: v for k, v in vars(args).items() if k not in ('database', 'output', 'compare')},
+        'results': results
+    }
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+    print('Wrote results to %s.' % args.output)
+
+    # compare
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        print('Comparing with %s from commit %s:' % (args.compare, baseline.get('commit')))
+        print('%-45s %14s %14s %9s' % ('Result', 'Baseline', 'Current', 'Change'))
+        compare(results, baseline.get('results', {}))
+
+
+if __name__ == '__main__':
+    main()